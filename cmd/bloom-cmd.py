@@ -22,7 +22,7 @@ def ruin_bloom(bloomfilename):
         add_error("bloom: %s not found to ruin\n" % rbloomfilename)
         return
     b = bloom.ShaBloom(bloomfilename, readwrite=True, expected=1)
-    b.map[16:16+2**b.bits] = '\0' * 2**b.bits
+    b.map[b.headerlen:b.headerlen+2**b.bits] = '\0' * 2**b.bits
 
 
 def check_bloom(path, bloomfilename, idx):
@@ -49,8 +49,19 @@ def check_bloom(path, bloomfilename, idx):
                       % str(objsha).encode('hex'))
 
 
-_first = None
 def do_bloom(path, outfilename):
+    # Keep anyone else from adding to the filter in place (see
+    # git.update_bloom()) until it's been updated or replaced here.
+    lockf = bloom.lock(outfilename)
+    try:
+        _do_bloom(path, outfilename, lockf)
+    finally:
+        if lockf:
+            lockf.close()
+
+
+_first = None
+def _do_bloom(path, outfilename, lockf):
     global _first
     b = None
     if os.path.exists(outfilename) and not opt.force:
@@ -58,6 +69,10 @@ def do_bloom(path, outfilename):
         if not b.valid():
             debug1("bloom: Existing invalid bloom found, regenerating.\n")
             b = None
+        elif b.version != version:
+            debug1("bloom: converting v%d bloom to v%d.\n"
+                   % (b.version, version))
+            b = None
 
     add = []
     rest = []
@@ -75,28 +90,32 @@ def do_bloom(path, outfilename):
             add_count += len(ix)
     total = add_count + rest_count
 
-    if not add:
-        debug1("bloom: nothing to do.\n")
-        return
-
     if b:
         if len(b) != rest_count:
             debug1("bloom: size %d != idx total %d, regenerating\n"
                    % (len(b), rest_count))
             b = None
-        elif (b.bits < bloom.MAX_BLOOM_BITS and
-              b.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
-            debug1("bloom: regenerating: adding %d entries gives "
+        elif b.needs_regrow(add_count):
+            # PackWriter adds new indexes to the filter itself, so this is
+            # usually how the filter gets bigger.
+            debug1("bloom: regenerating: %d entries give "
                    "%.2f%% false positives.\n"
-                   % (add_count, b.pfalse_positive(add_count)))
+                   % (total, b.pfalse_positive(add_count)))
             b = None
+        elif not add:
+            debug1("bloom: nothing to do.\n")
+            return
         else:
-            b = bloom.ShaBloom(outfilename, readwrite=True, expected=add_count)
+            b = bloom.ShaBloom(outfilename, f=lockf, readwrite=True,
+                               expected=add_count)
     if not b: # Need all idxs to build from scratch
         add += rest
         add_count += rest_count
     del rest
     del rest_count
+    if not add:
+        debug1("bloom: nothing to do.\n")
+        return
 
     msg = b is None and 'creating from' or 'adding'
     if not _first: _first = path
@@ -109,7 +128,8 @@ def do_bloom(path, outfilename):
     tfname = None
     if b is None:
         tfname = os.path.join(path, 'bup.tmp.bloom')
-        b = bloom.create(tfname, expected=add_count, k=opt.k)
+        b = bloom.create(tfname, expected=add_count, k=opt.k,
+                         version=version)
     count = 0
     icount = 0
     for name in add:
@@ -147,6 +167,13 @@ git.check_repo_or_die()
 if not opt.check and opt.k and opt.k not in (4,5):
     o.fatal('only k values of 4 and 5 are supported')
 
+if not (opt.check or opt.ruin):
+    try:
+        version = bloom.version_from_config(git.git_config_get)
+    except ValueError, e:
+        log('error: %s\n' % e)
+        sys.exit(1)
+
 paths = opt.dir and [opt.dir] or git.all_packdirs()
 for path in paths:
     debug1('bloom: scanning %s\n' % path)
@@ -12,6 +12,7 @@ exclude= a path to exclude from the backup (can be used more than once)
 exclude-from= a file that contains exclude paths (can be used more than once)
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
+j,jobs=  number of directories to read at once [1]
 q,quiet  don't actually print filenames
 profile  run under the python profiler
 """
@@ -20,6 +21,8 @@ o = options.Options(optspec)
 
 if len(extra) != 1:
     o.fatal("exactly one filename expected")
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 drecurse_top = extra[0]
 excluded_paths = parse_excludes(flags, o.fatal)
@@ -28,7 +31,7 @@ if not drecurse_top.startswith('/'):
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 it = drecurse.recursive_dirlist([drecurse_top], opt.xdev,
                                 excluded_paths=excluded_paths,
-                                exclude_rxs=exclude_rxs)
+                                exclude_rxs=exclude_rxs, jobs=opt.jobs)
 if opt.profile:
     import cProfile
     def do_it():
@@ -2,6 +2,7 @@
 import os, re, stat, sys, time
 from collections import namedtuple
 from functools import partial
+from itertools import izip
 from bup import git, options, client, helpers, vfs
 from bup.helpers import add_error, debug1, handle_ctrl_c, log, saved_errors
 from bup.helpers import hostname, userfullname, username
@@ -25,6 +26,7 @@ v,verbose  increase log output (can be used more than once)
 q,quiet    don't show progress meter
 bwlimit=   maximum bytes/sec to transmit to server
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    number of objects to read from the source repository at once [1]
 """
 
 method_args = ('--ff', '--append', '--pick', '--force-pick',
@@ -115,14 +117,32 @@ def get_commit_items(id, cp):
     return parse_commit(commit_content)
 
 
-def walk_object(cat_pipe, id, verbose=None, parent_path=[], writer=None):
+def prefetch_blobs(cat_pipe, entries, writer):
+    # Generate the (type, data) of each of the tree entries that looks
+    # like a blob writer doesn't have yet, or None for the rest, while
+    # cat_pipe.get_many() reads the blobs ahead.
+    wanted = [not stat.S_ISDIR(mode) and not (writer and writer.exists(sha))
+              for (mode, name, sha) in entries]
+    items = cat_pipe.get_many(sha.encode('hex')
+                              for ((mode, name, sha), want)
+                              in izip(entries, wanted) if want)
+    for want in wanted:
+        yield next(items) if want else None
+
+
+def walk_object(cat_pipe, id, verbose=None, parent_path=[], writer=None,
+                item=None):
     # Yield everything reachable from id via cat_pipe, stopping
     # whenever we hit something writer already has.  Produce (id, type
     # data) for each item.  Since maybe_write() can't accept an
-    # iterator, join()ing the data here doesn't hurt anything.
-    item_it = cat_pipe.get(id)
-    type = item_it.next()
-    data = ''.join(item_it)
+    # iterator, join()ing the data here doesn't hurt anything.  If
+    # the object has already been read, item is its (type, data).
+    if item:
+        type, data = item
+    else:
+        item_it = cat_pipe.get(id)
+        type = item_it.next()
+        data = ''.join(item_it)
     id = git.calc_hash(type, data)
     if writer and writer.exists(id):
         return
@@ -140,10 +160,12 @@ def walk_object(cat_pipe, id, verbose=None, parent_path=[], writer=None):
                 yield x
     elif type == 'tree':
         yield (id, type, data)
-        for (mode, name, ent_id) in git.tree_decode(data):
+        entries = list(git.tree_decode(data))
+        items = prefetch_blobs(cat_pipe, entries, writer)
+        for (mode, name, ent_id), item in izip(entries, items):
             if not verbose > 1:
                 for x in walk_object(cat_pipe, ent_id.encode('hex'),
-                                     writer=writer):
+                                     writer=writer, item=item):
                     yield x
             else:
                 demangled, bup_type = git.demangle_name(name)
@@ -151,7 +173,7 @@ def walk_object(cat_pipe, id, verbose=None, parent_path=[], writer=None):
                 # Don't print the sub-parts of chunked files.
                 sub_v = verbose if bup_type == git.BUP_NORMAL else None
                 for x in walk_object(cat_pipe, ent_id.encode('hex'),
-                                     sub_v, sub_path, writer):
+                                     sub_v, sub_path, writer, item):
                     yield x
                 if stat.S_ISDIR(mode):
                     if verbose > 1 and bup_type == git.BUP_NORMAL:
@@ -553,6 +575,9 @@ o = options.Options(optspec)
 if len(extra):
     o.fatal('unexpected arguments: %s' % ' '.join(map(repr, extra)))
 
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
 target_specs = parse_target_args(flags, o.fatal)
 
 git.check_repo_or_die()
@@ -572,7 +597,7 @@ else:
     writer = git.PackWriter(compression_level=opt.compress)
 
 src_vfs = vfs.RefList(None, repo_dir=src_dir)
-src_cp = vfs.cp(src_dir)
+src_cp = git.ReaderPool(opt.jobs, repo_dir=src_dir)
 src_repo = LocalRepo(src_dir)
 
 # Resolve and validate all sources and destinations, implicit or
@@ -631,6 +656,7 @@ for item in target_items:
 
 
 writer.close()  # Must close before we can update the ref(s).
+src_cp.close()
 
 # Only update the refs at the very end, so that if something goes
 # wrong above, the old refs will be undisturbed.
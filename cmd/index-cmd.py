@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import sys, stat, time, os, errno, re
-from bup import metadata, options, git, index, drecurse, hlinkdb
+from bup import metadata, options, git, index, drecurse, hlinkdb, xstat
 from bup.helpers import *
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
 
@@ -19,30 +19,74 @@ class IterHelper:
         return self.cur
 
 
+class KnownHashes:
+    """The hashes of the files that were already indexed (and are still
+    valid), by identity (see index.stat_identity()), so that a path that
+    is new to the index because its file was renamed or moved, or is a
+    new hard link, doesn't have to be read again by save.
+
+    The table is only read from the index when the first new path turns
+    up, and since by then some entries may have been marked deleted
+    (which invalidates them), deleted() has to be told about each one
+    beforehand.
+    """
+    def __init__(self, reader, check_device):
+        self.reader = reader
+        self.check_device = check_device
+        self.hashes = None
+        self.deleted_hashes = {}
+
+    def deleted(self, ent):
+        if self.hashes is None and ent.is_valid() \
+                and not stat.S_ISDIR(ent.mode) \
+                and ent.gitmode and ent.sha != index.EMPTY_SHA:
+            key = ent.identity(self.check_device)
+            self.deleted_hashes[key] = (ent.gitmode, ent.sha)
+
+    def get(self, st, tstart):
+        """Return the (gitmode, sha) of the file st describes, or None."""
+        key = index.stat_identity(st, self.check_device)
+        # As in from_stat(), the file might still be changing.
+        if not key or xstat.fstime_floor_secs(st.st_ctime) * 10**9 >= tstart:
+            return None
+        if self.hashes is None:
+            self.hashes = self.reader.hashes_by_identity(self.check_device)
+            self.hashes.update(self.deleted_hashes)
+            self.deleted_hashes = None
+        return self.hashes.get(key)
+
+
 def check_index(reader):
     try:
         log('check: checking forward iteration...\n')
         e = None
         d = {}
-        for e in reader.forward_iter():
-            if e.children_n:
+        for e in reader.columns('basename', 'children_ofs', 'children_n',
+                                'flags', 'sha', 'gitmode'):
+            (name, children_ofs, children_n, flags, sha, gitmode) = e
+            if children_n:
                 if opt.verbose:
-                    log('%08x+%-4d %r\n' % (e.children_ofs, e.children_n,
-                                            e.name))
-                assert(e.children_ofs)
-                assert(e.name.endswith('/'))
-                assert(not d.get(e.children_ofs))
-                d[e.children_ofs] = 1
-            if e.flags & index.IX_HASHVALID:
-                assert(e.sha != index.EMPTY_SHA)
-                assert(e.gitmode)
-        assert(not e or e.name == '/')  # last entry is *always* /
+                    log('%08x+%-4d %r\n' % (children_ofs, children_n, name))
+                assert(children_ofs)
+                assert(name.endswith('/'))
+                assert(not d.get(children_ofs))
+                d[children_ofs] = 1
+            if flags & index.IX_HASHVALID:
+                assert(sha != index.EMPTY_SHA)
+                assert(gitmode)
+        assert(not e or e[0] == '/')  # last entry is *always* /
         log('check: checking normal iteration...\n')
         last = None
         for e in reader:
             if last:
                 assert(last > e.name)
             last = e.name
+        log('check: checking lookups...\n')
+        for e in reader:
+            found = reader.find(e.name)
+            assert(found)
+            assert(found.name == e.name)
+            assert(found.packed() == e.packed())
     except:
         log('index error! at %r\n' % e)
         raise
@@ -50,7 +94,8 @@ def check_index(reader):
 
 
 def clear_index(indexfile):
-    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.hlink']
+    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.meta.hash',
+                  indexfile + '.hlink', indexfile + '.paths']
     for indexfile in indexfiles:
         path = git.repo(indexfile)
         try:
@@ -62,6 +107,29 @@ def clear_index(indexfile):
                 raise
 
 
+def compact_meta(indexfile, auto=False):
+    meta_filename = indexfile + '.meta'
+    if not os.path.exists(meta_filename):
+        return
+    if auto:
+        if os.path.getsize(meta_filename) < index.meta_compact_min_size:
+            return
+        usage = index.meta_usage(indexfile)
+        if not usage or usage[0] >= usage[1] * index.meta_compact_ratio:
+            return
+        debug1('index: %d of %d metadata records in use, compacting\n'
+               % usage)
+    # Anyone else using the index (e.g. bup save) holds its lock too.
+    if not index_lock.acquire(exclusive=True, wait=not auto):
+        debug1('index: %s is in use, not compacting\n' % indexfile)
+        index_lock.acquire()
+        return
+    (old_size, new_size) = index.compact_meta(indexfile)
+    index_lock.acquire()
+    if opt.verbose or not auto:
+        log('compact-meta: %d -> %d bytes\n' % (old_size, new_size))
+
+
 def update_index(top, excluded_paths, exclude_rxs):
     # tmax and start must be epoch nanoseconds.
     tmax = (time.time() - 1) * 10**9
@@ -77,6 +145,7 @@ def update_index(top, excluded_paths, exclude_rxs):
     if opt.fake_valid:
         def hashgen(name):
             return (GIT_MODE_FILE, index.FAKE_SHA)
+    known = KnownHashes(ri, opt.check_device)
 
     total = 0
     bup_dir = os.path.abspath(git.repo())
@@ -84,7 +153,8 @@ def update_index(top, excluded_paths, exclude_rxs):
     for (path,pst) in drecurse.recursive_dirlist([top], xdev=opt.xdev,
                                                  bup_dir=bup_dir,
                                                  excluded_paths=excluded_paths,
-                                                 exclude_rxs=exclude_rxs):
+                                                 exclude_rxs=exclude_rxs,
+                                                 jobs=opt.jobs):
         if opt.verbose>=2 or (opt.verbose==1 and stat.S_ISDIR(pst.st_mode)):
             sys.stdout.write('%s\n' % path)
             sys.stdout.flush()
@@ -98,6 +168,7 @@ def update_index(top, excluded_paths, exclude_rxs):
         total += 1
         while rig.cur and rig.cur.name > path:  # deleted paths
             if rig.cur.exists():
+                known.deleted(rig.cur)
                 rig.cur.set_deleted()
                 rig.cur.repack()
                 if rig.cur.nlink > 1 and not stat.S_ISDIR(rig.cur.mode):
@@ -147,7 +218,12 @@ def update_index(top, excluded_paths, exclude_rxs):
             # See same assignment to 0, above, for rationale.
             meta.atime = meta.mtime = meta.ctime = 0
             meta_ofs = msw.store(meta)
-            wi.add(path, pst, meta_ofs, hashgen = hashgen)
+            new_hashgen = hashgen
+            if not (hashgen or opt.fake_invalid):
+                known_hash = known.get(pst, tstart)
+                if known_hash:
+                    new_hashgen = lambda name: known_hash
+            wi.add(path, pst, meta_ofs, hashgen = new_hashgen)
             if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
                 hlinks.add_path(path, pst.st_dev, pst.st_ino)
 
@@ -167,14 +243,7 @@ def update_index(top, excluded_paths, exclude_rxs):
                 check_index(ri)
                 log('check: before merging: newfile\n')
                 check_index(wr)
-            mi = index.Writer(indexfile, msw, tmax)
-
-            for e in index.merge(ri, wr):
-                # FIXME: shouldn't we remove deleted entries eventually?  When?
-                mi.add_ixentry(e)
-
-            ri.close()
-            mi.close()
+            index.add_entries(ri, wr, msw, tmax)
             wr.close()
         wi.abort()
     else:
@@ -194,6 +263,7 @@ s,status   print each filename with a status char (A/M/D) (implies -p)
 u,update   recursively update the index entries for the given file/dir names (default if no mode is specified)
 check      carefully check index file integrity
 clear      clear the default index
+compact-meta  drop unused records from the index's metadata store
  Options:
 H,hash     print the hash for each object next to its name
 l,long     print more information about each file
@@ -207,6 +277,7 @@ exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 v,verbose  increase log output (can be used more than once)
 x,xdev,one-file-system  don't cross filesystem boundaries
+j,jobs=    number of directories to read at once [1]
 """
 
 is_reverse = os.environ.get('BUP_SERVER_REVERSE')
@@ -223,7 +294,8 @@ if not (opt.modified or \
         opt.status or \
         opt.update or \
         opt.check or \
-        opt.clear):
+        opt.clear or \
+        opt.compact_meta):
     opt.update = 1
 if (opt.fake_valid or opt.fake_invalid) and not opt.update:
     o.fatal('--fake-{in,}valid are meaningless without -u')
@@ -231,6 +303,8 @@ if opt.fake_valid and opt.fake_invalid:
     o.fatal('--fake-valid is incompatible with --fake-invalid')
 if opt.clear and opt.indexfile:
     o.fatal('cannot clear an external index (via -f)')
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 # FIXME: remove this once we account for timestamp races, i.e. index;
 # touch new-file; index.  It's possible for this to happen quickly
@@ -241,6 +315,8 @@ time.sleep(1 - (tick_start - int(tick_start)))
 
 git.check_repo_or_die()
 indexfile = opt.indexfile or git.repo('bupindex')
+index_lock = index.Lock(indexfile)
+index_lock.acquire()
 
 handle_ctrl_c()
 
@@ -252,7 +328,7 @@ if opt.clear:
     log('clear: clearing index.\n')
     clear_index(indexfile)
 
-excluded_paths = parse_excludes(flags, o.fatal)
+excluded_paths = ExcludedPaths(parse_excludes(flags, o.fatal))
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 paths = index.reduce_paths(extra)
 
@@ -262,6 +338,11 @@ if opt.update:
     for (rp,path) in paths:
         update_index(rp, excluded_paths, exclude_rxs)
 
+if opt.compact_meta:
+    compact_meta(indexfile)
+elif opt.update:
+    compact_meta(indexfile, auto=True)
+
 if opt['print'] or opt.status or opt.modified:
     for (name, ent) in index.Reader(indexfile).filter(extra or ['']):
         if (opt.modified 
@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 import sys
 
-from bup import git, options, client
+from bup import git, options, client, hashsplit
 from bup.helpers import *
 
 
 optspec = """
-[BUP_DIR=...] bup init [-r host:path]
+[BUP_DIR=...] bup init [-r host:path] [--chunker=name [--chunk-sizes=min,avg,max]]
 --
 r,remote=  remote repository path
+chunker=   record the chunker the repository's data is split with (rollsum or gear)
+chunk-sizes=  the min,avg,max chunk sizes for --chunker=gear
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -16,9 +18,30 @@ o = options.Options(optspec)
 if extra:
     o.fatal("no arguments expected")
 
+config = []
+if opt.chunker or opt.chunk_sizes:
+    if opt.remote:
+        o.fatal('--chunker is only recorded in the local repository;'
+                ' run bup init --chunker on the server instead')
+    settings = {'bup.chunker': opt.chunker or 'gear'}
+    if opt.chunk_sizes:
+        if settings['bup.chunker'] != 'gear':
+            o.fatal('--chunk-sizes requires --chunker=gear')
+        sizes = opt.chunk_sizes.split(',')
+        if len(sizes) != 3:
+            o.fatal('--chunk-sizes must be of the form min,avg,max')
+        settings['bup.chunkMinSize'] = sizes[0]
+        settings['bup.chunkAvgSize'] = sizes[1]
+        settings['bup.chunkMaxSize'] = sizes[2]
+    try:
+        config = hashsplit.chunker_from_config(settings.get).config()
+    except ValueError, e:
+        o.fatal(str(e))
 
 try:
     git.init_repo()  # local repo
+    for name, value in config:
+        git.git_config_set(name, value)
 except git.GitError, e:
     log("bup: error: could not init repository: %s" % e)
     sys.exit(1)
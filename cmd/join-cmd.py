@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys
+import stat, sys
 from bup import git, options, client
 from bup.helpers import *
 
@@ -9,10 +9,15 @@ bup join [-r host:path] [refs or hashes...]
 --
 r,remote=  remote repository path
 o=         output filename
+j,jobs=    number of objects to read at once [1]
+sparse     leave holes where the data is all zeros (output must be a file)
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
 
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
 git.check_repo_or_die()
 
 if not extra:
@@ -24,7 +29,7 @@ if opt.remote:
     cli = client.Client(opt.remote)
     cat = cli.cat
 else:
-    cp = git.CatPipe()
+    cp = git.ReaderPool(opt.jobs)
     cat = cp.join
 
 if opt.o:
@@ -32,10 +37,16 @@ if opt.o:
 else:
     outfile = sys.stdout
 
+if opt.sparse and not stat.S_ISREG(os.fstat(outfile.fileno()).st_mode):
+    o.fatal('--sparse requires the output to be a regular file')
+
 for id in extra:
     try:
-        for blob in cat(id):
-            outfile.write(blob)
+        if opt.sparse:
+            write_sparsely(outfile, cat(id))
+        else:
+            for blob in cat(id):
+                outfile.write(blob)
     except KeyError, e:
         outfile.flush()
         log('error: %s\n' % e)
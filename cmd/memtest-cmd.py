@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys, re, struct, time, resource
+import sys, re, struct, time, resource, glob, tempfile
 from bup import git, bloom, midx, options, _helpers
 from bup.helpers import *
 
@@ -58,6 +58,49 @@ def report(count):
     last = time.time()
 
 
+def compare_blooms(count):
+    """Build v2 and v3 bloom filters for the repository and look up the
+    same `count` random objects in each, reporting steps and page faults
+    per lookup."""
+    idxs = [git.open_idx(n) for n in glob.glob(git.repo('objects/pack/*.idx'))]
+    total = sum(len(ix) for ix in idxs)
+    if not total:
+        log('memtest: no objects in repository, skipping bloom comparison\n')
+        return
+    shas = [_helpers.random_sha() for n in xrange(count)]
+    tmpdir = tempfile.mkdtemp(prefix='bup-memtest-')
+    try:
+        print
+        print '%9s  %10s %10s %10s %10s' % ('bloom', 'steps/obj', 'faults/obj',
+                                           'MajFlt', 'ms')
+        for version in bloom.SUPPORTED_VERSIONS:
+            name = os.path.join(tmpdir, 'v%d.bloom' % version)
+            b = bloom.create(name, expected=total, version=version)
+            for ix in idxs:
+                b.add_idx(ix)
+            b.close()
+            # Reopen it, so the new mapping starts with no pages faulted in.
+            b = bloom.ShaBloom(name)
+            searches, steps = bloom._total_searches, bloom._total_steps
+            ru = resource.getrusage(resource.RUSAGE_SELF)
+            t = time.time()
+            for sha in shas:
+                b.exists(sha)
+            ms = int((time.time() - t) * 1000)
+            ru2 = resource.getrusage(resource.RUSAGE_SELF)
+            faults = (ru2.ru_minflt - ru.ru_minflt
+                      + ru2.ru_majflt - ru.ru_majflt)
+            print '%9s  %10.3f %10.3f %10d %10d' \
+                % ('v%d' % version,
+                   (bloom._total_steps - steps) * 1.0 / count,
+                   faults * 1.0 / count,
+                   ru2.ru_majflt - ru.ru_majflt, ms)
+            b.close()
+            bloom._total_searches, bloom._total_steps = searches, steps
+    finally:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 optspec = """
 bup memtest [-n elements] [-c cycles]
 --
@@ -65,6 +108,7 @@ n,number=  number of objects per cycle [10000]
 c,cycles=  number of cycles to run [100]
 ignore-midx  ignore .midx files, use only .idx files
 existing   test with existing objects instead of fake ones
+bloom      compare lookups in v2 and v3 bloom filters built from the repository
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -103,6 +147,20 @@ for c in xrange(opt.cycles):
             assert(not m.exists(bin))
     report((c+1)*opt.number)
 
+print 'exists_many(), %d objects per call:' % opt.number
+report(0)
+for c in xrange(opt.cycles):
+    if opt.existing:
+        bins = [objit.next() for n in xrange(opt.number)]
+        assert(all(m.exists_many(bins)))
+    else:
+        bins = [_helpers.random_sha() for n in xrange(opt.number)]
+        assert(not any(m.exists_many(bins)))
+    report((c+1)*opt.number)
+
+if opt.bloom:
+    compare_blooms(opt.number * opt.cycles)
+
 if bloom._total_searches:
     print ('bloom: %d objects searched in %d steps: avg %.3f steps/object' 
            % (bloom._total_searches, bloom._total_steps,
@@ -16,6 +16,8 @@ map-group=  given OLD=NEW, restore OLD group as NEW group
 map-uid=    given OLD=NEW, restore OLD uid as NEW uid
 map-gid=    given OLD=NEW, restore OLD gid as NEW gid
 q,quiet     don't show progress meter
+j,jobs=     number of files (and objects of each) to read at once [1]
+sparse      leave holes where files' contents are all zeros
 """
 
 total_restored = 0
@@ -158,12 +160,47 @@ def hardlink_if_possible(fullname, node, meta):
 def write_file_content(fullname, n):
     outf = open(fullname, 'wb')
     try:
-        for b in chunkyreader(n.open()):
-            outf.write(b)
+        if readers:
+            it = readers.join(n.hash.encode('hex'))
+        else:
+            it = chunkyreader(n.open())
+        if opt.sparse:
+            write_sparsely(outf, it)
+        else:
+            for b in it:
+                outf.write(b)
     finally:
         outf.close()
 
 
+def restore_file(job):
+    (fullname, n, meta) = job
+    write_file_content(fullname, n)
+    return job
+
+
+# do_root() and do_node() create everything but the regular files'
+# contents as they go, and generate a (fullname, node, meta) job for each
+# file to fill in, which restore() hands to the pool (if any), and then
+# applies each file's metadata once its content has been written.  The
+# directories' metadata (e.g. permissions that might prevent writing the
+# files, or times that writing them would change) is applied last,
+# children first.
+dir_metadata = []
+
+def restore(jobs):
+    if pool:
+        done = pool.imap(restore_file, jobs)
+    else:
+        done = (restore_file(job) for job in jobs)
+    for (fullname, n, meta) in done:
+        if meta:
+            apply_metadata(meta, fullname, opt.numeric_ids, owner_map)
+    for (meta, fullname) in dir_metadata:
+        apply_metadata(meta, fullname, opt.numeric_ids, owner_map)
+    del dir_metadata[:]
+
+
 def find_dir_item_metadata_by_name(dir, name):
     """Find metadata in dir (a node) for an item with the given name,
     or for the directory itself if the name is ''."""
@@ -211,9 +248,10 @@ def do_root(n, owner_map, restore_root_meta = True):
             # Don't get metadata if this is a dir -- handled in sub do_node().
             if meta_stream and not stat.S_ISDIR(sub.mode):
                 m = metadata.Metadata.read(meta_stream)
-            do_node(n, sub, owner_map, meta = m)
+            for job in do_node(n, sub, owner_map, meta = m):
+                yield job
         if root_meta and restore_root_meta:
-            apply_metadata(root_meta, '.', opt.numeric_ids, owner_map)
+            dir_metadata.append((root_meta, '.'))
     finally:
         if meta_stream:
             meta_stream.close()
@@ -247,13 +285,12 @@ def do_node(top, n, owner_map, meta = None):
         if meta and meta.hardlink_target:
             created_hardlink = hardlink_if_possible(fullname, n, meta)
 
+        is_file = False
         if not created_hardlink:
             create_path(n, fullname, meta)
-            if meta:
-                if stat.S_ISREG(meta.mode):
-                    write_file_content(fullname, n)
-            elif stat.S_ISREG(n.mode):
-                write_file_content(fullname, n)
+            is_file = stat.S_ISREG(meta.mode if meta else n.mode)
+            if is_file:
+                yield (fullname, n, meta)
 
         total_restored += 1
         plog('Restoring: %d\r' % total_restored)
@@ -262,9 +299,13 @@ def do_node(top, n, owner_map, meta = None):
             # Don't get metadata if this is a dir -- handled in sub do_node().
             if meta_stream and not stat.S_ISDIR(sub.mode):
                 m = metadata.Metadata.read(meta_stream)
-            do_node(top, sub, owner_map, meta = m)
-        if meta and not created_hardlink:
-            apply_metadata(meta, fullname, opt.numeric_ids, owner_map)
+            for job in do_node(top, sub, owner_map, meta = m):
+                yield job
+        if meta and not created_hardlink and not is_file:
+            if stat.S_ISDIR(n.mode):
+                dir_metadata.append((meta, fullname))
+            else:
+                apply_metadata(meta, fullname, opt.numeric_ids, owner_map)
     finally:
         if meta_stream:
             meta_stream.close()
@@ -276,8 +317,13 @@ handle_ctrl_c()
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
 
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+
 git.check_repo_or_die()
 top = vfs.RefList(None)
+readers = git.ReaderPool(opt.jobs) if opt.jobs > 1 else None
+pool = WorkerPool(opt.jobs) if opt.jobs > 1 else None
 
 if not extra:
     o.fatal('must specify at least one filename to restore')
@@ -312,7 +358,7 @@ for d in extra:
         if not isdir:
             add_error('%r: not a directory' % d)
         else:
-            do_root(n, owner_map, restore_root_meta = (name == '.'))
+            restore(do_root(n, owner_map, restore_root_meta = (name == '.')))
     else:
         # Source is /foo/what/ever -- extract ./ever to cwd.
         if isinstance(n, vfs.FakeSymlink):
@@ -323,10 +369,15 @@ for d in extra:
             target = n.dereference()
             mkdirp(n.name)
             os.chdir(n.name)
-            do_root(target, owner_map)
+            restore(do_root(target, owner_map))
         else: # Not a directory or fake symlink.
             meta = find_dir_item_metadata_by_name(n.parent, n.name)
-            do_node(n.parent, n, owner_map, meta = meta)
+            restore(do_node(n.parent, n, owner_map, meta = meta))
+
+if pool:
+    pool.close()
+if readers:
+    readers.close()
 
 if not opt.quiet:
     progress('Restoring: %d, done.\n' % total_restored)
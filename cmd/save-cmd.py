@@ -25,6 +25,9 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    number of threads to hash and compress file contents with [1]
+adaptive-compress  store file data that doesn't compress well uncompressed
+detect-appends  only split the new data of files that have grown
 """
 
 is_reverse = os.environ.get('BUP_SERVER_REVERSE')
@@ -46,6 +49,8 @@ opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
@@ -75,6 +80,8 @@ if opt.graft:
 
 if is_reverse and opt.remote:
     o.fatal("don't use -r in reverse mode; it's automatic")
+if opt.detect_appends and (opt.remote or is_reverse):
+    o.fatal('--detect-appends only works with a local repository')
 
 if opt.name and opt.name.startswith('.'):
     o.fatal("'%s' is not a valid branch name" % opt.name)
@@ -82,11 +89,22 @@ refname = opt.name and 'refs/heads/%s' % opt.name or None
 if opt.remote or is_reverse:
     cli = client.Client(opt.remote)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    config_get = cli.config_get
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    config_get = git.git_config_get
+try:
+    hashsplit.chunker = hashsplit.chunker_from_config(config_get)
+except ValueError, e:
+    log('error: %s\n' % e)
+    sys.exit(1)
+if cli:
+    w = cli.new_packwriter(compression_level=opt.compress, jobs=opt.jobs,
+                           adaptive_compression=opt.adaptive_compress)
+else:
+    w = git.PackWriter(compression_level=opt.compress, jobs=opt.jobs,
+                       adaptive_compression=opt.adaptive_compress)
 
 handle_ctrl_c()
 
@@ -192,6 +210,8 @@ def progress_report(n):
 
 
 indexfile = opt.indexfile or git.repo('bupindex')
+index_lock = index.Lock(indexfile)
+index_lock.acquire()
 r = index.Reader(indexfile)
 try:
     msr = index.MetaStoreReader(indexfile + '.meta')
@@ -211,6 +231,38 @@ def wantrecurse_pre(ent):
 def wantrecurse_during(ent):
     return not already_saved(ent) or ent.sha_missing()
 
+def read_chunk_tree(sha):
+    it = git.cp().get(sha.encode('hex'))
+    type = it.next()
+    if type != 'tree':
+        raise git.GitError('%s: expected tree, got %s'
+                           % (sha.encode('hex'), type))
+    return [(mode, int(name, 16), id)
+            for (mode, name, id) in git.tree_decode(''.join(it))]
+
+def read_chunk(sha):
+    it = git.cp().get(sha.encode('hex'))
+    it.next()
+    return ''.join(it)
+
+def resume_split(ent, f):
+    # Returns the split state to continue from if ent's file has only
+    # been appended to since it was saved, or None.
+    if not (opt.detect_appends and ent.gitmode == GIT_MODE_TREE
+            and ent.sha != index.EMPTY_SHA and w.exists(ent.sha)):
+        return None
+    try:
+        stacks = hashsplit.resume_split(read_chunk_tree, read_chunk,
+                                        w.new_tree, ent.sha, f)
+    except (KeyError, git.GitError), e:
+        debug1('%s: not resuming split: %s\n' % (ent.name, e))
+        stacks = None
+    if stacks:
+        debug1('%s: resuming split at %d\n' % (ent.name, f.tell()))
+    else:
+        f.seek(0)
+    return stacks
+
 def find_hardlink_target(hlink_db, ent):
     if hlink_db and not stat.S_ISDIR(ent.mode) and ent.nlink > 1:
         link_paths = hlink_db.node_paths(ent.dev, ent.ino)
@@ -375,10 +427,14 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
                 add_error(e)
                 lastskip_name = ent.name
             else:
+                w.start_file(ent.name)
                 try:
+                    stacks = resume_split(ent, f)
                     (mode, id) = hashsplit.split_to_blob_or_tree(
                                             w.new_blob, w.new_tree, [f],
-                                            keep_boundaries=False)
+                                            keep_boundaries=False,
+                                            makeblobs=w.new_blobs,
+                                            stacks=stacks)
                 except (IOError, OSError), e:
                     add_error('%s: %s' % (ent.name, e))
                     lastskip_name = ent.name
@@ -448,6 +504,8 @@ if opt.commit or opt.name:
 
 msr.close()
 w.close()  # must close before we can update the ref
+if w.adaptive and opt.verbose:
+    log('Adaptive compression: %s.\n' % w.adaptive.summary())
 
 if opt.name:
     if cli:
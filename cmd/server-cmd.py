@@ -63,6 +63,33 @@ def send_index(conn, name):
     conn.ok()
 
 
+def _receive_batch(conn, w, batch, suggested):
+    # Write the objects in batch, unless the repository already has them,
+    # in which case suggest the index that does instead.  Looking them all
+    # up at once is much faster than one at a time.
+    if dumb_server_mode:
+        found = [None] * len(batch)
+    else:
+        found = w.exists_many([shar for (shar, crcr, buf) in batch],
+                              want_source=True)
+    for (shar, crcr, buf), oldpack in zip(batch, found):
+        if oldpack:
+            assert(not oldpack == True)
+            assert(oldpack.endswith('.idx'))
+            (dir,name) = os.path.split(oldpack)
+            if not (name in suggested):
+                debug1("bup server: suggesting index %s\n"
+                       % git.shorten_hash(name))
+                debug1("bup server:   because of object %s\n"
+                       % shar.encode('hex'))
+                conn.write('index %s\n' % name)
+                suggested.add(name)
+            continue
+        nw, crc = w._raw_write((buf,), sha=shar)
+        _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
+    del batch[:]
+
+
 def receive_objects_v2(conn, junk):
     global suspended_w
     _init_session()
@@ -75,6 +102,8 @@ def receive_objects_v2(conn, junk):
             w = git.PackWriter(objcache_maker=None)
         else:
             w = git.PackWriter()
+    batch = []
+    batch_bytes = 0
     while 1:
         ns = conn.read(4)
         if not ns:
@@ -82,6 +111,8 @@ def receive_objects_v2(conn, junk):
             raise Exception('object read: expected length header, got EOF\n')
         n = struct.unpack('!I', ns)[0]
         #debug2('expecting %d bytes\n' % n)
+        if not n or n == 0xffffffff:
+            _receive_batch(conn, w, batch, suggested)
         if not n:
             debug1('bup server: received %d object%s.\n' 
                 % (w.count, w.count!=1 and "s" or ''))
@@ -103,22 +134,15 @@ def receive_objects_v2(conn, junk):
         buf = conn.read(n)  # object sizes in bup are reasonably small
         #debug2('read %d bytes\n' % n)
         _check(w, n, len(buf), 'object read: expected %d bytes, got %d\n')
-        if not dumb_server_mode:
-            oldpack = w.exists(shar, want_source=True)
-            if oldpack:
-                assert(not oldpack == True)
-                assert(oldpack.endswith('.idx'))
-                (dir,name) = os.path.split(oldpack)
-                if not (name in suggested):
-                    debug1("bup server: suggesting index %s\n"
-                           % git.shorten_hash(name))
-                    debug1("bup server:   because of object %s\n"
-                           % shar.encode('hex'))
-                    conn.write('index %s\n' % name)
-                    suggested.add(name)
-                continue
-        nw, crc = w._raw_write((buf,), sha=shar)
-        _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
+        batch.append((shar, crcr, buf))
+        batch_bytes += n
+        # Don't hold on to the objects (and any index suggestions) while
+        # the client is waiting for something.
+        if len(batch) >= git.exists_batch \
+           or batch_bytes >= git.exists_batch_bytes \
+           or not conn.has_input():
+            _receive_batch(conn, w, batch, suggested)
+            batch_bytes = 0
     # NOTREACHED
     
 
@@ -135,6 +159,13 @@ def read_ref(conn, refname):
     conn.ok()
 
 
+def config_get(conn, option):
+    _init_session()
+    r = git.git_config_get(option.strip())
+    conn.write('%s\n' % (r or '').encode('hex'))
+    conn.ok()
+
+
 def path_info(conn, junk):
     _init_session()
     n = vint.read_vuint(conn)
@@ -165,7 +196,7 @@ def cat(conn, id):
     global cat_pipe
     _init_session()
     if not cat_pipe:
-        cat_pipe = git.CatPipe()
+        cat_pipe = git.PackReader()
     try:
         for blob in cat_pipe.join(id):
             conn.write(struct.pack('!I', len(blob)))
@@ -199,6 +230,7 @@ commands = {
     'send-index': send_index,
     'receive-objects-v2': receive_objects_v2,
     'read-ref': read_ref,
+    'config-get': config_get,
     'path-info' : path_info,
     'update-ref': update_ref,
     'cat': cat,
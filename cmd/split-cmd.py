@@ -29,6 +29,8 @@ max-pack-objects=  maximum number of objects in a single pack
 fanout=    average number of blobs in a single tree
 bwlimit=   maximum bytes/sec to transmit to server
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    number of threads to hash and compress with [1]
+adaptive-compress  store data that doesn't compress well uncompressed
 """
 
 is_reverse = os.environ.get('BUP_SERVER_REVERSE')
@@ -66,6 +68,8 @@ if opt.blobs:
     hashsplit.fanout = 0
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
 else:
@@ -90,14 +94,28 @@ if opt.name and opt.name.startswith('.'):
 refname = opt.name and 'refs/heads/%s' % opt.name or None
 if opt.noop or opt.copy:
     cli = pack_writer = oldref = None
+    config_get = git.git_config_get
 elif opt.remote or is_reverse:
     cli = client.Client(opt.remote)
     oldref = refname and cli.read_ref(refname) or None
-    pack_writer = cli.new_packwriter(compression_level=opt.compress)
+    config_get = cli.config_get
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    pack_writer = git.PackWriter(compression_level=opt.compress)
+    config_get = git.git_config_get
+try:
+    hashsplit.chunker = hashsplit.chunker_from_config(config_get)
+except ValueError, e:
+    log('error: %s\n' % e)
+    sys.exit(1)
+if cli:
+    pack_writer = cli.new_packwriter(compression_level=opt.compress,
+                                     jobs=opt.jobs,
+                                     adaptive_compression=opt.adaptive_compress)
+elif not (opt.noop or opt.copy):
+    pack_writer = git.PackWriter(compression_level=opt.compress,
+                                 jobs=opt.jobs,
+                                 adaptive_compression=opt.adaptive_compress)
 
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
@@ -108,7 +126,7 @@ if opt.git_ids:
     # It would be less ugly if either CatPipe.get() returned a file-like object
     # (not very efficient), or split_to_shalist() expected an iterator instead
     # of a file.
-    cp = git.CatPipe()
+    cp = git.PackReader()
     class IterToFile:
         def __init__(self, it):
             self.it = iter(it)
@@ -137,7 +155,8 @@ else:
 if pack_writer and opt.blobs:
     shalist = hashsplit.split_to_blobs(pack_writer.new_blob, files,
                                        keep_boundaries=opt.keep_boundaries,
-                                       progress=prog)
+                                       progress=prog,
+                                       makeblobs=pack_writer.new_blobs)
     for (sha, size, level) in shalist:
         print sha.encode('hex')
         reprogress()
@@ -148,13 +167,15 @@ elif pack_writer:  # tree or commit or name
                                             pack_writer.new_tree,
                                             files,
                                             keep_boundaries=opt.keep_boundaries,
-                                            progress=prog)
+                                            progress=prog,
+                                            makeblobs=pack_writer.new_blobs)
         splitfile_name = git.mangle_name('data', hashsplit.GIT_MODE_FILE, mode)
         shalist = [(mode, splitfile_name, sha)]
     else:
         shalist = hashsplit.split_to_shalist(
                       pack_writer.new_blob, pack_writer.new_tree, files,
-                      keep_boundaries=opt.keep_boundaries, progress=prog)
+                      keep_boundaries=opt.keep_boundaries, progress=prog,
+                      makeblobs=pack_writer.new_blobs)
     tree = pack_writer.new_tree(shalist)
 else:
     last = 0
@@ -199,6 +220,8 @@ size = hashsplit.total_split
 if opt.bench:
     log('bup: %.2fkbytes in %.2f secs = %.2f kbytes/sec\n'
         % (size/1024., secs, size/1024./secs))
+    if pack_writer and pack_writer.adaptive:
+        log('bup: adaptive compression: %s\n' % pack_writer.adaptive.summary())
 
 if saved_errors:
     log('WARNING: %d errors encountered while saving.\n' % len(saved_errors))
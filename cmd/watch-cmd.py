@@ -93,13 +93,16 @@ def kill_daemon(restart=False):
         else:
             sys.exit(err)
 
+_lock = None
 _ri = None
 _msw = None
 _wi = None
 _hlinks = None
 
 def setup_globals(tmax):
-    global _ri, _msw, _wi, _hlinks
+    global _lock, _ri, _msw, _wi, _hlinks
+    _lock = index.Lock(indexfile)
+    _lock.acquire()
     _ri = index.Reader(indexfile)
     _msw = index.MetaStoreWriter(indexfile+'.meta')
     _wi = index.Writer(indexfile, _msw, tmax)
@@ -115,14 +118,7 @@ def save_index(tmax):
         _wi.flush()
         if _wi.count:
             wr = _wi.new_reader()
-            mi = index.Writer(indexfile, _msw, tmax)
-
-            for e in index.merge(_ri, wr):
-                # FIXME: shouldn't we remove deleted entries eventually?  When?
-                mi.add_ixentry(e)
-
-            _ri.close()
-            mi.close()
+            index.add_entries(_ri, wr, _msw, tmax)
             wr.close()
         _wi.abort()
     else:
@@ -130,12 +126,10 @@ def save_index(tmax):
 
     _msw.close()
     _hlinks.commit_save()
+    _lock.close()
 
 def get_current(path):
-    try:
-        return next(iter(_ri.iter(name=path)))
-    except StopIteration:
-        return None
+    return _ri.find(path)
 
 def remove_path_from_index(path):
     if opt.verbose >= 2:
@@ -440,7 +434,7 @@ if opt.detach:
 if not extra:
     o.fatal('watch requested but no paths given')
 
-excluded_paths = parse_excludes(flags, o.fatal)
+excluded_paths = ExcludedPaths(parse_excludes(flags, o.fatal))
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 paths = index.reduce_paths(extra)
 
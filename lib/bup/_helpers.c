@@ -8,6 +8,7 @@
 #include <Python.h>
 
 #include <assert.h>
+#include <dirent.h>
 #include <errno.h>
 #include <fcntl.h>
 #include <arpa/inet.h>
@@ -34,6 +35,7 @@
 #endif
 
 #include "bupsplit.h"
+#include "gearsplit.h"
 
 #if defined(FS_IOC_GETFLAGS) && defined(FS_IOC_SETFLAGS)
 #define BUP_HAVE_FILE_ATTRS 1
@@ -47,6 +49,11 @@
 #undef HAVE_UTIMENSAT
 #endif
 
+#if defined(HAVE_OPENAT) && defined(HAVE_FSTATAT) && defined(HAVE_FDOPENDIR) \
+    && defined(AT_FDCWD) && defined(AT_SYMLINK_NOFOLLOW) && defined(O_DIRECTORY)
+#define BUP_HAVE_DIR_FDS 1
+#endif
+
 #ifndef FS_NOCOW_FL
 // Of course, this assumes it's a bitfield value.
 #define FS_NOCOW_FL 0
@@ -232,12 +239,141 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "t#", &buf, &len))
 	return NULL;
     assert(len <= INT_MAX);
+    Py_BEGIN_ALLOW_THREADS;
     out = bupsplit_find_ofs(buf, len, &bits);
+    Py_END_ALLOW_THREADS;
     if (out) assert(bits >= BUP_BLOBBITS);
     return Py_BuildValue("ii", out, bits);
 }
 
 
+// The chunk finders that find_splits() can use: each returns the length
+// of the first chunk in buf (or 0 if it doesn't end in buf), with bits
+// set to 0 if the chunk was cut short.
+typedef int (*find_ofs_fn)(const unsigned char *buf, int len,
+			   const int *params, int *bits);
+
+
+// params: max_blob
+static int rollsum_find_ofs(const unsigned char *buf, int len,
+			    const int *params, int *bits)
+{
+    int ofs = bupsplit_find_ofs(buf, len, bits);
+    if (!ofs)
+	return 0;
+    assert(*bits >= BUP_BLOBBITS);
+    if (ofs > params[0])
+    {
+	ofs = params[0];
+	*bits = 0;
+    }
+    return ofs;
+}
+
+
+// params: min_size, avg_bits, max_size
+static int gear_find_ofs(const unsigned char *buf, int len,
+			 const int *params, int *bits)
+{
+    return gearsplit_find_ofs(buf, len, params[0], params[1], params[2], bits);
+}
+
+
+// Returns a string of native uint32_t (end offset, bits) pairs, one
+// for each chunk boundary that repeated find() calls find in buf.
+static PyObject *find_splits(const unsigned char *buf, Py_ssize_t len,
+			     find_ofs_fn find, const int *params,
+			     int typical_bits)
+{
+    Py_ssize_t pos = 0;
+    int nsplits = 0, maxsplits, nomem = 0;
+    uint32_t *splits;
+    PyObject *result;
+
+    assert(len <= INT_MAX);
+    // Enough for chunks of the typical size; grown below if not.
+    maxsplits = (len >> (typical_bits - 1)) + 16;
+    splits = malloc(maxsplits * 2 * sizeof(uint32_t));
+    if (!splits)
+	return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS;
+    while (pos < len)
+    {
+	int bits = -1;
+	int ofs = find(buf + pos, len - pos, params, &bits);
+	if (!ofs)
+	    break;
+	if (nsplits == maxsplits)
+	{
+	    uint32_t *more = realloc(splits,
+				     maxsplits * 4 * sizeof(uint32_t));
+	    if (!more)
+	    {
+		nomem = 1;
+		break;
+	    }
+	    splits = more;
+	    maxsplits *= 2;
+	}
+	pos += ofs;
+	splits[nsplits * 2] = pos;
+	splits[nsplits * 2 + 1] = bits;
+	nsplits++;
+    }
+    Py_END_ALLOW_THREADS;
+
+    if (nomem)
+	result = PyErr_NoMemory();
+    else
+	result = PyString_FromStringAndSize((char *)splits,
+					    nsplits * 2 * sizeof(uint32_t));
+    free(splits);
+    return result;
+}
+
+
+// Returns find_splits() for bupsplit, i.e. boundaries exactly as
+// repeated splitbuf() calls would find them, except that a boundary
+// beyond max_blob bytes is cut short at max_blob (with bits 0), and the
+// search restarts from there.
+static PyObject *splitbuf_all(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    int max_blob = 0;
+
+    if (!PyArg_ParseTuple(args, "t#i", &buf, &len, &max_blob))
+	return NULL;
+    if (max_blob <= 0)
+	return PyErr_Format(PyExc_ValueError, "max_blob must be positive");
+    return find_splits(buf, len, rollsum_find_ofs, &max_blob, BUP_BLOBBITS);
+}
+
+
+// Returns find_splits() for the gear chunker.
+static PyObject *gearsplit_all(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    int params[3];
+
+    if (!PyArg_ParseTuple(args, "t#iii", &buf, &len,
+			  &params[0], &params[1], &params[2]))
+	return NULL;
+    if (params[1] < GEARSPLIT_MIN_AVG_BITS
+	|| params[1] > GEARSPLIT_MAX_AVG_BITS)
+	return PyErr_Format(PyExc_ValueError,
+			    "avg_bits must be between %d and %d",
+			    GEARSPLIT_MIN_AVG_BITS, GEARSPLIT_MAX_AVG_BITS);
+    if (params[0] < 0 || params[0] >= (1 << params[1])
+	|| params[2] <= (1 << params[1]))
+	return PyErr_Format(PyExc_ValueError,
+			    "sizes must be 0 <= min < avg < max");
+    return find_splits(buf, len, gear_find_ofs, params, params[1]);
+}
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -410,6 +546,107 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+/* Bloom v3 ("blocked") filters keep all k bits for an object in one
+ * 64-byte block, so a lookup touches one cache line (and one page)
+ * instead of k random ones.  The block number comes from the first 8
+ * bytes of the sha, and each bit within the block from the top 9 bits
+ * of a 16-bit word starting at byte 8.
+ */
+#define BLOOM3_HEADERLEN 64
+#define BLOOM3_BLOCKBITS 6
+
+static unsigned char *bloom3_block(unsigned char *bloom,
+	const unsigned char *sha, const int nbits)
+{
+    uint32_t high, low;
+    uint64_t raw;
+
+    memcpy(&high, sha, 4);
+    memcpy(&low, sha + 4, 4);
+    raw = ((uint64_t)ntohl(high) << 32) | ntohl(low);
+    raw >>= 64 - (nbits - BLOOM3_BLOCKBITS);
+    return bloom + BLOOM3_HEADERLEN + (raw << BLOOM3_BLOCKBITS);
+}
+
+static int bloom3_bit(const unsigned char *sha, int i)
+{
+    return ((sha[8 + 2*i] << 8) | sha[9 + 2*i]) >> 7;
+}
+
+static int bloom3_check_args(Py_ssize_t blen, int nbits, int k)
+{
+    if (nbits <= BLOOM3_BLOCKBITS || nbits > 63 || k < 1 || k > 6)
+    {
+	PyErr_Format(PyExc_ValueError, "invalid bloom v3 parameters "
+		     "(nbits=%d, k=%d)", nbits, k);
+	return 0;
+    }
+    if (blen < BLOOM3_HEADERLEN + ((Py_ssize_t)1 << nbits))
+    {
+	PyErr_SetString(PyExc_ValueError, "bloom table is too small");
+	return 0;
+    }
+    return 1;
+}
+
+static PyObject *bloom_add3(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block, *end;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i, bit;
+
+    if (!PyArg_ParseTuple(args, "w#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+    if (!bloom3_check_args(blen, nbits, k))
+	return NULL;
+    if (len % 20 != 0)
+    {
+	PyErr_SetString(PyExc_ValueError, "sha table length is not a multiple of 20");
+	return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS;
+    for (end = sha + len; sha < end; sha += 20)
+    {
+	block = bloom3_block(bloom, sha, nbits);
+	for (i = 0; i < k; i++)
+	{
+	    bit = bloom3_bit(sha, i);
+	    block[bit >> 3] |= 1 << (bit & 7);
+	}
+    }
+    Py_END_ALLOW_THREADS;
+
+    return Py_BuildValue("n", len/20);
+}
+
+static PyObject *bloom_contains3(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i, bit;
+
+    if (!PyArg_ParseTuple(args, "t#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+    if (!bloom3_check_args(blen, nbits, k))
+	return NULL;
+    if (len != 20)
+    {
+	PyErr_SetString(PyExc_ValueError, "sha must be 20 bytes");
+	return NULL;
+    }
+
+    block = bloom3_block(bloom, sha, nbits);
+    for (i = 0; i < k; i++)
+    {
+	bit = bloom3_bit(sha, i);
+	if (!(block[bit >> 3] & (1 << (bit & 7))))
+	    return Py_BuildValue("Oi", Py_None, i + 1);
+    }
+    return Py_BuildValue("ii", 1, k);
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -471,7 +708,6 @@ static void _fix_idx_order(struct idx **idxs, int *last_i)
     if (idxs[*last_i]->cur >= idxs[*last_i]->end)
     {
 	idxs[*last_i] = NULL;
-	PyMem_Free(idx);
 	--*last_i;
 	return;
     }
@@ -508,17 +744,173 @@ static uint32_t _get_idx_i(struct idx *idx)
     return ntohl(*idx->cur_name) + idx->name_base;
 }
 
+// A sha table is 'count' sorted records of 'stride' bytes, each of which
+// starts with a 20-byte sha (e.g. the sha list of an idx or midx).
+static int _check_sha_table(Py_ssize_t len, Py_ssize_t stride,
+			    Py_ssize_t count)
+{
+    if (stride < 20 || count < 0 || (count && (count-1)*stride + 20 > len))
+    {
+	PyErr_SetString(PyExc_ValueError, "invalid sha table size");
+	return 0;
+    }
+    return 1;
+}
+
+
+static PyObject *bisect_sha(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *sha = NULL;
+    Py_ssize_t len = 0, sha_len = 0, stride = 0, start = 0, end = 0;
+    int steps = 0;
+
+    if (!PyArg_ParseTuple(args, "t#nnnt#", &table, &len, &stride,
+			  &start, &end, &sha, &sha_len))
+	return NULL;
+    if (!_check_sha_table(len, stride, end))
+	return NULL;
+    if (start < 0 || sha_len != 20)
+	return PyErr_Format(PyExc_ValueError, "invalid sha search");
+
+    while (start < end)
+    {
+	Py_ssize_t mid = start + (end - start) / 2;
+	int c = memcmp(table + mid * stride, sha, 20);
+	++steps;
+	if (c < 0)
+	    start = mid + 1;
+	else if (c > 0)
+	    end = mid;
+	else
+	    return Py_BuildValue("ni", mid, steps);
+    }
+    return Py_BuildValue("ni", (Py_ssize_t)-1, steps);
+}
+
+
+static PyObject *interpolate_sha(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *sha = NULL;
+    Py_ssize_t len = 0, sha_len = 0, start = 0, end = 0;
+    unsigned PY_LONG_LONG startv = 0, endv = 0, hashv;
+    int steps = 0;
+
+    if (!PyArg_ParseTuple(args, "t#nnKKt#", &table, &len, &start, &end,
+			  &startv, &endv, &sha, &sha_len))
+	return NULL;
+    if (!_check_sha_table(len, 20, end))
+	return NULL;
+    if (start < 0 || sha_len != 20)
+	return PyErr_Format(PyExc_ValueError, "invalid sha search");
+
+    hashv = ntohl(*(uint32_t *)sha);
+    if (hashv < startv || hashv > endv)
+	return Py_BuildValue("ni", (Py_ssize_t)-1, steps);
+    while (start < end)
+    {
+	Py_ssize_t mid = start;
+	const unsigned char *v;
+	int c;
+	++steps;
+	// hashv is within [startv, endv], so mid is within [start, end).
+	if (endv > startv)
+	    mid += (hashv - startv) * (end - start - 1) / (endv - startv);
+	v = table + mid * 20;
+	c = memcmp(v, sha, 20);
+	if (c < 0)
+	{
+	    start = mid + 1;
+	    startv = ntohl(*(uint32_t *)v);
+	}
+	else if (c > 0)
+	{
+	    end = mid;
+	    endv = ntohl(*(uint32_t *)v);
+	}
+	else
+	    return Py_BuildValue("ni", mid, steps);
+    }
+    return Py_BuildValue("ni", (Py_ssize_t)-1, steps);
+}
+
+
+static PyObject *find_shas(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *queries = NULL;
+    Py_ssize_t len = 0, qlen = 0, stride = 0, count = 0, nq, i, lo;
+    Py_ssize_t *found;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#nnt#", &table, &len, &stride, &count,
+			  &queries, &qlen))
+	return NULL;
+    if (!_check_sha_table(len, stride, count))
+	return NULL;
+    if (qlen % 20)
+	return PyErr_Format(PyExc_ValueError,
+			    "query length %zd is not a multiple of 20", qlen);
+    nq = qlen / 20;
+    found = PyMem_Malloc((nq ? nq : 1) * sizeof(*found));
+    if (!found)
+	return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS;
+    // The queries are sorted, so each search can start where the last one
+    // ended, galloping ahead to bound it: the whole batch is one merge
+    // pass when the queries are dense, and a binary search each when not.
+    lo = 0;
+    for (i = 0; i < nq; i++)
+    {
+	const unsigned char *q = queries + i * 20;
+	Py_ssize_t bound = 1, start, end;
+	while (lo + bound <= count
+	       && memcmp(table + (lo + bound - 1) * stride, q, 20) < 0)
+	    bound *= 2;
+	start = lo + bound / 2;
+	end = lo + bound - 1 < count ? lo + bound - 1 : count;
+	while (start < end)
+	{
+	    Py_ssize_t mid = start + (end - start) / 2;
+	    if (memcmp(table + mid * stride, q, 20) < 0)
+		start = mid + 1;
+	    else
+		end = mid;
+	}
+	lo = start;
+	if (lo < count && memcmp(table + lo * stride, q, 20) == 0)
+	    found[i] = lo;
+	else
+	    found[i] = -1;
+    }
+    Py_END_ALLOW_THREADS;
+
+    result = PyList_New(nq);
+    for (i = 0; result && i < nq; i++)
+    {
+	PyObject *n = PyInt_FromSsize_t(found[i]);
+	if (!n)
+	{
+	    Py_DECREF(result);
+	    result = NULL;
+	    break;
+	}
+	PyList_SET_ITEM(result, i, n);
+    }
+    PyMem_Free(found);
+    return result;
+}
+
 #define MIDX4_HEADERLEN 12
 
 static PyObject *merge_into(PyObject *self, PyObject *args)
 {
-    PyObject *py_total, *ilist = NULL;
+    PyObject *py_total, *ilist = NULL, **maps = NULL, *result = NULL;
     unsigned char *fmap = NULL;
     struct sha *sha_ptr, *sha_start = NULL;
     uint32_t *table_ptr, *name_ptr, *name_start;
-    struct idx **idxs = NULL;
+    struct idx **idxs = NULL, *idx_structs = NULL;
     Py_ssize_t flen = 0;
-    int bits = 0, i;
+    int bits = 0, i, num_maps = 0;
     unsigned int total;
     uint32_t count, prefix;
     int num_i;
@@ -532,16 +924,32 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
         return NULL;
 
     num_i = PyList_Size(ilist);
+    if (num_i < 0)
+        return NULL;
     idxs = (struct idx **)PyMem_Malloc(num_i * sizeof(struct idx *));
+    idx_structs = (struct idx *)PyMem_Malloc(num_i * sizeof(struct idx));
+    // The GIL is released below, so hold on to the output map and each of
+    // the input maps until we're done with their buffers.  The caller
+    // mustn't close them in the meantime, either.
+    maps = (PyObject **)PyMem_Malloc((num_i + 1) * sizeof(PyObject *));
+    if (!idxs || !idx_structs || !maps)
+    {
+        PyErr_NoMemory();
+        goto clean_and_return;
+    }
+    maps[num_maps] = PyTuple_GET_ITEM(args, 0);
+    Py_INCREF(maps[num_maps++]);
 
     for (i = 0; i < num_i; i++)
     {
 	long len, sha_ofs, name_map_ofs;
-	idxs[i] = (struct idx *)PyMem_Malloc(sizeof(struct idx));
+	idxs[i] = &idx_structs[i];
 	PyObject *itup = PyList_GetItem(ilist, i);
 	if (!PyArg_ParseTuple(itup, "t#llli", &idxs[i]->map, &idxs[i]->bytes,
 		    &len, &sha_ofs, &name_map_ofs, &idxs[i]->name_base))
-	    return NULL;
+	    goto clean_and_return;
+	maps[num_maps] = PyTuple_GET_ITEM(itup, 0);
+	Py_INCREF(maps[num_maps++]);
 	idxs[i]->cur = (struct sha *)&idxs[i]->map[sha_ofs];
 	idxs[i]->end = &idxs[i]->cur[len];
 	if (name_map_ofs)
@@ -553,6 +961,8 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     sha_start = sha_ptr = (struct sha *)&table_ptr[1<<bits];
     name_start = name_ptr = (uint32_t *)&sha_ptr[total];
 
+    // This may be running in a background thread (see git.auto_midx()).
+    Py_BEGIN_ALLOW_THREADS;
     last_i = num_i-1;
     count = 0;
     prefix = 0;
@@ -577,13 +987,20 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     }
     while (prefix < (1<<bits))
 	table_ptr[prefix++] = htonl(count);
+    Py_END_ALLOW_THREADS;
     assert(count == total);
     assert(prefix == (1<<bits));
     assert(sha_ptr == sha_start+count);
     assert(name_ptr == name_start+count);
+    result = PyLong_FromUnsignedLong(count);
 
+  clean_and_return:
+    for (i = 0; i < num_maps; i++)
+        Py_DECREF(maps[i]);
+    PyMem_Free(maps);
     PyMem_Free(idxs);
-    return PyLong_FromUnsignedLong(count);
+    PyMem_Free(idx_structs);
+    return result;
 }
 
 // This function should technically be macro'd out if it's going to be used
@@ -811,6 +1228,78 @@ static PyObject *fadvise_done(PyObject *self, PyObject *args)
 }
 
 
+#if defined(SEEK_DATA) && defined(SEEK_HOLE)
+#define BUP_HAVE_SEEK_HOLE 1
+
+// Return lseek(fd, ofs, whence) for SEEK_DATA or SEEK_HOLE, or None if
+// there's no such offset (ENXIO).  The file offset is left unchanged,
+// so that this doesn't disturb anyone reading from fd.
+static PyObject *seek_data_or_hole(PyObject *args, int whence)
+{
+    int fd = -1, err;
+    long long ofs = 0;
+    off_t cur, result;
+    if (!PyArg_ParseTuple(args, "iL", &fd, &ofs))
+	return NULL;
+    cur = lseek(fd, 0, SEEK_CUR);
+    if (cur < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    result = lseek(fd, ofs, whence);
+    err = errno;
+    if (lseek(fd, cur, SEEK_SET) < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    if (result < 0)
+    {
+        if (err == ENXIO)
+            return Py_BuildValue("");
+        errno = err;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+    return PyLong_FromLongLong(result);
+}
+
+
+static PyObject *next_data(PyObject *self, PyObject *args)
+{
+    return seek_data_or_hole(args, SEEK_DATA);
+}
+
+
+static PyObject *next_hole(PyObject *self, PyObject *args)
+{
+    return seek_data_or_hole(args, SEEK_HOLE);
+}
+#endif /* defined(SEEK_DATA) && defined(SEEK_HOLE) */
+
+
+static PyObject *madvise_sequential(PyObject *self, PyObject *args)
+{
+    char *buf = NULL;
+    Py_ssize_t len = 0;
+    if (!PyArg_ParseTuple(args, "t#", &buf, &len))
+	return NULL;
+#ifdef MADV_SEQUENTIAL
+    if (len)
+        madvise(buf, len, MADV_SEQUENTIAL);
+#endif
+    return Py_BuildValue("");
+}
+
+
+static PyObject *madvise_done(PyObject *self, PyObject *args)
+{
+    char *buf = NULL;
+    Py_ssize_t len = 0;
+    if (!PyArg_ParseTuple(args, "t#", &buf, &len))
+	return NULL;
+#ifdef MADV_DONTNEED
+    if (len)
+        madvise(buf, len, MADV_DONTNEED);
+#endif
+    return Py_BuildValue("");
+}
+
+
 #ifdef BUP_HAVE_FILE_ATTRS
 static PyObject *bup_get_linux_file_attr(PyObject *self, PyObject *args)
 {
@@ -1152,6 +1641,141 @@ static PyObject *bup_fstat(PyObject *self, PyObject *args)
 }
 
 
+#ifdef BUP_HAVE_DIR_FDS
+
+static PyObject *bup_open_dir_at(PyObject *self, PyObject *args)
+{
+    int dirfd, fd;
+    char *name;
+
+    if (!PyArg_ParseTuple(args, "is", &dirfd, &name))
+        return NULL;
+
+    int flags = O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_NONBLOCK;
+#ifdef O_LARGEFILE
+    flags |= O_LARGEFILE;
+#endif
+#ifdef O_CLOEXEC
+    flags |= O_CLOEXEC;
+#endif
+    Py_BEGIN_ALLOW_THREADS;
+    fd = openat(dirfd, name, flags);
+    Py_END_ALLOW_THREADS;
+    if (fd < 0)
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, name);
+    return Py_BuildValue("i", fd);
+}
+
+
+struct dir_stat
+{
+    char *name;
+    int err;
+    struct stat st;
+};
+
+static void free_dir_stats(struct dir_stat *ents, size_t n)
+{
+    size_t i;
+    for (i = 0; i < n; i++)
+        free(ents[i].name);
+    free(ents);
+}
+
+static PyObject *bup_stat_dir(PyObject *self, PyObject *args)
+{
+    int fd, dupfd, err = 0;
+    DIR *dir = NULL;
+    struct dirent *d;
+    struct dir_stat *ents = NULL;
+    size_t n = 0, size = 0, i;
+
+    if (!PyArg_ParseTuple(args, "i", &fd))
+        return NULL;
+
+    // Read every name, and fstatat() each one, without the GIL, so
+    // that other threads can do the same for other directories.
+    Py_BEGIN_ALLOW_THREADS;
+    dupfd = dup(fd);  // closedir() closes the fd fdopendir() was given
+    if (dupfd < 0 || !(dir = fdopendir(dupfd)))
+        err = errno;
+    while (dir && !err)
+    {
+        errno = 0;
+        d = readdir(dir);
+        if (!d)
+        {
+            err = errno;
+            break;
+        }
+        if (!strcmp(d->d_name, ".") || !strcmp(d->d_name, ".."))
+            continue;
+        if (n == size)
+        {
+            size_t new_size = size ? size * 2 : 64;
+            struct dir_stat *new_ents = realloc(ents,
+                                                new_size * sizeof(*ents));
+            if (!new_ents)
+            {
+                err = ENOMEM;
+                break;
+            }
+            ents = new_ents;
+            size = new_size;
+        }
+        ents[n].name = strdup(d->d_name);
+        if (!ents[n].name)
+        {
+            err = ENOMEM;
+            break;
+        }
+        ents[n].err = 0;
+        if (fstatat(fd, d->d_name, &ents[n].st, AT_SYMLINK_NOFOLLOW) != 0)
+            ents[n].err = errno;
+        n++;
+    }
+    if (dir)
+        closedir(dir);
+    else if (dupfd >= 0)
+        close(dupfd);
+    Py_END_ALLOW_THREADS;
+
+    if (err)
+    {
+        free_dir_stats(ents, n);
+        errno = err;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    PyObject *result = PyList_New(n);
+    if (!result)
+    {
+        free_dir_stats(ents, n);
+        return NULL;
+    }
+    for (i = 0; i < n; i++)
+    {
+        PyObject *st;
+        if (ents[i].err)
+            st = PyInt_FromLong(ents[i].err);
+        else
+            st = stat_struct_to_py(&ents[i].st, ents[i].name, fd);
+        PyObject *item = st ? Py_BuildValue("(sN)", ents[i].name, st) : NULL;
+        if (!item)
+        {
+            Py_DECREF(result);
+            free_dir_stats(ents, n);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+    free_dir_stats(ents, n);
+    return result;
+}
+
+#endif /* def BUP_HAVE_DIR_FDS */
+
+
 static PyMethodDef helper_methods[] = {
     { "selftest", selftest, METH_VARARGS,
 	"Check that the rolling checksum rolls correctly (for unit tests)." },
@@ -1159,6 +1783,10 @@ static PyMethodDef helper_methods[] = {
 	"Return the number of bits in the rolling checksum." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "splitbuf_all", splitbuf_all, METH_VARARGS,
+	"Return every (end offset, bits) split point in a buffer as uint32s." },
+    { "gearsplit_all", gearsplit_all, METH_VARARGS,
+	"Split a buffer with the gear chunker, like splitbuf_all()." },
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
@@ -1167,8 +1795,18 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "bloom_contains3", bloom_contains3, METH_VARARGS,
+	"Check if a blocked (v3) bloom filter of 2^nbits bytes contains an object" },
+    { "bloom_add3", bloom_add3, METH_VARARGS,
+	"Add objects to a blocked (v3) bloom filter of 2^nbits bytes" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
+    { "bisect_sha", bisect_sha, METH_VARARGS,
+	"Binary search a sorted sha table for a sha; return (index, steps)." },
+    { "interpolate_sha", interpolate_sha, METH_VARARGS,
+	"Interpolation search a sorted sha list; return (index, steps)." },
+    { "find_shas", find_shas, METH_VARARGS,
+	"Return the index (or -1) of each of the sorted shas in a sha table." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
@@ -1181,6 +1819,16 @@ static PyMethodDef helper_methods[] = {
 	"open() the given filename for read with O_NOATIME if possible" },
     { "fadvise_done", fadvise_done, METH_VARARGS,
 	"Inform the kernel that we're finished with earlier parts of a file" },
+#ifdef BUP_HAVE_SEEK_HOLE
+    { "next_data", next_data, METH_VARARGS,
+	"Return the offset of the first data in fd at or after ofs, or None" },
+    { "next_hole", next_hole, METH_VARARGS,
+	"Return the offset of the first hole in fd at or after ofs, or None" },
+#endif
+    { "madvise_sequential", madvise_sequential, METH_VARARGS,
+	"Inform the kernel that the given mmap will be read sequentially" },
+    { "madvise_done", madvise_done, METH_VARARGS,
+	"Inform the kernel that we're finished with the given mmap's pages" },
 #ifdef BUP_HAVE_FILE_ATTRS
     { "get_linux_file_attr", bup_get_linux_file_attr, METH_VARARGS,
       "Return the Linux attributes for the given file." },
@@ -1204,6 +1852,13 @@ static PyMethodDef helper_methods[] = {
 #endif
     { "stat", bup_stat, METH_VARARGS,
       "Extended version of stat." },
+#ifdef BUP_HAVE_DIR_FDS
+    { "open_dir_at", bup_open_dir_at, METH_VARARGS,
+      "Open the directory name (not a symlink) relative to dirfd." },
+    { "stat_dir", bup_stat_dir, METH_VARARGS,
+      "Return a list of (name, lstat() result or errno) for the entries"
+      " of the directory open as fd." },
+#endif
     { "lstat", bup_lstat, METH_VARARGS,
       "Extended version of lstat." },
     { "fstat", bup_fstat, METH_VARARGS,
@@ -78,12 +78,35 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Version 3 ("blocked") filters:
+
+A v2 lookup probes k bits scattered across the whole table, so when the
+table isn't resident in memory, every lookup of a new object can cost k
+major page faults, which is exactly the case the first point above warns
+about.  A v3 filter splits the table into 64-byte blocks (one cache line)
+and sets all k bits for an object inside a single block: the block number
+comes from the first 64 bits of the SHA, and each bit within the block
+from 9 of the following bits.  The header is padded to 64 bytes so that
+blocks are aligned to cache lines and never straddle a page.  A lookup
+therefore faults in at most one page.
+
+The price is a somewhat higher false positive rate for the same size,
+because entries aren't spread perfectly evenly across blocks; see
+pfalse_positive() below.  With the usual 32 bits per entry and k=5 it
+goes from about 0.006% to 0.010%, which is much cheaper than the extra
+page faults.  v2 is still the default; setting bup.bloomVersion to 3 in a
+repository's git config makes `bup bloom` create (or regenerate) v3
+filters there instead.  Either version can be read and updated.
 """
-import sys, os, math, mmap
+import sys, os, errno, math, mmap, fcntl
 from bup import _helpers
 from bup.helpers import *
 
-BLOOM_VERSION = 2
+BLOOM_VERSION = 2  # the default; see version_from_config()
+SUPPORTED_VERSIONS = (2, 3)
+HEADER_LEN = {2: 16, 3: 64}
+BLOCK_BITS = 512 # bits per v3 block
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
 MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
@@ -93,6 +116,8 @@ _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
 bloom_add = _helpers.bloom_add
+_contains = {2: _helpers.bloom_contains, 3: _helpers.bloom_contains3}
+_add = {2: _helpers.bloom_add, 3: _helpers.bloom_add3}
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
@@ -107,7 +132,17 @@ class ShaBloom:
         assert(filename.endswith('.bloom'))
         if readwrite:
             assert(expected > 0)
-            self.rwfile = f = f or open(filename, 'r+b')
+            # Filters are updated in place by several processes (see
+            # git.update_bloom()); only one may write at a time.  The lock
+            # goes away when rwfile is closed.
+            if f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f = lock(filename)
+                if not f:
+                    raise IOError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                  filename)
+            self.rwfile = f
             f.seek(0)
 
             # Decide if we want to mmap() the pages as writable ('immediate'
@@ -126,7 +161,12 @@ class ShaBloom:
             # one bit flipped per memory page), let's use a "private" mmap,
             # which defeats Linux's ability to flush it to disk.  Then we'll
             # flush it as one big lump during close().
-            pages = os.fstat(f.fileno()).st_size / 4096 * 5 # assume k=5
+            #
+            # A v2 entry touches k pages (assume k=5), a v3 entry only one.
+            hdr = f.read(8)
+            f.seek(0)
+            per_entry = (hdr[4:8] == struct.pack('!I', 3)) and 1 or 5
+            pages = os.fstat(f.fileno()).st_size / 4096 * per_entry
             self.delaywrite = expected > pages
             debug1('bloom: delaywrite=%r\n' % self.delaywrite)
             if self.delaywrite:
@@ -142,17 +182,21 @@ class ShaBloom:
             log('Warning: invalid BLOM header (%r) in %r\n' % (got, filename))
             return self._init_failed()
         ver = struct.unpack('!I', self.map[4:8])[0]
-        if ver < BLOOM_VERSION:
+        if ver < min(SUPPORTED_VERSIONS):
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
-        if ver > BLOOM_VERSION:
+        if ver > max(SUPPORTED_VERSIONS):
             log('Warning: ignoring too-new (v%d) bloom %r\n'
                 % (ver, filename))
             return self._init_failed()
 
+        self.version = ver
+        self.headerlen = HEADER_LEN[ver]
         self.bits, self.k, self.entries = struct.unpack('!HHI', self.map[8:16])
-        idxnamestr = str(self.map[16 + 2**self.bits:])
+        self._contains = _contains[ver]
+        self._add = _add[ver]
+        idxnamestr = str(self.map[self.headerlen + 2**self.bits:])
         if idxnamestr:
             self.idxnames = idxnamestr.split('\0')
         else:
@@ -166,6 +210,7 @@ class ShaBloom:
             self.rwfile = None
         self.idxnames = []
         self.bits = self.entries = 0
+        self.version = None
 
     def valid(self):
         return self.map and self.bits
@@ -182,7 +227,7 @@ class ShaBloom:
                 self.rwfile.write(self.map)
             else:
                 self.map.flush()
-            self.rwfile.seek(16 + 2**self.bits)
+            self.rwfile.seek(self.headerlen + 2**self.bits)
             if self.idxnames:
                 self.rwfile.write('\0'.join(self.idxnames))
         self._init_failed()
@@ -191,14 +236,35 @@ class ShaBloom:
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if self.version < 3:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # Each block behaves like a small v2 filter holding a Poisson
+        # distributed number of entries; average over that distribution.
+        mean = float(n) / (m / BLOCK_BITS)
+        p = math.exp(-mean)
+        total = 0
+        for i in xrange(int(mean + 10*math.sqrt(mean) + 10)):
+            if i:
+                p *= mean / i
+            total += p * (1-(1-1.0/BLOCK_BITS)**(k*i))**k
+        return 100*total
+
+    def needs_regrow(self, additional=0):
+        """Return true if the filter is (or, with `additional` more entries,
+        would be) too full, and regenerating it would make it bigger."""
+        return (self.bits < max(MAX_BLOOM_BITS.values())
+                and self.pfalse_positive(additional) > MAX_PFALSE_POSITIVE)
 
     def add_idx(self, ix):
-        """Add the object to the filter, return current pfalse_positive."""
+        """Add the objects in the index ix to the filter, unless they're
+        already there."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ix.shatable, self.bits, self.k)
-        self.idxnames.append(os.path.basename(ix.name))
+        name = os.path.basename(ix.name)
+        if name in self.idxnames:
+            return
+        self.entries += self._add(self.map, ix.shatable, self.bits, self.k)
+        self.idxnames.append(name)
 
     def exists(self, sha):
         """Return nonempty if the object probably exists in the bloom filter.
@@ -211,7 +277,7 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k)
+        found, steps = self._contains(self.map, str(sha), self.bits, self.k)
         _total_steps += steps
         return found
 
@@ -219,21 +285,81 @@ class ShaBloom:
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
+def lock(filename, wait=True):
+    """Lock the filter in filename against other writers, and return the
+    open file that holds the lock, or None if there's no such filter.
+    A ShaBloom opened for writing takes the same lock, so 'bup bloom' can
+    hold it while it replaces the filter.  If wait is false and someone
+    else holds the lock, raise IOError (EWOULDBLOCK) instead of waiting."""
+    while 1:
+        try:
+            f = open(filename, 'r+b')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            fcntl.flock(f.fileno(),
+                        fcntl.LOCK_EX | (not wait and fcntl.LOCK_NB or 0))
+        except:
+            f.close()
+            raise
+        # Whoever held the lock may have renamed a new filter into place.
+        try:
+            st = os.stat(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+        fst = os.fstat(f.fileno())
+        if st and (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+            return f
+        f.close()
+
+
+def version_from_config(config_get):
+    """Return the filter version that the bup.bloomVersion setting asks
+    for, or BLOOM_VERSION if it's unset.  config_get is as for
+    hashsplit.chunker_from_config().  Raise ValueError if the setting is
+    invalid."""
+    val = config_get('bup.bloomVersion')
+    if not val:
+        return BLOOM_VERSION
+    try:
+        version = int(val)
+    except ValueError:
+        version = None
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError('invalid bup.bloomVersion %r (expected %s)'
+                         % (val, ' or '.join(str(v)
+                                             for v in SUPPORTED_VERSIONS)))
+    return version
+
+
+def create(name, expected, delaywrite=None, f=None, k=None,
+           version=BLOOM_VERSION):
     """Create and return a bloom filter for `expected` entries."""
+    assert(version in SUPPORTED_VERSIONS)
     bits = int(math.floor(math.log(expected*MAX_BITS_EACH/8,2)))
     k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
     if bits > MAX_BLOOM_BITS[k]:
         log('bloom: warning, max bits exceeded, non-optimal\n')
         bits = MAX_BLOOM_BITS[k]
-    debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
+    if version >= 3:
+        # Blocking can't save faults in a table smaller than a page, and
+        # tiny tables have too few blocks to spread entries evenly.
+        bits = max(bits, 12)
+    debug1('bloom: using 2^%d bytes and %d hash functions (v%d)\n'
+           % (bits, k, version))
+    headerlen = HEADER_LEN[version]
     f = f or open(name, 'w+b')
     f.write('BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
-    assert(f.tell() == 16)
+    f.write(struct.pack('!IHHI', version, bits, k, 0))
+    f.write('\0' * (headerlen - 16))
+    assert(f.tell() == headerlen)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
-    f.truncate(16+2**bits)
+    f.truncate(headerlen+2**bits)
     f.seek(0)
     if delaywrite != None and not delaywrite:
         # tell it to expect very few objects, forcing a direct mmap
@@ -236,7 +236,8 @@ class Client:
             self.conn.write('%s\n' % ob)
         return idx
 
-    def new_packwriter(self, compression_level = 1):
+    def new_packwriter(self, compression_level = 1, jobs = 1,
+                       adaptive_compression = False):
         self.check_busy()
         def _set_busy():
             self._busy = 'receive-objects-v2'
@@ -247,7 +248,9 @@ class Client:
                                  onopen = _set_busy,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
-                                 compression_level = compression_level)
+                                 compression_level = compression_level,
+                                 jobs = jobs,
+                                 adaptive_compression = adaptive_compression)
 
     def read_ref(self, refname):
         self.check_busy()
@@ -260,6 +263,13 @@ class Client:
         else:
             return None   # nonexistent ref
 
+    def config_get(self, option):
+        self.check_busy()
+        self.conn.write('config-get %s\n' % option)
+        r = self.conn.readline().strip()
+        self.check_ok()
+        return r.decode('hex') or None  # None if unset
+
     def path_info(self, paths):
         self.check_busy()
         self.conn.write('path-info\n')
@@ -303,8 +313,11 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
-                 compression_level=1):
-        git.PackWriter.__init__(self, objcache_maker)
+                 compression_level=1,
+                 jobs=1,
+                 adaptive_compression=False):
+        git.PackWriter.__init__(self, objcache_maker, jobs=jobs,
+                                adaptive_compression=adaptive_compression)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -329,6 +342,7 @@ class PackWriter_Remote(git.PackWriter):
             return self.suggest_packs() # Returns last idx received
 
     def close(self):
+        self._close_pool()
         id = self._end()
         self.file = None
         return id
@@ -1,4 +1,5 @@
-import stat, os
+import stat, os, itertools
+from bup import _helpers
 from bup.helpers import *
 import bup.xstat as xstat
 
@@ -54,10 +55,10 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                        exclude_rxs=None):
     for (name,pst) in _dirlist():
         path = prepend + name
-        if excluded_paths:
-            if os.path.normpath(path) in excluded_paths:
-                debug1('Skipping %r: excluded.\n' % path)
-                continue
+        excluded = excluded_paths and excluded_paths.child(name)
+        if excluded and excluded.excluded:
+            debug1('Skipping %r: excluded.\n' % path)
+            continue
         if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
             continue
         if name.endswith('/'):
@@ -75,15 +76,199 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                 else:
                     for i in _recursive_dirlist(prepend=prepend+name, xdev=xdev,
                                                 bup_dir=bup_dir,
-                                                excluded_paths=excluded_paths,
+                                                excluded_paths=excluded,
                                                 exclude_rxs=exclude_rxs):
                         yield i
                     os.chdir('..')
         yield (path, pst)
 
 
+class _DirFile(OsFile):
+    def __init__(self, fd):
+        self.fd = fd
+
+
+_have_dir_fds = hasattr(_helpers, 'stat_dir')
+
+def _stat_dir(dfile, prepend):
+    """Return the entries of the directory dfile, like _dirlist()."""
+    return _stat_dir_listing(_helpers.stat_dir(dfile.fd), prepend)
+
+
+def _stat_dir_listing(entries, prepend):
+    l = []
+    for (n, st) in entries:
+        if isinstance(st, int):
+            e = OSError(st, os.strerror(st), n)
+            add_error(Exception('%s: %s' % (prepend + n, str(e))))
+            continue
+        st = xstat.stat_result.from_xstat_rep(st)
+        if (st.st_mode & _IFMT) == stat.S_IFDIR:
+            n += '/'
+        l.append((n,st))
+    l.sort(reverse=True)
+    return l
+
+
+def _open_and_stat_dir((dfile, name, prepend)):
+    try:
+        sub = _DirFile(_helpers.open_dir_at(dfile.fd, name))
+        return (sub, _helpers.stat_dir(sub.fd), None)
+    except OSError, e:
+        return (None, None, e)
+
+
+def _prefetch_dir((dfile, name, prepend)):
+    # Runs in a WorkerPool thread, so report errors via the result.  Only
+    # the listing is read ahead, and the fd is closed before returning,
+    # so that however many listings are pending, the walk itself never
+    # holds more than one fd per level (see _reopen_dir()).
+    try:
+        fd = _helpers.open_dir_at(dfile.fd, name)
+        try:
+            st = xstat.fstat(fd)
+            return ((st.st_dev, st.st_ino), _helpers.stat_dir(fd), None)
+        finally:
+            os.close(fd)
+    except OSError, e:
+        return (None, None, e)
+
+
+def _reopen_dir(dfile, name, (id, listing, e)):
+    """Open the directory whose listing _prefetch_dir() read, and return
+    (sub, listing, e) like _open_and_stat_dir(), reading the listing
+    again if the directory has been replaced since."""
+    if e:
+        return (None, None, e)
+    try:
+        sub = _DirFile(_helpers.open_dir_at(dfile.fd, name))
+        st = sub.stat()
+        if (st.st_dev, st.st_ino) != id:
+            listing = _helpers.stat_dir(sub.fd)
+        return (sub, listing, None)
+    except OSError, e:
+        return (None, None, e)
+
+
+def _recursive_dirlist_at(pool, dfile, listing, prepend, xdev, bup_dir,
+                          excluded_paths, exclude_rxs):
+    # Like _recursive_dirlist(), but read the directories via fds rather
+    # than chdir(), and (given a pool) read the subdirectories' listings
+    # in other threads, ahead of time, while yielding in the same order.
+    todo = []
+    for (name,pst) in listing:
+        path = prepend + name
+        excluded = excluded_paths and excluded_paths.child(name)
+        if excluded and excluded.excluded:
+            debug1('Skipping %r: excluded.\n' % path)
+            continue
+        if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
+            continue
+        recurse = False
+        if name.endswith('/'):
+            if bup_dir != None:
+                if os.path.normpath(path) == bup_dir:
+                    debug1('Skipping BUP_DIR.\n')
+                    continue
+            if xdev != None and pst.st_dev != xdev:
+                debug1('Skipping contents of %r: different filesystem.\n' % path)
+            else:
+                recurse = True
+        todo.append((name, path, pst, recurse, excluded))
+    subdirs = [(dfile, name[:-1], prepend)
+               for (name, path, pst, recurse, excluded) in todo if recurse]
+    if pool:
+        sublistings = pool.imap(_prefetch_dir, subdirs)
+    else:
+        sublistings = itertools.imap(_open_and_stat_dir, subdirs)
+    for (name, path, pst, recurse, excluded) in todo:
+        if recurse:
+            (sub, sublisting, e) = next(sublistings)
+            if pool:
+                (sub, sublisting, e) = _reopen_dir(dfile, name[:-1],
+                                                   (sub, sublisting, e))
+            if e:
+                add_error('%s: %s' % (prepend, e))
+            else:
+                sublisting = _stat_dir_listing(sublisting, path)
+                for i in _recursive_dirlist_at(pool, sub, sublisting, path,
+                                               xdev=xdev, bup_dir=bup_dir,
+                                               excluded_paths=excluded,
+                                               exclude_rxs=exclude_rxs):
+                    yield i
+                sub = None
+        yield (path, pst)
+
+
 def recursive_dirlist(paths, xdev, bup_dir=None, excluded_paths=None,
-                      exclude_rxs=None):
+                      exclude_rxs=None, jobs=1):
+    """Yield (path, stat) for each of the paths, and everything below
+    them, in reverse order (so that each directory comes after its
+    contents), skipping excluded paths and bup_dir.  If xdev, don't
+    descend into directories on other filesystems.
+
+    Where directory fds are supported, up to jobs threads read and
+    lstat() the contents of different directories at once.
+
+    excluded_paths and exclude_rxs may be plain lists, or (to avoid
+    compiling them for every call) an ExcludedPaths and an RxExcludes.
+    """
+    if excluded_paths and not isinstance(excluded_paths, ExcludedPaths):
+        excluded_paths = ExcludedPaths(excluded_paths)
+    if exclude_rxs and not isinstance(exclude_rxs, RxExcludes):
+        exclude_rxs = RxExcludes(exclude_rxs)
+    if not _have_dir_fds:
+        for i in _recursive_dirlist_chdir(paths, xdev, bup_dir=bup_dir,
+                                          excluded_paths=excluded_paths,
+                                          exclude_rxs=exclude_rxs):
+            yield i
+        return
+    pool = WorkerPool(jobs) if jobs > 1 else None
+    try:
+        assert(type(paths) != type(''))
+        for path in paths:
+            try:
+                pst = xstat.lstat(path)
+                if stat.S_ISLNK(pst.st_mode):
+                    yield (path, pst)
+                    continue
+            except OSError, e:
+                add_error('recursive_dirlist: %s' % e)
+                continue
+            try:
+                pfile = OsFile(path)
+            except OSError, e:
+                add_error(e)
+                continue
+            pst = pfile.stat()
+            if xdev:
+                xdev = pst.st_dev
+            else:
+                xdev = None
+            if stat.S_ISDIR(pst.st_mode):
+                prepend = os.path.join(path, '')
+                try:
+                    listing = _stat_dir(pfile, prepend)
+                except OSError, e:
+                    add_error('%s: %s' % (prepend, e))
+                else:
+                    excluded = excluded_paths and excluded_paths.find(prepend)
+                    for i in _recursive_dirlist_at(pool, pfile, listing,
+                                                   prepend, xdev=xdev,
+                                                   bup_dir=bup_dir,
+                                                   excluded_paths=excluded,
+                                                   exclude_rxs=exclude_rxs):
+                        yield i
+            else:
+                prepend = path
+            yield (prepend,pst)
+    finally:
+        if pool:
+            pool.close()
+
+
+def _recursive_dirlist_chdir(paths, xdev, bup_dir=None, excluded_paths=None,
+                             exclude_rxs=None):
     startdir = OsFile('.')
     try:
         assert(type(paths) != type(''))
@@ -109,9 +294,10 @@ def recursive_dirlist(paths, xdev, bup_dir=None, excluded_paths=None,
             if stat.S_ISDIR(pst.st_mode):
                 pfile.fchdir()
                 prepend = os.path.join(path, '')
+                excluded = excluded_paths and excluded_paths.find(prepend)
                 for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
                                             bup_dir=bup_dir,
-                                            excluded_paths=excluded_paths,
+                                            excluded_paths=excluded,
                                             exclude_rxs=exclude_rxs):
                     yield i
                 startdir.fchdir()
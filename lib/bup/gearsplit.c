@@ -0,0 +1,155 @@
+// A FastCDC-style content defined chunker, built on a "gear" rolling
+// hash (h = (h << 1) + gear[byte]), whose top bits depend on the last 64
+// bytes.  No boundary is considered in the first min_size bytes of a
+// chunk, and every chunk is cut at max_size.  In between, "normalized
+// chunking" makes a boundary less likely than the average before
+// avg_size and more likely after it, which narrows the distribution of
+// chunk sizes around the average.
+#include "gearsplit.h"
+#include <stdint.h>
+
+// The first 8 bytes (big endian) of sha1("bup gear %d" % i).  Changing
+// these changes every chunk boundary.
+static const uint64_t gear[256] = {
+    0xe9e4ab59dcb1e351ULL, 0x6c43c680ebdce1b7ULL, 0x3715d2ba4e01c567ULL,
+    0x3c5aacc4435b97b6ULL, 0x923e518dd03b5c61ULL, 0xc9505d1ccdf2d0c6ULL,
+    0x9c3989c1317ec3e9ULL, 0xf071cee11c6f76caULL, 0x117fd793f6ace8f0ULL,
+    0xc9b28f94b6226330ULL, 0x8f7f7db749c0fa79ULL, 0x0e618a19f661508cULL,
+    0xefc29e82ce779648ULL, 0xae77137975bbfe27ULL, 0xddc6fcf9f1e2613eULL,
+    0x57400d781629b98dULL, 0xa9e562c021905964ULL, 0xcda2d173646692a3ULL,
+    0x25a7cabc7b3a56f8ULL, 0x93e76a1093409368ULL, 0x819a5b040f670dfbULL,
+    0x07fdc8b8c29160daULL, 0x8f00d6a01f1f9159ULL, 0xb650f7d2a9f88b23ULL,
+    0xa145cea1aff8933bULL, 0xcf831341cc4980a1ULL, 0x0bec226f83c5f4a6ULL,
+    0x538f2d5f348d4bb0ULL, 0xe2095149ea6f5ff5ULL, 0x2b13966a53f3ff0aULL,
+    0xef44709b4de0ea4eULL, 0x5ed0a0e917e6bc3cULL, 0xb37cd54535cdcfd7ULL,
+    0x974fc8b14c2b46faULL, 0x2e5edb7e8959671eULL, 0x3d7b359c36999a9cULL,
+    0xa8e971d287a083cdULL, 0x8b1c36efa3efe80fULL, 0xd6a29f16d4bb7393ULL,
+    0xc29169a48cabfc45ULL, 0x1eb9d825a8c4fc8bULL, 0x604ba541e8f0bc0dULL,
+    0x18fb4e85958079eaULL, 0x36a694c7b60496e1ULL, 0x125be5fa29d502b8ULL,
+    0xbed589db7657ff44ULL, 0x690658389c27e6d6ULL, 0x72afd2732beeb112ULL,
+    0x27a63e694e4ba370ULL, 0x58483c3dfcf79f46ULL, 0x56c4135249ec9eaeULL,
+    0x6079bec64b7636e5ULL, 0x9d97d0a041200a15ULL, 0x3ac512bb1523d7c5ULL,
+    0xf74bc56933b02e0eULL, 0xff16b5222b3c21e9ULL, 0xde498262e761e315ULL,
+    0xfcf9f20778f56d50ULL, 0x1aba3dbb7ec3fc68ULL, 0xfb9b48b4e52eb2adULL,
+    0xc1c011ec1726a02aULL, 0x671b817caf42d91cULL, 0xe0043096c13b31fcULL,
+    0xd8bcccd4d1e44387ULL, 0x9de2119fb153a153ULL, 0xfa92eb93eff48969ULL,
+    0x3a455b31189ccfa3ULL, 0xb36c0319ade4533bULL, 0xfc3010a33c2d432eULL,
+    0x40fd3ab206f4c8a1ULL, 0x81b99f4c33f70961ULL, 0x46bec6886b683681ULL,
+    0x2118432556a98b68ULL, 0x1dc2f384f5f5b20cULL, 0x848f3968840d6ddfULL,
+    0x58e9c39d2d51740bULL, 0x8c31879179c3593bULL, 0xf02b2df646410b6cULL,
+    0x6b45e095eb8ac8a8ULL, 0xd6088d15c04d8f2eULL, 0x5d7b79df4763477bULL,
+    0xfa352c8038453befULL, 0x8099c0b27b2681b4ULL, 0xd1ea5d4e657c52b3ULL,
+    0x953787d5c2f030b7ULL, 0xc43662ac0aa90346ULL, 0x7f1181ff91ec6fa5ULL,
+    0x02d88cb0cc88da23ULL, 0xc4acaeba2c91d8c5ULL, 0x1a15cfbb9a3ec905ULL,
+    0x8edf42a1ae211c29ULL, 0x6d4a5bc184c7ddffULL, 0x568e56fcf6c15a8bULL,
+    0x82fa717b09de8a50ULL, 0x97f1aea912ef80e3ULL, 0x17d0659bf3743086ULL,
+    0x5f3a56b93c795a3cULL, 0xca20fd7fae3626c1ULL, 0x63f12723a95b167fULL,
+    0x4b0a264e570f6b4eULL, 0xbdd017dc79317f15ULL, 0x45d5c0205297a4bdULL,
+    0x0ed55e87212d307aULL, 0xfa6a6e672e0f0d14ULL, 0xfc60193b786e4e93ULL,
+    0x38156d4a9b00a4cfULL, 0xd85d46206f316966ULL, 0x6ab30174d6ce6525ULL,
+    0xa4c22fc3eee8c043ULL, 0xb3f53aa167a90cbeULL, 0x709ec597640a76e5ULL,
+    0x36d3363011d85b13ULL, 0xe73a420c86bf2c9bULL, 0x67346b0e0c505701ULL,
+    0xb8bf1bfce40db72aULL, 0x4212aa476b17f516ULL, 0xdac7df929ec8d685ULL,
+    0x05fadb263a04f663ULL, 0xe2c089828314fbabULL, 0x3ccecdf5c2671a72ULL,
+    0x5c8f891089c4506bULL, 0xca4f834a1489a2deULL, 0xfa6ac3c5b57058feULL,
+    0xbcda3a4e63743401ULL, 0xd1c53155ed0629d0ULL, 0x3149e9389022d61bULL,
+    0x76025d9c676be63eULL, 0xeffe9f7f066a7d2bULL, 0x3540c58667268ec5ULL,
+    0xe854f1b7cc0bb90dULL, 0xeb089ca2e5633eb0ULL, 0xb64bc700cd4181c8ULL,
+    0xfd45d498fb78f436ULL, 0x7180868dccb7fdd3ULL, 0x6ae498f064add775ULL,
+    0x8481c7fb86683a78ULL, 0xd7b0a6f76f0a9a07ULL, 0x2511ceb5010ae307ULL,
+    0x8397da013b00d01aULL, 0x65b958487546126eULL, 0xb8912531a075b3f4ULL,
+    0x80b007ec53434855ULL, 0x5e24b1b0d8e08fcdULL, 0xfcbfd0b180f601cfULL,
+    0x735bd722d135a998ULL, 0xb80c833c8d2d76baULL, 0x07530ad3abd9b5e1ULL,
+    0x126caacd8c17732eULL, 0x2bfe986532ea99a9ULL, 0xc1f38e35cb5a3cd3ULL,
+    0x589199e7f108500fULL, 0xa39789cf28348215ULL, 0x28bfcfd7fdad374eULL,
+    0x82d09d14c8ef72b6ULL, 0xcf2c3b8a40194c5bULL, 0x9606a506e5ff645aULL,
+    0x8d846b502f0e3e7cULL, 0x57accdc395d42008ULL, 0x50e4ed5916348ea4ULL,
+    0x169ccf964668a947ULL, 0x3e051e3cd0dc5effULL, 0xe16d48d5967d9e32ULL,
+    0xadd303e115e6609dULL, 0xf8ac0d9391735fdeULL, 0x73ab7f6590d3105eULL,
+    0x49ede711332b30a2ULL, 0xa3f6f78f4c2aef28ULL, 0x28b6e7ca13579173ULL,
+    0xdfb12061c359dee6ULL, 0x12c1790d771ef5e8ULL, 0xc8f84a789a9e3704ULL,
+    0x88830e7c064f6b6bULL, 0x26c41d0aa3bf135dULL, 0xc130dc6cbf08e25cULL,
+    0xd3effb4118303cffULL, 0x44780ad5a61546cbULL, 0xc615448337b143b2ULL,
+    0xc8baf7ef738fa068ULL, 0xf4262ab626badcceULL, 0x20206b2865bf0c0fULL,
+    0x87d41270320190b0ULL, 0x2ddc95757c25db37ULL, 0xcdde33b72052cb04ULL,
+    0xed75140680f306a8ULL, 0x8d819dcec2a0a67cULL, 0x88db0ccbb7467c59ULL,
+    0xb8a082b9a28d460bULL, 0x94e0bb61196f692dULL, 0x69aa09f81a89e85dULL,
+    0x3539331d55e5cb66ULL, 0xfb909931df09f7c0ULL, 0x34700efb22e2fd40ULL,
+    0x6df095ca90f0e76dULL, 0x26eb19cb8873d2d2ULL, 0x20991f4030fa50d6ULL,
+    0xf4d33ac52de5de69ULL, 0xc7858347b1e7cfa6ULL, 0x249ca59be9f91cc1ULL,
+    0xf6f4daae0e5589a5ULL, 0xaad8bcf733db0711ULL, 0x85ae2160a968202dULL,
+    0x3ff06ea967260f77ULL, 0x5dd906c5cf19d4c9ULL, 0xe645b3b0604962c0ULL,
+    0xa83c698c2f2a8c0dULL, 0x2a725ed143c90c79ULL, 0x369b94bc4d29c8bbULL,
+    0xefdbdf156e234afaULL, 0xca3c4433c4300b18ULL, 0x9a079a1236bb7a77ULL,
+    0x4685bd148800ef14ULL, 0xa5771d7adc47e02cULL, 0x860e5892dddc4f92ULL,
+    0x54c1b7b0331771b4ULL, 0x4fd63b324fe99684ULL, 0x5cfe276672ff77e3ULL,
+    0x02d76b482ef6f5b8ULL, 0xc10c0dcb41338d5dULL, 0xf0708b3475f206d9ULL,
+    0x2f40a5df858f6bd3ULL, 0x355c8f53208bf824ULL, 0xb670c2c3c782052fULL,
+    0x410e69e544204ebfULL, 0x103011d1219c575fULL, 0x45c922b260370bf3ULL,
+    0xaddcfdb49815da6eULL, 0x9b6876fd8bd57eb5ULL, 0x554866643ab17decULL,
+    0xd9d0d1b8ddf00449ULL, 0x99559a963d64b6f2ULL, 0x3a066d00a4d47746ULL,
+    0xb93cbb1e7a844817ULL, 0x91b9eb2f6240f382ULL, 0xed960a7ca1f72534ULL,
+    0x1c47cdba54f3bd00ULL, 0x9d98f0806a53a5dfULL, 0xaca1fe8fe3985ba7ULL,
+    0x30606be17f9e057fULL, 0x498fd2a5d2bd0c81ULL, 0x138e2de2f7036b05ULL,
+    0xe6eb327028d2da64ULL, 0xf002ef75491005faULL, 0xef3b9114aa800b52ULL,
+    0x1a2b5d40cfb24412ULL, 0x10eb37dc39cfd96dULL, 0xb7f2d4ef8b486259ULL,
+    0x4e367e39f8e09eebULL, 0x45ffc36f1df59ed6ULL, 0x5940aaa8af74217cULL,
+    0x07dc9502d5058859ULL, 0x18088f5bb63a85f0ULL, 0x75ad1be4dd617feaULL,
+    0x6425391f8f971812ULL, 0x4281a6ecb38091c1ULL, 0x68c61f4cdcff2671ULL,
+    0xf1ee067d7d6924f4ULL
+};
+
+// How many bits beyond the average mask to use before (and after)
+// avg_size, i.e. the "normalization level".
+#define GEARSPLIT_NORMAL_BITS (2)
+
+
+static int leading_zeros(uint64_t h)
+{
+    int n = 0;
+    if (!h)
+	return 64;
+    while (!(h & (1ULL << 63)))
+    {
+	h <<= 1;
+	n++;
+    }
+    return n;
+}
+
+
+// Returns the length of the first chunk in buf, or 0 if buf ends before
+// the chunk does.  *bits is the number of leading zero bits in the hash
+// at the boundary (which is used like bupsplit's bits for the fanout),
+// but at least avg_bits, or 0 if the chunk was cut at max_size.
+int gearsplit_find_ofs(const unsigned char *buf, int len,
+		       int min_size, int avg_bits, int max_size, int *bits)
+{
+    const uint64_t mask_s = ~0ULL << (64 - (avg_bits + GEARSPLIT_NORMAL_BITS));
+    const uint64_t mask_l = ~0ULL << (64 - (avg_bits - GEARSPLIT_NORMAL_BITS));
+    const int end = len < max_size ? len : max_size;
+    const int normal = end < (1 << avg_bits) ? end : (1 << avg_bits);
+    uint64_t h = 0;
+    int i;
+
+    for (i = min_size; i < normal; i++)
+    {
+	h = (h << 1) + gear[buf[i]];
+	if (!(h & mask_s))
+	    goto found;
+    }
+    for (; i < end; i++)
+    {
+	h = (h << 1) + gear[buf[i]];
+	if (!(h & mask_l))
+	    goto found;
+    }
+    *bits = 0;
+    return len >= max_size ? max_size : 0;
+
+found:
+    *bits = leading_zeros(h);
+    if (*bits < avg_bits)
+	*bits = avg_bits;
+    return i + 1;
+}
@@ -0,0 +1,19 @@
+#ifndef __GEARSPLIT_H
+#define __GEARSPLIT_H
+
+// Limits on the average chunk size, as a power of two.
+#define GEARSPLIT_MIN_AVG_BITS (8)
+#define GEARSPLIT_MAX_AVG_BITS (24)
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+int gearsplit_find_ofs(const unsigned char *buf, int len,
+		       int min_size, int avg_bits, int max_size, int *bits);
+
+#ifdef __cplusplus
+}
+#endif
+
+#endif /* __GEARSPLIT_H */
@@ -4,6 +4,7 @@ interact with the Git data structures.
 """
 import cPickle as pickle;
 import os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
+import threading
 from collections import namedtuple
 from itertools import islice
 
@@ -12,6 +13,8 @@ from bup import _helpers, path, midx, bloom, xstat
 
 max_pack_size = 1000*1000*1000  # larger packs will slow down pruning
 max_pack_objects = 200*1000  # cache memory usage is about 83 bytes per object
+exists_batch = 1024  # objects to check with each exists_many() call
+exists_batch_bytes = 8*1024*1024  # ...unless they add up to more than this
 
 verbose = 0
 ignore_midx = 0
@@ -136,26 +139,100 @@ def all_packdirs():
     return paths
 
 
+_auto_midx_lock = threading.Lock()
+_auto_midx_threads = {}  # objdir -> [thread, run again when done]
+
 def auto_midx(objdir):
-    args = [path.exe(), 'midx', '--auto', '--dir', objdir]
-    try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError, e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+    """Merge the indexes in objdir into tiered midx files as needed, and
+    update its bloom filter, in a background thread.
+
+    If that's already happening for objdir, it's done once more after the
+    current run.  The process won't exit until the thread is finished;
+    see also wait_auto_midx().
+    """
+    objdir = os.path.abspath(objdir)
+    with _auto_midx_lock:
+        state = _auto_midx_threads.get(objdir)
+        if state:
+            state[1] = True
+            return
+        t = threading.Thread(target=_auto_midx_thread, args=(objdir,))
+        _auto_midx_threads[objdir] = [t, False]
+    t.start()
+
+
+def _auto_midx_thread(objdir):
+    while 1:
+        try:
+            midx.auto_merge(objdir, midx.max_files())
+        except (GitError, IOError, OSError), e:
+            add_error('midx %r: %s' % (objdir, e))
+
+        args = [path.exe(), 'bloom', '--dir', objdir]
+        try:
+            rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
+        except OSError, e:
+            # make sure 'args' gets printed to help with debugging
+            add_error('%r: exception: %s' % (args, e))
+        else:
+            if rv:
+                add_error('%r: returned %d' % (args, rv))
+
+        with _auto_midx_lock:
+            state = _auto_midx_threads[objdir]
+            if not state[1]:
+                del _auto_midx_threads[objdir]
+                return
+            state[1] = False
+
+
+def update_bloom(objdir, idxname):
+    """Add the objects in idxname to objdir's bup.bloom, if there is one.
+
+    Return true if the filter should be regenerated, because it has become
+    too full (see ShaBloom.needs_regrow()) or can't be updated in place.
+    'bup bloom' (run by auto_midx()) takes care of that.
 
-    args = [path.exe(), 'bloom', '--dir', objdir]
+    If someone else is writing the filter (e.g. 'bup bloom' is regenerating
+    it), don't wait for them; the index is just left out, and is checked
+    separately (see PackIdxList.unbloomed) until the next 'bup bloom'.
+    """
+    bfull = os.path.join(objdir, 'bup.bloom')
+    if not os.path.exists(bfull):
+        return False
+    ix = open_idx(idxname)
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError, e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+        f = bloom.lock(bfull, wait=False)
+        if not f:
+            return False
+        b = bloom.ShaBloom(bfull, f=f, readwrite=True, expected=len(ix))
+    except (IOError, OSError), e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            debug1('bloom: %s is busy; not adding %s\n'
+                   % (bfull, os.path.basename(idxname)))
+        else:
+            debug1('bloom: %s: %s\n' % (bfull, e))
+        return False
+    try:
+        if not b.valid():
+            return True
+        b.add_idx(ix)
+        debug2('bloom: added %d objects, %.4f%% false positives\n'
+               % (len(ix), b.pfalse_positive()))
+        return b.needs_regrow()
+    finally:
+        b.close()
+
+
+def wait_auto_midx():
+    """Wait for any auto_midx() threads to finish."""
+    while 1:
+        with _auto_midx_lock:
+            threads = [t for t, again in _auto_midx_threads.itervalues()]
+        if not threads:
+            return
+        for t in threads:
+            t.join()
 
 
 def mangle_name(name, mode, gitmode):
@@ -261,6 +338,12 @@ def _encode_packobj(type, content, compression_level=1):
     yield z.flush()
 
 
+def _encode_blob(content, compression_level=1):
+    """Return the id of blob 'content' and its encoding as a pack object."""
+    return (calc_hash('blob', content),
+            ''.join(_encode_packobj('blob', content, compression_level)))
+
+
 def _encode_looseobj(type, content, compression_level=1):
     z = zlib.compressobj(compression_level)
     yield z.compress('%s %d\0' % (type, len(content)))
@@ -316,6 +399,14 @@ class PackIdx:
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return exists(hash, want_source) for each of the sorted hashes,
+        looking them all up in one pass."""
+        source = want_source and os.path.basename(self.name) or True
+        found = _helpers.find_shas(self._shas, self._sha_stride, len(self),
+                                   ''.join(hashes))
+        return [source if i >= 0 else None for i in found]
+
     def __len__(self):
         return int(self.fanout[255])
 
@@ -326,18 +417,11 @@ class PackIdx:
         b1 = ord(hash[0])
         start = self.fanout[b1-1] # range -1..254
         end = self.fanout[b1] # range 0..255
-        want = str(hash)
-        _total_steps += 1  # lookup table is a step
-        while start < end:
-            _total_steps += 1
-            mid = start + (end-start)/2
-            v = self._idx_to_hash(mid)
-            if v < want:
-                start = mid+1
-            elif v > want:
-                end = mid
-            else: # got it!
-                return mid
+        idx, steps = _helpers.bisect_sha(self._shas, self._sha_stride,
+                                         start, end, hash)
+        _total_steps += 1 + steps  # lookup table is a step
+        if idx >= 0:
+            return idx
         return None
 
 
@@ -353,6 +437,8 @@ class PackIdxV1(PackIdx):
         nsha = self.fanout[255]
         self.sha_ofs = 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*24)
+        self._shas = buffer(self.map, self.sha_ofs + 4, max(nsha*24 - 4, 0))
+        self._sha_stride = 24
 
     def _ofs_from_idx(self, idx):
         return struct.unpack('!I', str(self.shatable[idx*24 : idx*24+4]))[0]
@@ -377,7 +463,8 @@ class PackIdxV2(PackIdx):
         self.fanout.append(0)  # entry "-1"
         nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
-        self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
+        self.shatable = self._shas = buffer(self.map, self.sha_ofs, nsha*20)
+        self._sha_stride = 20
         self.ofstable = buffer(self.map,
                                self.sha_ofs + nsha*20 + nsha*4,
                                nsha*4)
@@ -411,6 +498,7 @@ class PackIdxList:
         self.packs = []
         self.do_bloom = False
         self.bloom = None
+        self.unbloomed = []  # packs the bloom filter doesn't cover
         self.refresh()
 
     def __del__(self):
@@ -430,23 +518,62 @@ class PackIdxList:
         _total_searches += 1
         if hash in self.also:
             return True
+        packs = self.packs
         if self.do_bloom and self.bloom:
             if self.bloom.exists(hash):
                 self.do_bloom = False
-            else:
+            elif not self.unbloomed:
                 _total_searches -= 1  # was counted by bloom
                 return None
-        for i in xrange(len(self.packs)):
-            p = self.packs[i]
+            else:
+                packs = self.unbloomed
+        for i in xrange(len(packs)):
+            p = packs[i]
             _total_searches -= 1  # will be incremented by sub-pack
             ix = p.exists(hash, want_source=want_source)
             if ix:
                 # reorder so most recently used packs are searched first
-                self.packs = [p] + self.packs[:i] + self.packs[i+1:]
+                if i:
+                    packs.insert(0, packs.pop(i))
                 return ix
         self.do_bloom = True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return a list with exists(hash, want_source) for each of hashes.
+
+        The hashes are sorted and looked up in each index in one pass, so
+        this is much faster than calling exists() on each of a large batch.
+        """
+        result = [None] * len(hashes)
+        todo = []
+        unbloomed = []  # only in the packs the bloom filter doesn't cover
+        for i, hash in enumerate(hashes):
+            if hash in self.also:
+                result[i] = True
+            elif not self.bloom or self.bloom.exists(hash):
+                todo.append((str(hash), i))
+            elif self.unbloomed:
+                unbloomed.append((str(hash), i))
+        self._exists_many(self.packs, todo, result, want_source)
+        self._exists_many(self.unbloomed, unbloomed, result, want_source)
+        return result
+
+    def _exists_many(self, packs, todo, result, want_source):
+        todo.sort()
+        for p in packs:
+            if not todo:
+                break
+            found = p.exists_many([hash for (hash, i) in todo],
+                                  want_source=want_source)
+            left = []
+            for (hash, i), ix in zip(todo, found):
+                if ix:
+                    result[i] = ix
+                else:
+                    left.append((hash, i))
+            todo = left
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -461,6 +588,7 @@ class PackIdxList:
         """
         self.bloom = None # Always reopen the bloom as it may have been relaced
         self.do_bloom = False
+        self.unbloomed = []
         skip_midx = skip_midx or ignore_midx
         d = dict((p.name, p) for p in self.packs
                  if not skip_midx or not isinstance(p, midx.PackMidx))
@@ -473,7 +601,11 @@ class PackIdxList:
                             d[os.path.join(self.dir, name)] = ix
                 for full in glob.glob(os.path.join(self.dir,'*.midx')):
                     if not d.get(full):
-                        mx = midx.PackMidx(full)
+                        try:
+                            mx = midx.PackMidx(full)
+                        except (IOError, OSError), e:
+                            # merged into a bigger one since the glob
+                            continue
                         (mxd, mxf) = os.path.split(mx.name)
                         broken = False
                         for n in mx.idxnames:
@@ -506,6 +638,14 @@ class PackIdxList:
                                % os.path.basename(ix.name))
                         ix.close()
                         unlink(ix.name)
+                # Stop using the midxes that have been merged into a higher
+                # tier (see midx.auto_merge()).
+                for name, ix in d.items():
+                    if isinstance(ix, midx.PackMidx) and name == ix.name \
+                       and ix.idxnames \
+                       and not any(d.get(os.path.join(self.dir, sub)) is ix
+                                   for sub in ix.idxnames):
+                        del d[name]
             for full in glob.glob(os.path.join(self.dir,'*.idx')):
                 if not d.get(full):
                     try:
@@ -519,8 +659,26 @@ class PackIdxList:
                 self.bloom = bloom.ShaBloom(bfull)
             self.packs = list(set(d.values()))
             self.packs.sort(lambda x,y: -cmp(len(x),len(y)))
-            if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
-                self.do_bloom = True
+            if self.bloom and self.bloom.valid():
+                # A filter that's missing some indexes (e.g. written by
+                # another process since the last 'bup bloom') is still
+                # good for the ones it has.
+                covered = set(self.bloom.idxnames)
+                def in_bloom(p):
+                    if isinstance(p, midx.PackMidx):
+                        return covered.issuperset(p.idxnames)
+                    return os.path.basename(p.name) in covered
+                self.unbloomed = [p for p in self.packs if not in_bloom(p)]
+                if len(self.unbloomed) == len(self.packs):
+                    self.bloom = None
+                    self.unbloomed = []
+                else:
+                    self.do_bloom = True
+                    if self.unbloomed:
+                        debug1('bloom: %d index%s not in %s\n'
+                               % (len(self.unbloomed),
+                                  len(self.unbloomed) != 1 and 'es' or '',
+                                  os.path.basename(bfull)))
             else:
                 self.bloom = None
         debug1('PackIdxList: using %d index%s.\n'
@@ -567,9 +725,94 @@ def idxmerge(idxlist, final_progress=True):
 def _make_objcache():
     return PackIdxList(repo('objects/pack'))
 
+
+class AdaptiveCompression:
+    """Decide which blobs aren't worth compressing.
+
+    Before a blob is compressed, a prefix of it is compressed at level 1
+    as a trial, and if that doesn't shrink it by at least min_gain, the
+    blob is stored (at level 0) instead.  Once settle_after trials in a row
+    in the current file (see start_file()) agree, the rest of the file
+    skips the trial, except for every reprobe'th blob.  A file whose
+    extension has almost always gone one way starts out settled.
+    """
+    sample_size = 4096
+    settle_after = 4
+    reprobe = 64
+    ext_min_trials = 16
+
+    def __init__(self, compression_level, min_gain=0.05):
+        self.compression_level = compression_level
+        self.min_gain = min_gain
+        self.ext_stats = {}  # ext -> [compressible, incompressible] trials
+        self.trials = 0
+        self.bytes_stored = 0  # blob bytes chosen to store uncompressed
+        self.secs_saved = 0.0  # estimated compression time avoided
+        self._secs_per_byte = 0.0  # at level 1, in the last trial
+        self.start_file(None)
+
+    def start_file(self, name):
+        """Note that the following blobs are the contents of file name."""
+        self._ext = name and os.path.splitext(name)[1].lower() or None
+        self._settled = None  # None, or whether to compress without a trial
+        self._run = self._run_outcome = None
+        self._since_trial = 0
+        stats = self.ext_stats.get(self._ext)
+        if stats and sum(stats) >= self.ext_min_trials:
+            if stats[0] >= 0.9 * sum(stats):
+                self._settled = True
+            elif stats[1] >= 0.9 * sum(stats):
+                self._settled = False
+
+    def _trial(self, content):
+        sample = buffer(content, 0, self.sample_size)
+        start = time.time()
+        compressed = zlib.compress(sample, 1)
+        secs = time.time() - start
+        self.trials += 1
+        self.secs_saved -= secs
+        compressible = len(compressed) <= len(sample) * (1 - self.min_gain)
+        if len(sample):
+            self._secs_per_byte = secs / len(sample)
+        if self._ext is not None:
+            stats = self.ext_stats.setdefault(self._ext, [0, 0])
+            stats[not compressible] += 1
+        if compressible == self._run_outcome:
+            self._run += 1
+        else:
+            self._run, self._run_outcome = 1, compressible
+        if self._run >= self.settle_after:
+            self._settled = compressible
+        elif self._settled is not None and compressible != self._settled:
+            self._settled = None
+        self._since_trial = 0
+        return compressible
+
+    def level_for(self, content):
+        """Return the compression level to write blob content with."""
+        if self.compression_level <= 0:
+            return self.compression_level
+        if self._settled is None or self._since_trial >= self.reprobe:
+            compressible = self._trial(content)
+        else:
+            compressible = self._settled
+            self._since_trial += 1
+        if compressible:
+            return self.compression_level
+        self.bytes_stored += len(content)
+        self.secs_saved += len(content) * self._secs_per_byte
+        return 0
+
+    def summary(self):
+        return ('%.2f kbytes stored uncompressed after %d trials,'
+                ' saving about %.2f secs of compression'
+                % (self.bytes_stored / 1024., self.trials,
+                   max(0.0, self.secs_saved)))
+
 class PackWriter:
     """Writes Git objects inside a pack file."""
-    def __init__(self, objcache_maker=_make_objcache, compression_level=1):
+    def __init__(self, objcache_maker=_make_objcache, compression_level=1,
+                 jobs=1, adaptive_compression=False):
         self.count = 0
         self.outbytes = 0
         self.filename = None
@@ -578,6 +821,11 @@ class PackWriter:
         self.objcache_maker = objcache_maker
         self.objcache = None
         self.compression_level = compression_level
+        self.jobs = jobs
+        self._pool = None
+        self.adaptive = None
+        if adaptive_compression:
+            self.adaptive = AdaptiveCompression(compression_level)
 
     def __del__(self):
         self.close()
@@ -617,13 +865,28 @@ class PackWriter:
             self.idx[ord(sha[0])].append((sha, crc, self.file.tell() - size))
 
     def _write(self, sha, type, content):
-        if verbose:
-            log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        return self._write_encoded(sha,
+                                   _encode_packobj(type, content,
+                                                   self._level_for(type,
+                                                                   content)))
+
+    def _level_for(self, type, content):
+        if self.adaptive and type == 'blob':
+            return self.adaptive.level_for(content)
+        return self.compression_level
+
+    def start_file(self, name):
+        """Note that the following blobs are the contents of file name,
+        for adaptive compression."""
+        if self.adaptive:
+            self.adaptive.start_file(name)
+
+    def _write_encoded(self, sha, datalist):
+        if verbose:
+            log('>')
+        size, crc = self._raw_write(datalist, sha=sha)
         if self.outbytes >= max_pack_size or self.count >= max_pack_objects:
             self.breakpoint()
         return sha
@@ -646,6 +909,11 @@ class PackWriter:
         self._require_objcache()
         return self.objcache.exists(id, want_source=want_source)
 
+    def exists_many(self, ids, want_source=False):
+        """Return exists(id, want_source) for each of ids."""
+        self._require_objcache()
+        return self.objcache.exists_many(ids, want_source=want_source)
+
     def write(self, sha, type, content):
         """Write an object to the pack file.  Fails if sha exists()."""
         self._write(sha, type, content)
@@ -663,6 +931,57 @@ class PackWriter:
         """Create a blob object in the pack with the supplied content."""
         return self.maybe_write('blob', blob)
 
+    def new_blobs(self, blobs):
+        """Generate the id of each blob in 'blobs', creating it if necessary.
+
+        The result (and the resulting pack) is the same as calling
+        new_blob() on each blob in turn, but if the writer was created with
+        jobs > 1, upcoming blobs are hashed and compressed by a pool of
+        threads while the current one is written, and they're checked
+        against the object cache in batches, via exists_many().  Each blob
+        need only remain valid until the next one is requested from 'blobs'.
+        With adaptive compression, the new blobs' levels are chosen in
+        order, after that check, just as new_blob() would choose them.
+        """
+        if self.jobs <= 1:
+            for blob in blobs:
+                yield self.new_blob(blob)
+            return
+        if not self._pool:
+            self._pool = WorkerPool(self.jobs)
+        hash = lambda blob: (calc_hash('blob', blob), blob)
+        encode = lambda (blob, level): \
+            ''.join(_encode_packobj('blob', blob, level))
+        # The blobs may be views of a reused buffer (see hashsplit), and
+        # they'll be needed after the next one is read.
+        hashed = self._pool.imap(hash, (str(blob) for blob in blobs))
+        while 1:
+            # Check which of a batch of blobs are new all at once.
+            batch = []
+            size = 0
+            for (sha, blob) in hashed:
+                batch.append((sha, blob))
+                size += len(blob)
+                if len(batch) >= exists_batch or size >= exists_batch_bytes:
+                    break
+            if not batch:
+                break
+            found = self.exists_many([sha for (sha, blob) in batch])
+            new = set()
+            levels = []
+            for (sha, blob), ix in zip(batch, found):
+                if not ix and sha not in new:
+                    new.add(sha)
+                    levels.append((blob, self._level_for('blob', blob)))
+            encoded = self._pool.imap(encode, levels)
+            for (sha, blob), ix in zip(batch, found):
+                if sha in new:
+                    new.remove(sha)
+                    self._write_encoded(sha, [next(encoded)])
+                    self._require_objcache()
+                    self.objcache.add(sha)
+                yield sha
+
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
         content = tree_encode(shalist)
@@ -713,13 +1032,18 @@ class PackWriter:
         cp = struct.pack('!i', self.count)
         assert(len(cp) == 4)
         f.write(cp)
+        f.flush()
 
-        # calculate the pack sha1sum
-        f.seek(0)
-        sum = Sha1()
-        for b in chunkyreader(f):
-            sum.update(b)
-        packbin = sum.digest()
+        # calculate the pack sha1sum.  Since the count is at the front, the
+        # sum can't be computed as the objects are written, but the pack
+        # should still be in the page cache, so hash it there rather than
+        # read() it all back.
+        pack_map = mmap_read(f, close=False)
+        try:
+            packbin = Sha1(pack_map).digest()
+        finally:
+            pack_map.close()
+        f.seek(0, 2)
         f.write(packbin)
         f.close()
 
@@ -731,12 +1055,23 @@ class PackWriter:
         os.rename(self.filename + '.pack', nameprefix + '.pack')
         os.rename(self.filename + '.idx', nameprefix + '.idx')
 
+        # Keep the bloom filter covering every index, so later lookups
+        # (in this process too) don't lose the fast negative path.
+        if update_bloom(repo('objects/pack'), nameprefix + '.idx') \
+           and not run_midx:
+            debug1('bloom: filter needs regenerating; run bup bloom\n')
         if run_midx:
             auto_midx(repo('objects/pack'))
         return nameprefix
 
+    def _close_pool(self):
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+
     def close(self, run_midx=True):
         """Close the pack file and move it to its definitive path."""
+        self._close_pool()
         return self._end(run_midx=run_midx)
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
@@ -751,33 +1086,23 @@ class PackWriter:
         idx_map = None
         idx_f = open(filename, 'w+b')
         try:
-            idx_f.truncate(index_len)
+            # Everything but the idx sum, which is computed from the map.
+            idx_f.truncate(index_len + 20)
             idx_map = mmap_readwrite(idx_f, close=False)
             count = _helpers.write_idx(filename, idx_map, idx, self.count)
             assert(count == self.count)
-        finally:
-            if idx_map: idx_map.close()
-            idx_f.close()
-
-        idx_f = open(filename, 'a+b')
-        try:
-            idx_f.write(packbin)
-            idx_f.seek(0)
-            idx_sum = Sha1()
-            b = idx_f.read(8 + 4*256)
-            idx_sum.update(b)
-
-            obj_list_sum = Sha1()
-            for b in chunkyreader(idx_f, 20*self.count):
-                idx_sum.update(b)
-                obj_list_sum.update(b)
-            namebase = obj_list_sum.hexdigest()
-
-            for b in chunkyreader(idx_f):
-                idx_sum.update(b)
-            idx_f.write(idx_sum.digest())
+            idx_map[index_len:] = packbin
+            shas_ofs = 8 + (4 * 256)
+            namebase = Sha1(buffer(idx_map, shas_ofs,
+                                   20 * self.count)).hexdigest()
+            idx_sum = Sha1(idx_map).digest()
+            idx_map.close()
+            idx_map = None
+            idx_f.seek(0, 2)
+            idx_f.write(idx_sum)
             return namebase
         finally:
+            if idx_map: idx_map.close()
             idx_f.close()
 
 
@@ -999,6 +1324,28 @@ def init_repo(path=None):
     _git_wait('git config', p)
 
 
+def git_config_get(option, repo_dir=None):
+    """Return the value of the given git config option in the repository,
+    or None if it isn't set."""
+    cmd = ('git', 'config', '--get', option)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                         preexec_fn=_gitenv(repo_dir))
+    r = p.stdout.read()
+    rc = p.wait()
+    if rc == 0:
+        return r.rstrip('\n')
+    if rc != 1:
+        raise GitError('%s returned %d' % (cmd, rc))
+    return None
+
+
+def git_config_set(option, value, repo_dir=None):
+    """Set the given git config option in the repository."""
+    p = subprocess.Popen(['git', 'config', option, value],
+                         stdout=sys.stderr, preexec_fn=_gitenv(repo_dir))
+    _git_wait('git config', p)
+
+
 def check_repo_or_die(path=None):
     """Make sure a bup repository exists, and abort if not.
     If the path to a particular repository was not specified, this function
@@ -1203,22 +1550,339 @@ class CatPipe:
         except StopIteration:
             log('booger!\n')
 
+    def get_many(self, ids, lookahead=None):
+        """Generate (type, content) for each object id in ids, in order.
+
+        This reads one object at a time; see ReaderPool for a version that
+        reads ahead.
+        """
+        for id in ids:
+            it = self.get(id)
+            type = it.next()
+            yield (type, ''.join(it))
+
+
+_OBJ_OFS_DELTA = 6
+_OBJ_REF_DELTA = 7
+_hexsha_rx = re.compile(r'^[0-9a-fA-F]{40}$')
+
+
+def _packobj_header(map, ofs):
+    """Return (type number, size, data offset) of the pack object at ofs."""
+    c = ord(map[ofs])
+    type = (c & 0x70) >> 4
+    sz = c & 0x0f
+    shift = 4
+    while c & 0x80:
+        ofs += 1
+        c = ord(map[ofs])
+        sz |= (c & 0x7f) << shift
+        shift += 7
+    return (type, sz, ofs + 1)
+
+
+def _inflate_iter(map, ofs, size):
+    """Generate the inflated content of the size byte zlib stream at ofs."""
+    z = zlib.decompressobj()
+    left = size
+    while left > 0:
+        # Compressed data is rarely much bigger than the original.
+        chunk = buffer(map, ofs, min(left, 65536) + 64)
+        if not len(chunk):
+            raise GitError('truncated object data at offset %d' % ofs)
+        ofs += len(chunk)
+        b = z.decompress(chunk)
+        left -= len(b)
+        if left < 0 or (left and z.unused_data):
+            raise GitError('object data at offset %d is not %d bytes'
+                           % (ofs, size))
+        yield b
+
+
+def _delta_size(delta, i):
+    sz = shift = 0
+    while 1:
+        c = ord(delta[i])
+        i += 1
+        sz |= (c & 0x7f) << shift
+        shift += 7
+        if not (c & 0x80):
+            return (sz, i)
+
+
+def _apply_delta(base, delta):
+    (base_sz, i) = _delta_size(delta, 0)
+    if base_sz != len(base):
+        raise GitError('delta base is %d bytes, expected %d'
+                       % (len(base), base_sz))
+    (sz, i) = _delta_size(delta, i)
+    out = []
+    while i < len(delta):
+        c = ord(delta[i])
+        i += 1
+        if c & 0x80:  # copy from base
+            ofs = n = 0
+            for bit in xrange(4):
+                if c & (1 << bit):
+                    ofs |= ord(delta[i]) << (bit * 8)
+                    i += 1
+            for bit in xrange(3):
+                if c & (0x10 << bit):
+                    n |= ord(delta[i]) << (bit * 8)
+                    i += 1
+            out.append(base[ofs:ofs + (n or 0x10000)])
+        elif c:  # insert the next c bytes
+            out.append(delta[i:i+c])
+            i += c
+        else:
+            raise GitError('invalid delta opcode 0')
+    result = ''.join(out)
+    if len(result) != sz:
+        raise GitError('delta result is %d bytes, expected %d'
+                       % (len(result), sz))
+    return result
+
+
+class PackReader(CatPipe):
+    """A CatPipe that reads objects directly from the repository's packs.
+
+    The packs are mapped, and each object is found via the midx and idx
+    files, inflated, and if it's a delta, applied to its base, without any
+    round trip to 'git cat-file'.  Anything that isn't an object id (or an
+    object id followed by ':'), or isn't in a pack (e.g. a loose object), is
+    still handled by CatPipe.
+    """
+    def __init__(self, repo_dir = None):
+        CatPipe.__init__(self, repo_dir)
+        self._cat_get = self.get
+        self.get = self._pack_get
+        self.packdir = repo('objects/pack', repo_dir=repo_dir)
+        self._idxs = []  # PackIdxes and PackMidxes, most recently used first
+        self._idx_cache = {}
+        self._pack_maps = {}
+        self._packdir_names = None
+        self._refresh()
+
+    def _open_idx(self, filename):
+        ix = self._idx_cache.get(filename)
+        if not ix:
+            ix = self._idx_cache[filename] = open_idx(filename)
+        return ix
+
+    def _refresh(self):
+        """Update the index list if the packdir has changed, and return
+        true if it has."""
+        names = set(glob.glob(os.path.join(self.packdir, '*.idx')))
+        midx_names = set(glob.glob(os.path.join(self.packdir, '*.midx')))
+        if (names, midx_names) == self._packdir_names:
+            return False
+        self._packdir_names = (names, midx_names)
+        for cache, keep in ((self._idx_cache, names | midx_names),
+                            (self._pack_maps, names)):
+            for name in set(cache) - keep:
+                del cache[name]
+        midxs = []
+        if not ignore_midx:
+            for name in midx_names:
+                try:
+                    mx = self._open_idx(name)
+                except (GitError, IOError, OSError), e:  # e.g. just removed
+                    continue
+                paths = [os.path.join(self.packdir, n) for n in mx.idxnames]
+                if mx.idxnames and all(n in names for n in paths):
+                    midxs.append((mx, paths))
+        midxs.sort(key=lambda (mx, paths): -len(mx))
+        covered = set()
+        idxs = []
+        for mx, paths in midxs:
+            if not covered.issuperset(paths):
+                idxs.append(mx)
+                covered.update(paths)
+        for name in names - covered:
+            try:
+                idxs.append(self._open_idx(name))
+            except (GitError, IOError, OSError), e:
+                continue
+        idxs.sort(key=lambda ix: -len(ix))
+        self._idxs = idxs
+        return True
+
+    def _pack_map(self, idxname):
+        m = self._pack_maps.get(idxname)
+        if not m:
+            m = mmap_read(open(idxname[:-len('.idx')] + '.pack'))
+            self._pack_maps[idxname] = m
+        return m
+
+    def _find(self, sha):
+        """Return (pack map, offset) for object sha, or None."""
+        for retry in (False, True):
+            if retry and not self._refresh():
+                return None
+            for i, ix in enumerate(self._idxs):
+                if isinstance(ix, midx.PackMidx):
+                    name = ix.exists(sha, want_source=True)
+                    if not name:
+                        continue
+                    ix = self._open_idx(os.path.join(self.packdir, name))
+                ofs = ix.find_offset(sha)
+                if ofs is not None:
+                    if i:
+                        self._idxs.insert(0, self._idxs.pop(i))
+                    return (self._pack_map(ix.name), ofs)
+
+    def _read_at(self, map, ofs):
+        """Return (type, content) of the pack object at ofs in map."""
+        (type, sz, data_ofs) = _packobj_header(map, ofs)
+        if type == _OBJ_OFS_DELTA:
+            c = ord(map[data_ofs])
+            base_ofs = c & 0x7f
+            while c & 0x80:
+                data_ofs += 1
+                c = ord(map[data_ofs])
+                base_ofs = ((base_ofs + 1) << 7) | (c & 0x7f)
+            (base_type, base) = self._read_at(map, ofs - base_ofs)
+            delta = ''.join(_inflate_iter(map, data_ofs + 1, sz))
+            return (base_type, _apply_delta(base, delta))
+        elif type == _OBJ_REF_DELTA:
+            base_sha = str(map[data_ofs:data_ofs+20])
+            loc = self._find(base_sha)
+            if not loc:
+                raise GitError('delta base %s is missing'
+                               % base_sha.encode('hex'))
+            (base_type, base) = self._read_at(*loc)
+            delta = ''.join(_inflate_iter(map, data_ofs + 20, sz))
+            return (base_type, _apply_delta(base, delta))
+        return (_typermap[type], ''.join(_inflate_iter(map, data_ofs, sz)))
+
+    def _pack_get(self, id):
+        loc = None
+        if _hexsha_rx.match(id):
+            loc = self._find(id.decode('hex'))
+        elif id.endswith(':') and _hexsha_rx.match(id[:-1]):
+            # The tree of a commit, or the tree itself.
+            loc = self._find(id[:-1].decode('hex'))
+            if loc:
+                (type, content) = self._read_at(*loc)
+                if type == 'commit':
+                    loc = self._find(parse_commit(content).tree.decode('hex'))
+                elif type != 'tree':
+                    loc = None
+        if not loc:
+            for x in self._cat_get(id):
+                yield x
+            return
+        (map, ofs) = loc
+        (type, sz, data_ofs) = _packobj_header(map, ofs)
+        if type in (_OBJ_OFS_DELTA, _OBJ_REF_DELTA):
+            (type, content) = self._read_at(map, ofs)
+            yield type
+            yield content
+        else:
+            yield _typermap[type]
+            for b in _inflate_iter(map, data_ofs, sz):
+                yield b
+
 
 _cp = {}
 
 def cp(repo_dir=None):
-    """Create a CatPipe object or reuse the already existing one."""
+    """Create a PackReader object or reuse the already existing one."""
     global _cp
     if not repo_dir:
         repo_dir = repo()
     repo_dir = os.path.abspath(repo_dir)
     cp = _cp.get(repo_dir)
     if not cp:
-        cp = CatPipe(repo_dir)
+        cp = PackReader(repo_dir)
         _cp[repo_dir] = cp
     return cp
 
 
+class ReaderPool:
+    """Keep several objects in flight with a set of independent readers.
+
+    A PackReader (like a CatPipe) can only read one object at a time, so
+    each of the 'jobs' worker threads gets a PackReader of its own, and
+    get_many() hands them the ids to read.  Inflating objects and applying
+    deltas mostly happens outside the GIL.  get() reads a single object in
+    the calling thread, via cp().  join() walks the trees in the calling
+    thread too, but with a PackReader of that thread's own, while the blobs
+    they point to are read by the pool, so any number of threads may
+    join() at once.
+    """
+    def __init__(self, jobs, repo_dir=None):
+        assert(jobs >= 1)
+        self.jobs = jobs
+        self.repo_dir = repo_dir
+        self._cp = cp(repo_dir)
+        self.get = self._cp.get
+        self._pool = WorkerPool(jobs) if jobs > 1 else None
+        self._local = threading.local()
+
+    def _reader(self):
+        reader = getattr(self._local, 'reader', None)
+        if not reader:
+            reader = self._local.reader = PackReader(self.repo_dir)
+        return reader
+
+    def _read(self, id):
+        it = self._reader().get(id)
+        type = it.next()
+        return (type, ''.join(it))
+
+    def get_many(self, ids, lookahead=None):
+        """Generate (type, content) for each object id in ids, in order.
+
+        The ids are consumed by the calling thread, and up to 'lookahead'
+        (default 4 * jobs) objects are read ahead.  A missing object raises
+        KeyError when its turn comes.
+        """
+        if not self._pool:
+            return self._cp.get_many(ids)
+        return self._pool.imap(self._read, ids, lookahead)
+
+    def _blob_ids(self, type, content):
+        if type == 'tree':
+            for (mode, name, sha) in tree_decode(content):
+                if not stat.S_ISDIR(mode):
+                    yield sha.encode('hex')
+                    continue
+                for id in self._blob_ids(*self._read(sha.encode('hex'))):
+                    yield id
+        elif type == 'commit':
+            for id in self._blob_ids(*self._read(parse_commit(content).tree)):
+                yield id
+        else:
+            raise GitError('invalid object type %r: expected blob/tree/commit'
+                           % type)
+
+    def join(self, id):
+        """Generate the content of all blobs that can be reached from an
+        object, like CatPipe.join()."""
+        it = self._reader().get(id)
+        type = it.next()
+        if type == 'blob':
+            for blob in it:
+                yield blob
+            return
+        ids = self._blob_ids(type, ''.join(it))
+        if self._pool:
+            objs = self.get_many(ids)
+        else:
+            objs = self._reader().get_many(ids)
+        for (type, blob) in objs:
+            if type != 'blob':
+                raise GitError('invalid object type %r: expected blob' % type)
+            yield blob
+
+    def close(self):
+        """Stop the worker threads."""
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+
+
 def tags(repo_dir = None):
     """Return a dictionary of all tags in the form {hash: [tag_names, ...]}."""
     tags = {}
@@ -1,9 +1,14 @@
-import math
+import itertools, math, mmap, stat
+from array import array
+from collections import deque
 from bup import _helpers
 from bup.helpers import *
 
 BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
 BLOB_READ_SIZE = 1024*1024
+MMAP_MIN_SIZE = 4*BLOB_READ_SIZE
+MMAP_WINDOW = 8*1024*1024
+HOLE_MIN_SIZE = BLOB_READ_SIZE
 MAX_PER_TREE = 256
 progress_callback = None
 fanout = 16
@@ -13,32 +18,265 @@ GIT_MODE_TREE = 040000
 GIT_MODE_SYMLINK = 0120000
 assert(GIT_MODE_TREE != 40000)  # 0xxx should be treated as octal
 
-# The purpose of this type of buffer is to avoid copying on peek(), get(),
-# and eat().  We do copy the buffer contents on put(), but that should
-# be ok if we always only put() large amounts of data at a time.
+
+# A chunker finds the content defined chunk boundaries: find_splits(buf)
+# returns the (end offset, bits) pairs for every boundary in buf as a
+# string of native uint32s (see _helpers.splitbuf_all()), where bits is
+# 0 for a chunk that was cut at max_size(), and is otherwise at least
+# basebits(), with each further fanout bits making the boundary one
+# level higher in the tree.  Which one a repository uses is recorded in
+# its config (see chunker_from_config()), because chunks only dedup
+# against chunks split the same way.
+class RollsumChunker:
+    """Split with bupsplit's rolling checksum, and cut at BLOB_MAX."""
+    name = 'rollsum'
+
+    def basebits(self):
+        return _helpers.blobbits()
+
+    def max_size(self):
+        return BLOB_MAX
+
+    def find_splits(self, buf):
+        return _helpers.splitbuf_all(buf, BLOB_MAX)
+
+    def config(self):
+        return [('bup.chunker', self.name)]
+
+
+class GearChunker:
+    """Split with a FastCDC style gear hash and normalized chunking."""
+    name = 'gear'
+
+    def __init__(self, min_size=2048, avg_size=8192, max_size=32768):
+        self.avg_bits = avg_size > 0 and int(round(math.log(avg_size, 2)))
+        if avg_size < 256 or avg_size != 1 << self.avg_bits:
+            raise ValueError('gear average chunk size %d is not a power of 2'
+                             ' of at least 256' % avg_size)
+        if not 0 <= min_size < avg_size < max_size <= BLOB_READ_SIZE:
+            raise ValueError('gear chunk sizes %d/%d/%d are not ordered'
+                             ' min < avg < max <= %d'
+                             % (min_size, avg_size, max_size, BLOB_READ_SIZE))
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self._max_size = max_size
+
+    def basebits(self):
+        return self.avg_bits
+
+    def max_size(self):
+        return self._max_size
+
+    def find_splits(self, buf):
+        return _helpers.gearsplit_all(buf, self.min_size, self.avg_bits,
+                                      self._max_size)
+
+    def config(self):
+        return [('bup.chunker', self.name),
+                ('bup.chunkMinSize', str(self.min_size)),
+                ('bup.chunkAvgSize', str(self.avg_size)),
+                ('bup.chunkMaxSize', str(self._max_size))]
+
+
+chunkers = {'rollsum': RollsumChunker, 'gear': GearChunker}
+chunker = RollsumChunker()
+
+
+def chunker_from_config(config_get):
+    """Return the chunker that the config_get(name) settings describe.
+
+    config_get returns the value of the given repository config setting
+    (e.g. git.git_config_get()), or None if it's unset.  Raise ValueError
+    if the settings are invalid.
+    """
+    name = config_get('bup.chunker') or 'rollsum'
+    if name not in chunkers:
+        raise ValueError('unknown bup.chunker %r (expected %s)'
+                         % (name, ' or '.join(sorted(chunkers))))
+    if name == 'rollsum':
+        return RollsumChunker()
+    sizes = {}
+    for key, size in (('min_size', 'bup.chunkMinSize'),
+                      ('avg_size', 'bup.chunkAvgSize'),
+                      ('max_size', 'bup.chunkMaxSize')):
+        val = config_get(size)
+        if val:
+            try:
+                sizes[key] = parse_num(val)
+            except ValueError:
+                raise ValueError('invalid %s %r' % (size, val))
+    return GearChunker(**sizes)
+
+
+# The purpose of this type of buffer is to avoid copying at all, other
+# than the read itself.  The storage is allocated once, reads land
+# directly in it via readinto() (when the file has one), and peek(),
+# get(), and eat() return or skip over views of it.  When there isn't
+# room for the next read, the unconsumed bytes (normally less than
+# BLOB_MAX) are moved to the front.  That means the views are only valid
+# until the next put() or fill().
 class Buf:
-    def __init__(self):
-        self.data = ''
+    def __init__(self, size=None):
+        self.data = bytearray(size or BLOB_READ_SIZE + BLOB_MAX)
+        self.view = memoryview(self.data)
+        self.start = self.end = 0
+
+    def _make_room(self, count):
+        if len(self.data) - self.end >= count:
+            return
+        used = self.used()
+        if used + count > len(self.data):
+            data = bytearray(max(used + count, len(self.data) * 2))
+            data[0:used] = self.view[self.start:self.end]
+            self.data = data
+            self.view = memoryview(self.data)
+        elif used:
+            self.view[0:used] = self.view[self.start:self.end]
         self.start = 0
+        self.end = used
 
     def put(self, s):
         if s:
-            self.data = buffer(self.data, self.start) + s
-            self.start = 0
-            
+            self._make_room(len(s))
+            self.view[self.end:self.end+len(s)] = s
+            self.end += len(s)
+
+    def fill(self, f, count):
+        """Append up to count bytes read from f, and return the number."""
+        self._make_room(count)
+        readinto = getattr(f, 'readinto', None)
+        if readinto:
+            n = readinto(self.view[self.end:self.end+count])
+        else:
+            b = f.read(count)
+            n = len(b)
+            self.view[self.end:self.end+n] = b
+        self.end += n
+        return n
+
     def peek(self, count):
-        return buffer(self.data, self.start, count)
-    
+        return buffer(self.data, self.start, min(count, self.used()))
+
     def eat(self, count):
         self.start += count
 
     def get(self, count):
-        v = buffer(self.data, self.start, count)
+        v = self.peek(count)
         self.start += count
         return v
 
     def used(self):
-        return len(self.data) - self.start
+        return self.end - self.start
+
+    def clear(self):
+        self.start = self.end = 0
+
+
+# Large regular files are mapped in windows instead of read, so that the
+# chunks handed to the hasher and compressor are views of the page cache
+# rather than copies.  Mapping starts at the file's current position (see
+# resume_split()), and each window starts at the allocation granularity
+# boundary at or before the first unconsumed byte, so no chunk ever
+# spans two windows, and as with Buf, views are only valid until the
+# next fill().  Touching a mapped page beyond the end of a file that has
+# shrunk (e.g. a log truncated by copytruncate) raises SIGBUS, so the
+# windows are kept fairly small, and the size is checked (see
+# unchanged()) before each window is mapped and before each view is
+# handed out.  Once it has changed, fill() returns 0, and the caller has
+# to read() the rest, starting at the first unconsumed byte, without
+# touching the map again.
+class MmapBuf:
+    def __init__(self, f, window=None):
+        self.f = f
+        self.fd = f.fileno()
+        self.size = os.fstat(self.fd).st_size
+        self.window = window or MMAP_WINDOW
+        assert(self.window > mmap.ALLOCATIONGRANULARITY + chunker.max_size())
+        self.map = None
+        self.ofs = f.tell()  # file offset of the start of the map
+        self.start = self.end = 0
+        self.changed = False
+
+    def _unmap(self):
+        if self.map:
+            _helpers.madvise_done(self.map)
+            self.map.close()
+            self.map = None
+
+    def fill(self, limit=None):
+        """Map the next window, and return the number of new bytes.
+
+        The window doesn't extend past the file offset limit, if given,
+        which must be beyond the end of the current one.
+        """
+        pos = self.ofs + self.start
+        end = self.ofs + self.end
+        if not self.unchanged():
+            return 0
+        if end >= self.size:
+            return 0
+        ofs = pos - pos % mmap.ALLOCATIONGRANULARITY
+        length = min(self.window, self.size - ofs)
+        if limit is not None:
+            assert(limit > end)
+            length = min(length, limit - ofs)
+        self._unmap()
+        fadvise_done(self.f, ofs)
+        self.map = mmap.mmap(self.fd, length, access=mmap.ACCESS_READ,
+                             offset=ofs)
+        _helpers.madvise_sequential(self.map)
+        self.ofs = ofs
+        self.start = pos - ofs
+        self.end = length
+        return ofs + length - end
+
+    def unchanged(self):
+        """Return true if the file is still the size it was when it was
+        opened, so the map is safe to read; otherwise set changed."""
+        if not self.changed and os.fstat(self.fd).st_size != self.size:
+            self.changed = True
+        return not self.changed
+
+    def peek(self, count):
+        return buffer(self.map, self.start, min(count, self.used()))
+
+    def eat(self, count):
+        self.start += count
+
+    def get(self, count):
+        v = self.peek(count)
+        self.start += count
+        return v
+
+    def used(self):
+        return self.end - self.start
+
+    def seek(self, pos):
+        """Drop the unconsumed bytes, and continue from file offset pos."""
+        self._unmap()
+        self.ofs = pos
+        self.start = self.end = 0
+
+    def close(self):
+        self._unmap()
+        fadvise_done(self.f, self.ofs + self.end)
+
+
+def _mmappable(files):
+    if not isinstance(files, (list, tuple)) or len(files) != 1:
+        return False
+    f = files[0]
+    if not hasattr(f, 'fileno'):
+        return False
+    try:
+        st = os.fstat(f.fileno())
+        return (stat.S_ISREG(st.st_mode)
+                and st.st_size - f.tell() >= MMAP_MIN_SIZE)
+    except (IOError, OSError, ValueError):
+        return False
+
+
+_spare_bufs = []
 
 
 def readfile_iter(files, progress=None):
@@ -57,36 +295,186 @@ def readfile_iter(files, progress=None):
             yield b
 
 
-def _splitbuf(buf, basebits, fanbits):
+def _fill_iter(buf, files, progress=None):
+    """Like readfile_iter(), but read into buf, and yield the byte counts."""
+    for filenum,f in enumerate(files):
+        ofs = 0
+        n = 0
+        while 1:
+            if progress:
+                progress(filenum, n)
+            fadvise_done(f, max(0, ofs - 1024*1024))
+            n = buf.fill(f, BLOB_READ_SIZE)
+            ofs += n
+            if not n:
+                fadvise_done(f, ofs)
+                break
+            yield n
+
+
+# Sparse files (e.g. VM images) can be mostly holes, and there's no
+# point in reading, splitting, and hashing gigabytes of zeros that aren't
+# even on disk.  Since the chunker never looks more than max_size() bytes
+# past a boundary, a chunk that starts at least that far from the end of
+# a hole is always the same one, the zero chunk (see _zero_chunk()).  So
+# whenever a chunk boundary falls in a large enough hole (found via
+# lseek(SEEK_HOLE/SEEK_DATA)), _mmap_split_iter() generates the zero
+# chunks the chunker would have found there, and then maps the rest of
+# the file starting right after the last one.  The resulting chunks, and
+# so the tree, are exactly the same as those for reading the zeros.
+class _ZeroChunk(str):
+    """A chunk of zeros that was generated for a hole instead of read."""
+
+
+_zero_chunks = {}
+
+
+def _zero_chunk(basebits, fanbits):
+    """Return the (blob, level) of a chunk that starts at least
+    chunker.max_size() bytes before the end of a run of zeros."""
+    key = (chunker, basebits, fanbits)
+    if key not in _zero_chunks:
+        zeros = '\0' * chunker.max_size()
+        splits = array('I', chunker.find_splits(zeros))
+        if splits and splits[1]:
+            end, level = splits[0], (splits[1]-basebits)//fanbits
+        else:
+            end, level = len(zeros), 0
+        _zero_chunks[key] = (_ZeroChunk(zeros[:end]), level)
+    return _zero_chunks[key]
+
+
+class _Holes:
+    """Find the holes of at least min_size bytes in the file fd."""
+    def __init__(self, fd, size, min_size):
+        self.fd = fd
+        self.size = size
+        self.min_size = min_size
+        self.start = self.end = 0
+
+    def next(self, pos):
+        """Return the (start, end) of the first hole that ends after
+        pos, or (size, size) if there isn't one."""
+        if pos < self.end:
+            return self.start, self.end
+        while pos < self.size:
+            start = _helpers.next_hole(self.fd, pos)
+            if start is None or start >= self.size:
+                break
+            end = _helpers.next_data(self.fd, start)
+            if end is None:
+                end = self.size
+            if end - start >= self.min_size:
+                self.start, self.end = start, end
+                return start, end
+            pos = end
+        self.start = self.end = self.size
+        return self.start, self.end
+
+
+def _file_holes(buf):
+    """Return the _Holes for buf's file, or None if it can't have any."""
+    if not hasattr(_helpers, 'next_hole'):
+        return None
+    st = os.fstat(buf.fd)
+    if st.st_blocks * 512 >= st.st_size:
+        return None
+    try:
+        if _helpers.next_hole(buf.fd, buf.ofs) >= buf.size:
+            return None  # e.g. a filesystem without SEEK_HOLE support
+    except (IOError, OSError):
+        return None
+    return _Holes(buf.fd, buf.size, max(HOLE_MIN_SIZE, chunker.max_size()))
+
+
+def _mmap_split_iter(buf, basebits, fanbits, progress=None):
+    holes = _file_holes(buf)
+    max_size = chunker.max_size()
+    n = 0
     while 1:
-        b = buf.peek(buf.used())
-        (ofs, bits) = _helpers.splitbuf(b)
-        if ofs:
-            if ofs > BLOB_MAX:
-                ofs = BLOB_MAX
-                level = 0
+        if progress:
+            progress(0, n)
+        limit = None
+        if holes:
+            pos = buf.ofs + buf.start  # always a chunk boundary
+            start, end = holes.next(pos)
+            if start <= pos:
+                blob, level = _zero_chunk(basebits, fanbits)
+                count = (end - pos - max_size) // len(blob) + 1
+                if count > 0:
+                    for i in xrange(count):
+                        yield blob, level
+                    buf.seek(pos + count * len(blob))
             else:
-                level = (bits-basebits)//fanbits  # integer division
-            buf.eat(ofs)
-            yield buffer(b, 0, ofs), level
-        else:
+                # Don't map (and split) much of the hole before skipping it
+                limit = start + max_size
+        n = buf.fill(limit)
+        if not n:
             break
-    while buf.used() >= BLOB_MAX:
+        for buf_and_level in _splitbuf(buf, basebits, fanbits,
+                                       buf.unchanged):
+            yield buf_and_level
+        if buf.changed:
+            break
+
+
+def _splitbuf(buf, basebits, fanbits, valid=None):
+    """Generate the chunks in buf, and consume them.  If valid is given,
+    stop (leaving the rest unconsumed) as soon as it returns false."""
+    b = buf.peek(buf.used())
+    # One call finds every boundary; (end, bits) pairs, bits 0 if forced.
+    splits = array('I', chunker.find_splits(b))
+    start = 0
+    for i in xrange(0, len(splits), 2):
+        if valid and not valid():
+            buf.eat(start)
+            return
+        end, bits = splits[i], splits[i+1]
+        if bits:
+            level = (bits-basebits)//fanbits  # integer division
+        else:
+            level = 0
+        yield buffer(b, start, end - start), level
+        start = end
+    buf.eat(start)
+    max_size = chunker.max_size()
+    while buf.used() >= max_size:
+        if valid and not valid():
+            return
         # limit max blob size
-        yield buf.get(BLOB_MAX), 0
+        yield buf.get(max_size), 0
 
 
 def _hashsplit_iter(files, progress):
-    assert(BLOB_READ_SIZE > BLOB_MAX)
-    basebits = _helpers.blobbits()
+    assert(BLOB_READ_SIZE > chunker.max_size())
+    basebits = chunker.basebits()
     fanbits = int(math.log(fanout or 128, 2))
-    buf = Buf()
-    for inblock in readfile_iter(files, progress):
-        buf.put(inblock)
-        for buf_and_level in _splitbuf(buf, basebits, fanbits):
-            yield buf_and_level
-    if buf.used():
-        yield buf.get(buf.used()), 0
+    if _mmappable(files):
+        buf = MmapBuf(files[0])
+        try:
+            for buf_and_level in _mmap_split_iter(buf, basebits, fanbits,
+                                                  progress):
+                yield buf_and_level
+            if buf.unchanged():
+                if buf.used():
+                    yield buf.get(buf.used()), 0
+                return
+            # The file changed size underneath us; read() the rest.
+            files[0].seek(buf.ofs + buf.start)
+        finally:
+            buf.close()
+    # Reuse buffers so that saving many small files doesn't allocate (and
+    # zero) a large one for each.
+    buf = _spare_bufs and _spare_bufs.pop() or Buf()
+    try:
+        for n in _fill_iter(buf, files, progress):
+            for buf_and_level in _splitbuf(buf, basebits, fanbits):
+                yield buf_and_level
+        if buf.used():
+            yield buf.get(buf.used()), 0
+    finally:
+        buf.clear()
+        _spare_bufs.append(buf)
 
 
 def _hashsplit_iter_keep_boundaries(files, progress):
@@ -103,6 +491,11 @@ def _hashsplit_iter_keep_boundaries(files, progress):
 
 
 def hashsplit_iter(files, keep_boundaries, progress):
+    """Generate (blob, level) for each chunk of the data in files.
+
+    Each blob is a view of an internal buffer that is only valid until the
+    next chunk is requested; use str(blob) to keep a copy.
+    """
     if keep_boundaries:
         return _hashsplit_iter_keep_boundaries(files, progress)
     else:
@@ -110,14 +503,47 @@ def hashsplit_iter(files, keep_boundaries, progress):
 
 
 total_split = 0
-def split_to_blobs(makeblob, files, keep_boundaries, progress):
+def split_to_blobs(makeblob, files, keep_boundaries, progress,
+                   makeblobs=None):
+    """Generate (sha, size, level) for each chunk of files, in order.
+
+    Each chunk is stored via makeblob(blob), unless makeblobs is given, in
+    which case it's called once with an iterator over all of the chunks
+    and must generate their ids in the same order (see
+    git.PackWriter.new_blobs()).  The zero chunks generated for holes
+    are all the same blob, so that's only stored (and hashed) once.
+    """
     global total_split
-    for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
-        sha = makeblob(blob)
-        total_split += len(blob)
+    chunks = hashsplit_iter(files, keep_boundaries, progress)
+    zero_ids = {}
+    def zero_id(blob):
+        if blob not in zero_ids:
+            zero_ids[blob] = makeblob(blob)
+        return zero_ids[blob]
+    def blob_ids(chunks):
+        if makeblobs:
+            sizes_and_levels = deque()
+            def blobs():
+                for (blob, level) in chunks:
+                    sizes_and_levels.append((len(blob), level))
+                    yield blob
+            return ((sha,) + sizes_and_levels.popleft()
+                    for sha in makeblobs(blobs()))
+        return ((makeblob(blob), len(blob), level) for (blob, level) in chunks)
+    def ids():
+        is_zero = lambda chunk: isinstance(chunk[0], _ZeroChunk)
+        for (zeros, group) in itertools.groupby(chunks, is_zero):
+            if zeros:
+                for (blob, level) in group:
+                    yield (zero_id(blob), len(blob), level)
+            else:
+                for id in blob_ids(group):
+                    yield id
+    for (sha, size, level) in ids():
+        total_split += size
         if progress_callback:
-            progress_callback(len(blob))
-        yield (sha, len(blob), level)
+            progress_callback(size)
+        yield (sha, size, level)
 
 
 def _make_shalist(l):
@@ -149,8 +575,10 @@ def _squish(maketree, stacks, n):
 
 
 def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+                     keep_boundaries, progress=None, makeblobs=None,
+                     stacks=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress,
+                        makeblobs=makeblobs)
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -158,7 +586,7 @@ def split_to_shalist(makeblob, maketree, files,
             shal.append((GIT_MODE_FILE, sha, size))
         return _make_shalist(shal)[0]
     else:
-        stacks = [[]]
+        stacks = stacks or [[]]
         for (sha,size,level) in sl:
             stacks[0].append((GIT_MODE_FILE, sha, size))
             _squish(maketree, stacks, level)
@@ -169,9 +597,11 @@ def split_to_shalist(makeblob, maketree, files,
 
 
 def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
+                          keep_boundaries, progress=None, makeblobs=None,
+                          stacks=None):
     shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+                                    files, keep_boundaries, progress,
+                                    makeblobs=makeblobs, stacks=stacks))
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
@@ -180,6 +610,98 @@ def split_to_blob_or_tree(makeblob, maketree, files,
         return (GIT_MODE_TREE, maketree(shalist))
 
 
+# When a file has only grown since it was saved, all of its old chunks
+# but the last one come out the same when it's split again, because the
+# chunkers start afresh at each boundary.  So resume_split() rebuilds
+# split_to_shalist()'s stacks as they were just before the last old
+# chunk, by replaying the old tree's subtrees (the entries along its
+# right edge), and the file only has to be split from there.  Where a
+# subtree ended up in the stacks isn't recorded in the tree, but follows
+# from the level of its last chunk, except for subtrees that were closed
+# early because they reached MAX_PER_TREE, whose entries are replayed
+# one by one instead.  Each of those last chunks is read back to find
+# its level, and compared to the file, which doubles as a sample check
+# that the file really was only appended to.
+RESUME_MAX_READS = 4096
+
+
+def _last_chunk(readtree, entries, ofs):
+    while 1:
+        (mode, o, sha) = entries[-1]
+        ofs += o
+        if mode != GIT_MODE_TREE:
+            return (sha, ofs)
+        entries = readtree(sha)
+
+
+def _subtrees(entries, ofs, size):
+    for i, (mode, o, sha) in enumerate(entries):
+        end = entries[i+1][1] if i + 1 < len(entries) else size
+        yield (mode, sha, ofs + o, end - o)
+
+
+def _same_data(f, ofs, data):
+    f.seek(ofs)
+    return f.read(len(data)) == data
+
+
+def resume_split(readtree, readblob, maketree, sha, f):
+    """Prepare to split f again, reusing the chunks it had when it was
+    saved as the chunk tree sha.
+
+    readtree(sha) returns the (mode, offset, sha) entries of a chunk tree,
+    and readblob(sha) the content of a chunk.  Return the stacks to pass
+    to split_to_shalist(), with f positioned where it should continue,
+    or None if f doesn't appear to be the old content with more appended.
+    """
+    basebits = chunker.basebits()
+    fanbits = int(math.log(fanout or 128, 2))
+    todo = []
+    ofs = 0
+    entries = readtree(sha)
+    while 1:
+        todo.extend(_subtrees(entries[:-1], ofs, entries[-1][1]))
+        (mode, o, sha) = entries[-1]
+        ofs += o
+        if mode != GIT_MODE_TREE:
+            break
+        entries = readtree(sha)
+    last = readblob(sha)
+    f.seek(0, 2)
+    if f.tell() <= ofs + len(last) or not _same_data(f, ofs, last):
+        return None
+    stacks = [[]]
+    reads = 0
+    todo.reverse()
+    while todo:
+        (mode, sha, o, size) = todo.pop()
+        if mode == GIT_MODE_TREE:
+            entries = readtree(sha)
+            if len(entries) >= MAX_PER_TREE:
+                todo.extend(reversed(list(_subtrees(entries, o, size))))
+                continue
+            chunk_sha, chunk_ofs = _last_chunk(readtree, entries, o)
+        else:
+            chunk_sha, chunk_ofs = sha, o
+        reads += 1
+        if reads > RESUME_MAX_READS:
+            return None
+        chunk = readblob(chunk_sha)
+        if not _same_data(f, chunk_ofs, chunk):
+            return None
+        splits = array('I', chunker.find_splits(chunk))
+        bits = 0
+        if splits:
+            if len(splits) != 2 or splits[0] != len(chunk):
+                return None
+            bits = splits[1]
+        level = bits and (bits-basebits)//fanbits
+        stacks[0].append((mode, sha, size))
+        _squish(maketree, stacks, level)
+    f.seek(ofs)
+    return stacks
+
+
 def open_noatime(name):
     fd = _helpers.open_noatime(name)
     try:
@@ -3,7 +3,8 @@
 from ctypes import sizeof, c_void_p
 from os import environ
 import sys, os, pwd, subprocess, errno, socket, select, mmap, stat, re, struct
-import hashlib, heapq, operator, time, grp
+import fcntl
+import hashlib, heapq, operator, time, grp, threading, Queue
 
 from bup import _helpers
 import bup._helpers as _helpers
@@ -234,6 +235,77 @@ def merge_iter(iters, pfreq, pfunc, pfinal, key=None):
     pfinal(count, total)
 
 
+class WorkerPool:
+    """A fixed set of threads that run functions on behalf of the caller.
+
+    This only helps when the functions spend most of their time in code
+    that releases the GIL (zlib, hashlib, I/O, most of _helpers, ...).
+    The threads are started on first use and live until close() is called.
+    """
+    def __init__(self, jobs):
+        assert(jobs >= 1)
+        self.jobs = jobs
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()  # imap() may be called by any thread
+
+    def _work(self):
+        while 1:
+            task = self._tasks.get()
+            if not task:
+                return
+            func, arg, result = task
+            try:
+                result.put((True, func(arg)))
+            except:
+                result.put((False, sys.exc_info()))
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.jobs:
+                t = threading.Thread(target=self._work)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def imap(self, func, iterable, lookahead=None):
+        """Generate func(x) for each x in iterable, in order.
+
+        The iterable itself is consumed by the calling thread, but up to
+        'lookahead' (default 4 * jobs) calls to func may be in flight at
+        once.  Any exception raised by func is re-raised in the caller when
+        its result is reached.
+        """
+        self._start()
+        if not lookahead:
+            lookahead = 4 * self.jobs
+        pending = []
+        it = iter(iterable)
+        while 1:
+            while it and len(pending) < lookahead:
+                x = next(it, _unspecified_next_default)
+                if x is _unspecified_next_default:
+                    it = None
+                    break
+                result = Queue.Queue(1)
+                self._tasks.put((func, x, result))
+                pending.append(result)
+            if not pending:
+                break
+            ok, v = pending.pop(0).get()
+            if not ok:
+                raise v[0], v[1], v[2]
+            yield v
+
+    def close(self):
+        """Stop the worker threads once they have finished their tasks."""
+        for t in self._threads:
+            self._tasks.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
 def unlink(f):
     """Delete a file at path 'f' if it currently exists.
 
@@ -684,6 +756,41 @@ def chunkyreader(f, count = None):
             yield b
 
 
+_zeros = ''
+
+
+def write_sparsely(f, blocks):
+    """Write each of the strings in 'blocks' to the file 'f', but seek
+    past the ones that are all zeros instead, leaving holes (where the
+    filesystem supports them).
+
+    'f' must be seekable, and any bytes it already has after its current
+    position will read as zeros where blocks were skipped, so it should
+    normally be a new or truncated file.  If the last blocks are skipped,
+    'f' is extended to cover them via truncate().  If 'f' was opened for
+    appending, where seeks don't move the writes, everything is written.
+    """
+    global _zeros
+    if fcntl.fcntl(f.fileno(), fcntl.F_GETFL) & os.O_APPEND:
+        for b in blocks:
+            f.write(b)
+        return
+    skipped = 0
+    for b in blocks:
+        if len(b) > len(_zeros):
+            _zeros = '\0' * len(b)
+        if buffer(b) == buffer(_zeros, 0, len(b)):
+            skipped += len(b)
+            continue
+        if skipped:
+            f.seek(skipped, 1)
+            skipped = 0
+        f.write(b)
+    if skipped:
+        f.seek(skipped, 1)
+        f.truncate()
+
+
 def slashappend(s):
     """Append "/" to 's' if it doesn't aleady end in "/"."""
     if s and not s.endswith('/'):
@@ -854,6 +961,59 @@ def parse_date_or_fatal(str, fatal):
         return date
 
 
+def _path_parts(path):
+    path = os.path.normpath(path)
+    if path == '.':
+        return []
+    parts = [x for x in path.split('/') if x]
+    if path.startswith('/'):
+        parts.insert(0, '/')
+    return parts
+
+
+class ExcludedPaths:
+    """A set of --exclude paths, kept as a tree of path components.
+
+    Membership tests normalize the path (via os.path.normpath()), and a
+    directory walk can follow the tree (see child()) to check each entry
+    by name, and to skip the checks entirely in subtrees that don't
+    contain any excluded paths.
+    """
+    def __init__(self, paths=()):
+        self.excluded = False
+        self.children = {}
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        node = self
+        for part in _path_parts(path):
+            node = node.children.setdefault(part, ExcludedPaths())
+        node.excluded = True
+
+    def find(self, path):
+        """Return the node for path, or None if nothing at or below path
+        is excluded."""
+        node = self
+        for part in _path_parts(path):
+            node = node.children.get(part)
+            if not node:
+                return None
+        return node
+
+    def child(self, name):
+        """Return the node for name (a single path component, optionally
+        followed by '/'), or None if nothing at or below it is excluded."""
+        return self.children.get(name.rstrip('/'))
+
+    def __contains__(self, path):
+        node = self.find(path)
+        return bool(node and node.excluded)
+
+    def __nonzero__(self):
+        return self.excluded or bool(self.children)
+
+
 def parse_excludes(options, fatal):
     """Traverse the options and extract all excludes, or call Option.fatal()."""
     excluded_paths = []
@@ -900,16 +1060,60 @@ def parse_rx_excludes(options, fatal):
                     excluded_patterns.append(re.compile(spattern))
                 except re.error, ex:
                     fatal('invalid --exclude-rx pattern (%s): %s' % (spattern, ex))
-    return excluded_patterns
+    return RxExcludes(excluded_patterns)
+
+
+class RxExcludes(list):
+    """A list of compiled --exclude-rx patterns, that can check a path
+    against all of them at once (see search()).
+
+    The patterns without groups or flags of their own are combined into
+    a single alternation, so only the rest have to be tried one by one.
+    The list shouldn't be modified after the first search().
+    """
+    def __init__(self, patterns=()):
+        list.__init__(self, patterns)
+        self._combined = self._others = None
+
+    def _compile(self):
+        simple = [rx for rx in self if not rx.groups and not rx.flags]
+        self._others = [rx for rx in self if rx.groups or rx.flags]
+        self._simple = simple
+        self._combined = False
+        if simple:
+            try:
+                self._combined = re.compile('|'.join('(?:%s)' % rx.pattern
+                                                     for rx in simple))
+            except (re.error, OverflowError, RuntimeError):
+                self._simple = []
+                self._others = list(self)
+
+    def search(self, path):
+        """Return the first pattern (in the same order as the list, among
+        those combined, and then among the rest) that matches somewhere
+        in path, or None."""
+        if self._combined is None:
+            self._compile()
+        if self._combined and self._combined.search(path):
+            for rx in self._simple:
+                if rx.search(path):
+                    return rx
+        for rx in self._others:
+            if rx.search(path):
+                return rx
+        return None
 
 
 def should_rx_exclude_path(path, exclude_rxs):
     """Return True if path matches a regular expression in exclude_rxs."""
-    for rx in exclude_rxs:
-        if rx.search(path):
-            debug1('Skipping %r: excluded by rx pattern %r.\n'
-                   % (path, rx.pattern))
-            return True
+    if isinstance(exclude_rxs, RxExcludes):
+        rx = exclude_rxs.search(path)
+    else:
+        rx = next((rx for rx in exclude_rxs if rx.search(path)), None)
+    if rx:
+        debug1('Skipping %r: excluded by rx pattern %r.\n'
+               % (path, rx.pattern))
+        return True
     return False
 
 
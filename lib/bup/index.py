@@ -1,11 +1,15 @@
-import metadata, os, stat, struct, tempfile
+import errno, fcntl, itertools, metadata, os, re, stat, struct, tempfile, time
 from bup import xstat
 from bup.helpers import *
 
 EMPTY_SHA = '\0'*20
 FAKE_SHA = '\x01'*20
 
-INDEX_HDR = 'BUPI\0\0\0\5'
+INDEX_HDR = 'BUPI\0\0\0\6'
+# The header is followed by the length of the index proper, i.e. where
+# its journal (if any) starts.
+INDEX_LEN_SIG = '!Q'
+INDEX_HDRLEN = len(INDEX_HDR) + struct.calcsize(INDEX_LEN_SIG)
 
 # Time values are handled as integer nanoseconds since the epoch in
 # memory, but are written as xstat/metadata timespecs.  This behavior
@@ -20,14 +24,126 @@ ENTLEN = struct.calcsize(INDEX_SIG)
 FOOTER_SIG = '!Q'
 FOOTLEN = struct.calcsize(FOOTER_SIG)
 
+# The INDEX_SIG fields, in order; the times are (secs, nsecs) pairs.
+_entry_field_names = ('dev', 'ino', 'nlink', 'ctime', 'mtime', 'atime',
+                      'uid', 'gid', 'size', 'mode', 'gitmode', 'sha',
+                      'flags', 'children_ofs', 'children_n', 'meta_ofs')
+
+def _entry_field_table():
+    """Return a dict mapping each INDEX_SIG field name to the struct
+    format, offset, and conversion function (if any) to decode it."""
+    codes = re.findall(r'\d*[a-zA-Z]', INDEX_SIG[1:])
+    fields = {}
+    i = 0
+    for field in _entry_field_names:
+        n = field.endswith('time') and 2 or 1
+        fmt = '!' + ''.join(codes[i:i+n])
+        ofs = struct.calcsize('!' + ''.join(codes[:i]))
+        fields[field] = (fmt, ofs, n == 2 and xstat.timespec_to_nsecs or None)
+        i += n
+    assert(i == len(codes))
+    return fields
+
+_entry_fields = _entry_field_table()
+
+def _unpack_entry(m, ofs):
+    """Return a dict of all of the fields of the entry packed at m[ofs:]."""
+    (dev, ino, nlink, ctime, ctime_ns, mtime, mtime_ns, atime, atime_ns,
+     uid, gid, size, mode, gitmode, sha, flags, children_ofs, children_n,
+     meta_ofs) = struct.unpack_from(INDEX_SIG, m, ofs)
+    return dict(dev=dev, ino=ino, nlink=nlink,
+                ctime=xstat.timespec_to_nsecs((ctime, ctime_ns)),
+                mtime=xstat.timespec_to_nsecs((mtime, mtime_ns)),
+                atime=xstat.timespec_to_nsecs((atime, atime_ns)),
+                uid=uid, gid=gid, size=size, mode=mode, gitmode=gitmode,
+                sha=sha, flags=flags, children_ofs=children_ofs,
+                children_n=children_n, meta_ofs=meta_ofs)
+
 IX_EXISTS = 0x8000        # file exists on filesystem
 IX_HASHVALID = 0x4000     # the stored sha1 matches the filesystem
 IX_SHAMISSING = 0x2000    # the stored sha1 object doesn't seem to exist
 
+# The metadata store's hash table (see MetaHashTable) starts with a
+# header holding the size of the store it covers (or META_HASH_DIRTY while
+# it's being updated), the number of slots, and the number of slots used.
+META_HASH_HDR = 'BUPMH\0\0\1'
+META_HASH_SIG = '!QQQ'
+META_HASH_HDRLEN = len(META_HASH_HDR) + struct.calcsize(META_HASH_SIG)
+META_HASH_DIRTY = 2**64 - 1
+# Each slot holds a record's sha1 and its offset + 1 (0 means empty).
+META_HASH_SLOT = '!20s4xQ'
+META_HASH_SLOTLEN = struct.calcsize(META_HASH_SLOT)
+META_HASH_MIN_SLOTS = 1024
+
+# The path table (see PathTable) starts with a header holding the
+# identity of the index it was built from (see index_ident()), followed by
+# a record for each entry: the start of the sha1 of its full name, and its
+# offset.
+PATH_TABLE_HDR = 'BUPP\0\0\0\2'
+PATH_TABLE_SIG = '!QQqq'
+PATH_TABLE_HDRLEN = len(PATH_TABLE_HDR) + struct.calcsize(PATH_TABLE_SIG)
+PATH_TABLE_REC = '!8sQ'
+PATH_TABLE_RECLEN = struct.calcsize(PATH_TABLE_REC)
+# Reader.find() builds a path table for indexes with at least this many
+# entries; smaller ones are just searched from the root.
+path_table_min_entries = 10000
+
+# Each batch of entries in the journal is followed by a trailer holding
+# the offset of the end of the trailer, and a magic number.
+JOURNAL_TRAILER_SIG = '!Q8s'
+JOURNAL_TRAILER_LEN = struct.calcsize(JOURNAL_TRAILER_SIG)
+JOURNAL_MAGIC = 'BUPJ\0\0\0\1'
+
+# Entries added to an index go to its journal (see Journal), unless that
+# would make the journal hold more than this fraction of the index (or
+# than journal_min_entries, if that's more); then everything is merged
+# into a new index instead.
+journal_max_ratio = 0.1
+journal_min_entries = 1000
+
+# 'bup index' compacts the metadata store when it's at least this big and
+# less than this fraction of its records are still referenced.
+meta_compact_min_size = 16 * 1024 * 1024
+meta_compact_ratio = 0.5
+
 class Error(Exception):
     pass
 
 
+class Lock:
+    """A lock on an index and the files kept next to it, held via flock()
+    on e.g. bupindex.lock.  Commands that read or update the index hold
+    it shared, and compact_meta() needs it exclusively, since it swaps
+    the index and its metadata store out from under any other users.
+    The lock goes away when the Lock is closed.
+    """
+    def __init__(self, indexfile):
+        self._file = open(indexfile + '.lock', 'a')
+
+    def acquire(self, exclusive=False, wait=True):
+        """Take the lock (or convert a lock already held), and return
+        True, or return False if wait is false and it's held elsewhere.
+        Note that a failed conversion may drop the lock already held."""
+        op = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not wait:
+            op |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._file.fileno(), op)
+        except IOError, e:
+            if not wait and e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def __del__(self):
+        self.close()
+
+
 class MetaStoreReader:
     def __init__(self, filename):
         self._file = None
@@ -46,40 +162,186 @@ class MetaStoreReader:
         return metadata.Metadata.read(self._file)
 
 
+class MetaHashTable:
+    """An mmapped hash table, kept next to a metadata store, that maps the
+    sha1 of each encoded record in the store to its offset.
+
+    The header records how much of the store the table covers, so a
+    MetaStoreWriter only has to read records appended since then (or the
+    whole store, if the table is missing or was left dirty).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.slots = self.used = 0
+        self.dirty = False
+        self._file = self._map = None
+
+    def open(self):
+        """Map an existing table, and return the size of the store it
+        covers, or None if it's missing or can't be used."""
+        try:
+            f = open(self.filename, 'r+b')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        hdr = f.read(META_HASH_HDRLEN)
+        if len(hdr) == META_HASH_HDRLEN and hdr.startswith(META_HASH_HDR):
+            covered, slots, used = struct.unpack(META_HASH_SIG,
+                                                 hdr[len(META_HASH_HDR):])
+            size = os.fstat(f.fileno()).st_size
+            if covered != META_HASH_DIRTY and slots and not slots & (slots-1) \
+               and size == META_HASH_HDRLEN + slots * META_HASH_SLOTLEN:
+                self._file = f
+                self._map = mmap_readwrite(f, close=False)
+                self.slots, self.used = slots, used
+                return covered
+        f.close()
+        return None
+
+    def create(self, expected):
+        """Replace the table with an empty one for `expected` records."""
+        slots = META_HASH_MIN_SLOTS
+        while slots < expected * 2:
+            slots *= 2
+        self._replace(self._new(slots))
+
+    def _new(self, slots):
+        (dir, name) = os.path.split(self.filename)
+        (fd, tmpname) = tempfile.mkstemp('.tmp', name, dir or '.')
+        f = os.fdopen(fd, 'w+b')
+        f.write(META_HASH_HDR)
+        f.write(struct.pack(META_HASH_SIG, META_HASH_DIRTY, slots, 0))
+        f.truncate(META_HASH_HDRLEN + slots * META_HASH_SLOTLEN)
+        return (tmpname, f, mmap_readwrite(f, close=False), slots)
+
+    def _replace(self, new):
+        (tmpname, f, map, slots) = new
+        self._close_map()
+        os.rename(tmpname, self.filename)
+        self._file, self._map, self.slots = f, map, slots
+        self.used = 0
+        self.dirty = True
+
+    def _find(self, map, slots, digest):
+        """Return the position of digest's slot in map, or of the empty
+        slot where it belongs."""
+        mask = slots - 1
+        i = struct.unpack('!Q', digest[:8])[0] & mask
+        while 1:
+            pos = META_HASH_HDRLEN + i * META_HASH_SLOTLEN
+            if map[pos+24:pos+32] == '\0' * 8 or map[pos:pos+20] == digest:
+                return pos
+            i = (i + 1) & mask
+
+    def get(self, digest):
+        """Return the offset of the record with the given sha1, or None."""
+        pos = self._find(self._map, self.slots, digest)
+        ofs = struct.unpack('!Q', self._map[pos+24:pos+32])[0]
+        if not ofs:
+            return None
+        return ofs - 1
+
+    def add(self, digest, ofs):
+        if not self.dirty:
+            # If we don't get to close() (and record what's covered), the
+            # next writer has to rebuild the table.
+            self._map[len(META_HASH_HDR):len(META_HASH_HDR)+8] = \
+                struct.pack('!Q', META_HASH_DIRTY)
+            self._map.flush()
+            self.dirty = True
+        pos = self._find(self._map, self.slots, digest)
+        if self._map[pos+24:pos+32] != '\0' * 8:
+            return
+        self._map[pos:pos+META_HASH_SLOTLEN] = \
+            struct.pack(META_HASH_SLOT, digest, ofs + 1)
+        self.used += 1
+        if self.used * 2 > self.slots:
+            self._grow()
+
+    def _grow(self):
+        new = self._new(self.slots * 2)
+        (tmpname, f, map, slots) = new
+        old = self._map
+        for pos in xrange(META_HASH_HDRLEN, len(old), META_HASH_SLOTLEN):
+            slot = old[pos:pos+META_HASH_SLOTLEN]
+            if slot[24:] != '\0' * 8:
+                newpos = self._find(map, slots, slot[:20])
+                map[newpos:newpos+META_HASH_SLOTLEN] = slot
+        used = self.used
+        self._replace(new)
+        self.used = used
+
+    def _close_map(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def close(self, covered):
+        """Record that the table covers the first `covered` bytes of the
+        store, and close it."""
+        if self._map and self.dirty:
+            self._map.flush()
+            self._map[len(META_HASH_HDR):META_HASH_HDRLEN] = \
+                struct.pack(META_HASH_SIG, covered, self.slots, self.used)
+            self._map.flush()
+            self.dirty = False
+        self._close_map()
+
+
 class MetaStoreWriter:
     # For now, we just append to the file, and try to handle any
     # truncation or corruption somewhat sensibly.
 
     def __init__(self, filename):
-        # Map metadata hashes to bupindex.meta offsets.
-        self._offsets = {}
         self._filename = filename
         self._file = None
-        # FIXME: see how slow this is; does it matter?
-        m_file = open(filename, 'ab+')
-        try:
-            m_file.seek(0)
-            try:
-                m_off = m_file.tell()
-                m = metadata.Metadata.read(m_file)
-                while m:
-                    m_encoded = m.encode()
-                    self._offsets[m_encoded] = m_off
-                    m_off = m_file.tell()
-                    m = metadata.Metadata.read(m_file)
-            except EOFError:
-                pass
-            except:
-                log('index metadata in %r appears to be corrupt' % filename)
-                raise
-        finally:
-            m_file.close()
+        # Maps metadata hashes to bupindex.meta offsets; see _open_table().
+        self._table = None
         self._file = open(filename, 'ab')
 
+    def _open_table(self):
+        table = MetaHashTable(self._filename + '.hash')
+        size = os.fstat(self._file.fileno()).st_size
+        covered = table.open()
+        if covered is None or covered > size:
+            debug1('index: rebuilding %s\n' % table.filename)
+            table.create(size / 64)
+            covered = 0
+        if covered < size:
+            m_file = open(self._filename, 'rb')
+            try:
+                m_file.seek(covered)
+                try:
+                    while 1:
+                        m_off = m_file.tell()
+                        # None is an empty (but valid) record.
+                        m = metadata.Metadata.read(m_file) \
+                            or metadata.Metadata()
+                        m_encoded = m.encode(include_path=False)
+                        table.add(Sha1(m_encoded).digest(), m_off)
+                except EOFError:
+                    pass
+                except:
+                    log('index metadata in %r appears to be corrupt'
+                        % self._filename)
+                    raise
+            finally:
+                m_file.close()
+        self._table = table
+
     def close(self):
         if self._file:
+            self._file.flush()
+            size = os.fstat(self._file.fileno()).st_size
             self._file.close()
             self._file = None
+            if self._table:
+                self._table.close(size)
+                self._table = None
 
     def __del__(self):
         # Be optimistic.
@@ -87,12 +349,17 @@ class MetaStoreWriter:
 
     def store(self, metadata):
         meta_encoded = metadata.encode(include_path=False)
-        ofs = self._offsets.get(meta_encoded)
-        if ofs:
+        if not self._file:
+            self._file = open(self._filename, 'ab')
+        if not self._table:
+            self._open_table()
+        digest = Sha1(meta_encoded).digest()
+        ofs = self._table.get(digest)
+        if ofs is not None:
             return ofs
         ofs = self._file.tell()
         self._file.write(meta_encoded)
-        self._offsets[meta_encoded] = ofs
+        self._table.add(digest, ofs)
         return ofs
 
 
@@ -143,7 +410,12 @@ def _golevel(level, f, ename, newentry, metastore, tmax):
     return level
 
 
-class Entry:
+class Entry(object):
+    __slots__ = ('basename', 'name', 'meta_ofs', 'tmax',
+                 'children_ofs', 'children_n', 'dev', 'ino', 'nlink',
+                 'ctime', 'mtime', 'atime', 'uid', 'gid', 'size', 'mode',
+                 'gitmode', 'sha', 'flags')
+
     def __init__(self, basename, name, meta_ofs, tmax):
         self.basename = str(basename)
         self.name = str(name)
@@ -160,6 +432,9 @@ class Entry:
                    self.flags, self.meta_ofs,
                    self.children_ofs, self.children_n))
 
+    def _decode(self):
+        pass
+
     def packed(self):
         try:
             ctime = xstat.nsecs_to_timespec(self.ctime)
@@ -224,6 +499,11 @@ class Entry:
         f = IX_HASHVALID|IX_EXISTS
         return (self.flags & f) == f
 
+    def identity(self, check_device=True):
+        """Return the entry's key in Reader.hashes_by_identity()."""
+        return _identity(self.dev, self.ino, self.size, self.mtime,
+                         self.ctime, check_device)
+
     def invalidate(self):
         self.flags &= ~IX_HASHVALID
 
@@ -264,6 +544,8 @@ class Entry:
 
 
 class NewEntry(Entry):
+    __slots__ = ()
+
     def __init__(self, basename, name, tmax, dev, ino, nlink,
                  ctime, mtime, atime,
                  uid, gid, size, mode, gitmode, sha, flags, meta_ofs,
@@ -278,6 +560,8 @@ class NewEntry(Entry):
 
 
 class BlankNewEntry(NewEntry):
+    __slots__ = ()
+
     def __init__(self, basename, meta_ofs, tmax):
         NewEntry.__init__(self, basename, basename, tmax,
                           0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
@@ -285,19 +569,47 @@ class BlankNewEntry(NewEntry):
 
 
 class ExistingEntry(Entry):
+    """An entry in an index (or journal) map.
+
+    The packed fields are only decoded when they're first used (see
+    __getattr__()), since most walks through an index only look at a
+    few of them.
+    """
+    __slots__ = ('parent', '_m', '_ofs')
+
     def __init__(self, parent, basename, name, m, ofs):
-        Entry.__init__(self, basename, name, None, None)
+        self.basename = str(basename)
+        self.name = str(name)
+        self.tmax = None
         self.parent = parent
         self._m = m
         self._ofs = ofs
-        (self.dev, self.ino, self.nlink,
-         self.ctime, ctime_ns, self.mtime, mtime_ns, self.atime, atime_ns,
-         self.uid, self.gid, self.size, self.mode, self.gitmode, self.sha,
-         self.flags, self.children_ofs, self.children_n, self.meta_ofs
-         ) = struct.unpack(INDEX_SIG, str(buffer(m, ofs, ENTLEN)))
-        self.atime = xstat.timespec_to_nsecs((self.atime, atime_ns))
-        self.mtime = xstat.timespec_to_nsecs((self.mtime, mtime_ns))
-        self.ctime = xstat.timespec_to_nsecs((self.ctime, ctime_ns))
+
+    def __getattr__(self, field):
+        # Only called for fields that haven't been decoded (or set) yet.
+        try:
+            (fmt, ofs, convert) = _entry_fields[field]
+        except KeyError:
+            raise AttributeError(field)
+        val = struct.unpack_from(fmt, self._m, self._ofs + ofs)
+        val = convert(val) if convert else val[0]
+        setattr(self, field, val)
+        return val
+
+    def _decode(self):
+        """Decode all of the fields that haven't been decoded yet."""
+        vals = None
+        for field in _entry_field_names:
+            try:
+                object.__getattribute__(self, field)
+            except AttributeError:
+                if not vals:
+                    vals = _unpack_entry(self._m, self._ofs)
+                setattr(self, field, vals[field])
+
+    def packed(self):
+        self._decode()
+        return Entry.packed(self)
 
     # effectively, we don't bother messing with IX_SHAMISSING if
     # not IX_HASHVALID, since it's redundant, and repacking is more
@@ -350,14 +662,283 @@ class ExistingEntry(Entry):
 
     def __iter__(self):
         return self.iter()
-            
+
+    def _child(self, basename):
+        """Return the child entry called basename, or None."""
+        ofs = self.children_ofs
+        for i in xrange(self.children_n):
+            eon = self._m.find('\0', ofs)
+            assert(eon > ofs)
+            if self._m[ofs:eon] == basename:
+                return ExistingEntry(self, basename, self.name + basename,
+                                     self._m, eon+1)
+            ofs = eon + 1 + ENTLEN
+        return None
+
+
+class FoundEntry(ExistingEntry):
+    """An entry looked up by name (see Reader.find()), whose parent is
+    only looked up when it has to be invalidated."""
+    __slots__ = ('_reader',)
+
+    def __init__(self, reader, name, m, ofs):
+        ExistingEntry.__init__(self, None, pathsplit(name)[-1], name, m, ofs)
+        self._reader = reader
+
+    def repack(self):
+        self._m[self._ofs:self._ofs+ENTLEN] = self.packed()
+        if not self.is_valid() and self.name != '/':
+            # The parent lives in the index or the journal; find it there.
+            parent = self._reader.find(parent_name(self.name))
+            if parent and parent.is_valid():
+                parent.invalidate()
+                parent.repack()
+
+
+class JournalEntry(FoundEntry):
+    __slots__ = ()
+
+    def iter(self, name=None, wantrecurse=None):
+        # Children are separate journal entries, found by Reader.iter().
+        return iter([])
+
+
+class PathTable:
+    """A table of an index's entry offsets, sorted by (a hash of) the
+    entries' full names, so that Reader.find() can look them up without
+    walking the tree.
+
+    The table (e.g. bupindex.paths) is kept next to the index, and its
+    header identifies the index it was built from (see index_ident()), so
+    a table left over from an index that's since been rewritten is
+    ignored (and rebuilt).  Entries appended to the index's journal aren't
+    included.
+    """
+    def __init__(self, filename, ident):
+        self.filename = filename
+        self.ident = ident
+        self.m = None
+        self.count = 0
+        try:
+            f = open(filename, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        hdr = f.read(PATH_TABLE_HDRLEN)
+        size = os.fstat(f.fileno()).st_size
+        if len(hdr) == PATH_TABLE_HDRLEN and hdr.startswith(PATH_TABLE_HDR) \
+           and struct.unpack(PATH_TABLE_SIG,
+                             hdr[len(PATH_TABLE_HDR):]) == ident \
+           and not (size - PATH_TABLE_HDRLEN) % PATH_TABLE_RECLEN:
+            self.m = mmap_read(f)
+            self.count = (size - PATH_TABLE_HDRLEN) / PATH_TABLE_RECLEN
+        else:
+            f.close()
+
+    def build(self, entries):
+        """Replace the table with one for entries, an iterable of (name,
+        offset) pairs."""
+        recs = sorted(struct.pack(PATH_TABLE_REC, _path_key(name), ofs)
+                      for name, ofs in entries)
+        (dir, name) = os.path.split(self.filename)
+        (fd, tmpname) = tempfile.mkstemp('.tmp', name, dir or '.')
+        f = os.fdopen(fd, 'wb', 65536)
+        try:
+            f.write(PATH_TABLE_HDR + struct.pack(PATH_TABLE_SIG, *self.ident))
+            for rec in recs:
+                f.write(rec)
+            f.close()
+            os.rename(tmpname, self.filename)
+        except:
+            f.close()
+            os.unlink(tmpname)
+            raise
+        self.close()
+        self.__init__(self.filename, self.ident)
+
+    def restamp(self, ident):
+        """Record that the table is valid for the index with identity
+        ident (the same index, after its entries were updated in place)."""
+        f = open(self.filename, 'r+b')
+        try:
+            f.seek(len(PATH_TABLE_HDR))
+            f.write(struct.pack(PATH_TABLE_SIG, *ident))
+        finally:
+            f.close()
+        self.ident = ident
+
+    def offsets(self, name):
+        """Return the offsets of the entries whose names hash like name's."""
+        key = _path_key(name)
+        m = self.m
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            ofs = PATH_TABLE_HDRLEN + mid * PATH_TABLE_RECLEN
+            if m[ofs:ofs+8] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        ofs = PATH_TABLE_HDRLEN + lo * PATH_TABLE_RECLEN
+        while ofs < len(m) and m[ofs:ofs+8] == key:
+            result.append(struct.unpack(PATH_TABLE_REC,
+                                        m[ofs:ofs+PATH_TABLE_RECLEN])[1])
+            ofs += PATH_TABLE_RECLEN
+        return result
+
+    def close(self):
+        if self.m:
+            self.m.close()
+        self.m = None
+        self.count = 0
+
+
+def _path_key(name):
+    return Sha1(name).digest()[:8]
+
+
+class Journal:
+    """The entries added to an index since the index was last written.
+
+    The journal is appended to the index file, after the footer (the
+    index's header says where that is).  It's a series of records (a full
+    path, a NUL, and a packed entry, as per INDEX_SIG), each batch of them
+    followed by a trailer (see JOURNAL_TRAILER_SIG).  If an append is
+    interrupted, the partly written batch after the last trailer is
+    ignored, and overwritten by the next append(); anything else that
+    doesn't parse is an Error.  A Reader overlays the journal on the
+    index, and entries found there can be repacked in place, like the
+    ones in the index.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.entries = {}
+        self.end = self._parse(reader.m, reader.end)
+
+    def _parse(self, m, start):
+        """Load the entries in the complete batches after start, and
+        return the end of the last one."""
+        size = len(m)
+        end = ofs = start
+        batch = []
+        while ofs < size:
+            if m[ofs] == '/':
+                eon = m.find('\0', ofs)
+                if eon < 0 or eon + 1 + ENTLEN > size:
+                    break
+                batch.append((m[ofs:eon], eon + 1))
+                ofs = eon + 1 + ENTLEN
+            elif _journal_trailer_at(m, ofs):
+                for (name, eofs) in batch:
+                    self.entries[name] = JournalEntry(self.reader, name, m,
+                                                      eofs)
+                batch = []
+                end = ofs = ofs + JOURNAL_TRAILER_LEN
+            else:
+                break
+        if ofs < size:
+            # Unless a complete batch follows, this is just the rest of an
+            # interrupted append.
+            ofs = m.find(JOURNAL_MAGIC, ofs)
+            while ofs >= 0:
+                if _journal_trailer_at(m, ofs - JOURNAL_TRAILER_LEN
+                                       + len(JOURNAL_MAGIC)):
+                    raise Error('%s: corrupt journal at offset %d'
+                                % (self.reader.filename, end))
+                ofs = m.find(JOURNAL_MAGIC, ofs + 1)
+        return end
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sorted(self):
+        """Return the entries in index order (reverse sorted by name)."""
+        return sorted(self.entries.itervalues())
+
+    def append(self, entries):
+        """Append entries to the journal, and return true, or return
+        false (and leave the index alone) if the index file isn't the one
+        the reader read, e.g. because another process has rewritten it or
+        appended to it since."""
+        reader = self.reader
+        end = self.end
+        f = open(reader.filename, 'r+b')
+        try:
+            # Appends to the same file take turns; the lock goes away when
+            # f is closed.
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            st = xstat.fstat(f.fileno())
+            if not reader.ident \
+               or (st.st_ino, st.st_size) != reader.ident[:2]:
+                return False
+            f.seek(end)
+            for e in entries:
+                e.children_ofs = e.children_n = 0
+                rec = e.name + '\0' + e.packed()
+                f.write(rec)
+                end += len(rec)
+            end += JOURNAL_TRAILER_LEN
+            f.write(struct.pack(JOURNAL_TRAILER_SIG, end, JOURNAL_MAGIC))
+            f.truncate()
+        finally:
+            f.close()
+        self.end = end
+        # The index proper is unchanged, so the files kept next to it are
+        # still valid (see Reader._restamp()).
+        reader.ident = (reader.ident[0], end) + reader.ident[2:]
+        return True
+
+
+def _journal_trailer_at(m, ofs):
+    trailer = m[ofs:ofs+JOURNAL_TRAILER_LEN] if ofs >= 0 else ''
+    return len(trailer) == JOURNAL_TRAILER_LEN \
+        and struct.unpack(JOURNAL_TRAILER_SIG, trailer) \
+            == (ofs + JOURNAL_TRAILER_LEN, JOURNAL_MAGIC)
+
+
+def _identity(dev, ino, size, mtime, ctime, check_device):
+    return (dev if check_device else 0, ino, size, mtime, ctime)
+
+
+def stat_identity(st, check_device=True):
+    """Return the key that identifies the file st describes, as it was
+    then, in Reader.hashes_by_identity(), or None for a directory.  The
+    device is left out unless check_device, as in Entry.from_stat()."""
+    if stat.S_ISDIR(st.st_mode):
+        return None
+    return _identity(st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                     st.st_ctime, check_device)
+
+
+def index_ident(st):
+    """Return the identity of the index file that st describes, for the
+    files kept next to it (e.g. PathTable).  Rewriting the index changes
+    its inode, and updating entries in place changes its times, so a
+    Reader that updates entries has to restamp those files (see
+    Reader.close()), and no one else's will match."""
+    return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def parent_name(name):
+    """Return the name of the directory containing name, or None for /."""
+    if name == '/':
+        return None
+    return ''.join(pathsplit(name)[:-1]) or '/'
+
 
 class Reader:
     def __init__(self, filename):
+        finish_meta_compaction(filename)
         self.filename = filename
         self.m = ''
         self.writable = False
         self.count = 0
+        self.end = 0
+        self.ident = None
+        self.journal = None
+        self._paths = None
         f = None
         try:
             f = open(filename, 'r+')
@@ -367,27 +948,35 @@ class Reader:
             else:
                 raise
         if f:
-            b = f.read(len(INDEX_HDR))
-            if b != INDEX_HDR:
+            b = f.read(INDEX_HDRLEN)
+            if b[:len(INDEX_HDR)] != INDEX_HDR \
+               or len(b) != INDEX_HDRLEN:
                 log('warning: %s: header: expected %r, got %r\n'
                                  % (filename, INDEX_HDR, b))
             else:
-                st = os.fstat(f.fileno())
+                st = xstat.fstat(f.fileno())
                 if st.st_size:
                     self.m = mmap_readwrite(f)
                     self.writable = True
+                    self.ident = index_ident(st)
+                    self.end = struct.unpack(INDEX_LEN_SIG,
+                                             b[len(INDEX_HDR):])[0]
+                    if not INDEX_HDRLEN + FOOTLEN <= self.end <= st.st_size:
+                        raise Error('%s: invalid index length %d'
+                                    % (filename, self.end))
                     self.count = struct.unpack(FOOTER_SIG,
-                          str(buffer(self.m, st.st_size-FOOTLEN, FOOTLEN)))[0]
+                          str(buffer(self.m, self.end-FOOTLEN, FOOTLEN)))[0]
+        self.journal = Journal(self)
 
     def __del__(self):
         self.close()
 
     def __len__(self):
-        return int(self.count)
+        return int(self.count) + len(self.journal)
 
     def forward_iter(self):
-        ofs = len(INDEX_HDR)
-        while ofs+ENTLEN <= len(self.m)-FOOTLEN:
+        ofs = INDEX_HDRLEN
+        while ofs+ENTLEN <= self.end-FOOTLEN:
             eon = self.m.find('\0', ofs)
             assert(eon >= 0)
             assert(eon >= ofs)
@@ -396,21 +985,178 @@ class Reader:
             yield ExistingEntry(None, basename, basename, self.m, eon+1)
             ofs = eon + 1 + ENTLEN
 
+    def columns(self, *fields):
+        """Yield a tuple of the given fields (any of _entry_field_names,
+        and 'basename') of each entry in the index proper, in the same
+        order as forward_iter(), without creating entries."""
+        decoders = [_entry_fields.get(f) for f in fields]
+        for f, d in zip(fields, decoders):
+            if not d and f != 'basename':
+                raise ValueError('unknown index entry field %r' % f)
+        m = self.m
+        end = self.end - FOOTLEN
+        ofs = INDEX_HDRLEN
+        while ofs+ENTLEN <= end:
+            eon = m.find('\0', ofs)
+            assert(eon > ofs)
+            row = []
+            for d in decoders:
+                if not d:
+                    row.append(m[ofs:eon])
+                else:
+                    (fmt, field_ofs, convert) = d
+                    val = struct.unpack_from(fmt, m, eon + 1 + field_ofs)
+                    row.append(convert(val) if convert else val[0])
+            yield tuple(row)
+            ofs = eon + 1 + ENTLEN
+
+    def hashes_by_identity(self, check_device=True):
+        """Return a dict of the (gitmode, sha) of each valid, non-directory
+        entry, keyed by its identity (see stat_identity())."""
+        fields = ('dev', 'ino', 'size', 'mtime', 'ctime',
+                  'mode', 'flags', 'gitmode', 'sha')
+        journal = (tuple(getattr(e, f) for f in fields)
+                   for e in self.journal.entries.itervalues())
+        valid = IX_HASHVALID|IX_EXISTS
+        result = {}
+        for (dev, ino, size, mtime, ctime, mode, flags, gitmode, sha) \
+                in itertools.chain(self.columns(*fields), journal):
+            if (flags & valid) == valid and gitmode and sha != EMPTY_SHA \
+                    and mode and not stat.S_ISDIR(mode):
+                key = _identity(dev, ino, size, mtime, ctime, check_device)
+                result[key] = (gitmode, sha)
+        return result
+
     def iter(self, name=None, wantrecurse=None):
-        if len(self.m) > len(INDEX_HDR)+ENTLEN:
+        """Yield the entries at and below name in reverse name order,
+        including any in the journal, skipping the contents of directories
+        for which wantrecurse(dir) is false."""
+        if not self.journal.entries:
+            return self._iter(name, wantrecurse)
+        return self._journal_iter(name, wantrecurse)
+
+    def _iter(self, name=None, wantrecurse=None):
+        if name and name != '/' and self._path_table():
+            return self._found_iter(name, wantrecurse)
+        return self._walk_iter(name, wantrecurse)
+
+    def _found_iter(self, name, wantrecurse):
+        # Yield what _walk_iter() would, but starting from the entries
+        # called name (and name + '/'), instead of the root.
+        dname = name
+        if not dname.endswith('/'):
+            dname += '/'
+        if wantrecurse:
+            parent = parent_name(dname)
+            while parent and parent != '/':
+                e = self._find(parent)
+                if e and not wantrecurse(e):
+                    return
+                parent = parent_name(parent)
+        for n in (dname, name):
+            e = self._find(n)
+            if e:
+                if n == dname and (not wantrecurse or wantrecurse(e)):
+                    for sub in e.iter(name=name, wantrecurse=wantrecurse):
+                        yield sub
+                yield e
+            if n == name:
+                break
+
+    def _walk_iter(self, name=None, wantrecurse=None):
+        if self.end > INDEX_HDRLEN+ENTLEN:
             dname = name
             if dname and not dname.endswith('/'):
                 dname += '/'
             root = ExistingEntry(None, '/', '/',
-                                 self.m, len(self.m)-FOOTLEN-ENTLEN)
+                                 self.m, self.end-FOOTLEN-ENTLEN)
             for sub in root.iter(name=name, wantrecurse=wantrecurse):
                 yield sub
             if not dname or dname == root.name:
                 yield root
 
+    def _journal_iter(self, name, wantrecurse):
+        dname = name
+        if dname and not dname.endswith('/'):
+            dname += '/'
+        pruned = set()
+        def recurse(e):
+            if wantrecurse and not wantrecurse(e):
+                pruned.add(e.name)
+                return False
+            return True
+        def wanted(e):
+            # Like the index's own entries, skip journal entries below a
+            # directory wantrecurse() rejected.
+            parent = parent_name(e.name)
+            while parent:
+                if parent in pruned:
+                    return False
+                jdir = self.journal.entries.get(parent)
+                if jdir and parent not in checked:
+                    checked.add(parent)
+                    if not recurse(jdir):
+                        return False
+                parent = parent_name(parent)
+            return True
+        checked = set()
+        jents = iter([e for e in self.journal.sorted()
+                      if not name or e.name == name
+                         or e.name.startswith(dname)])
+        je = next(jents, None)
+        for e in self._iter(name, recurse):
+            while je and je.name > e.name:
+                if wanted(je):
+                    yield je
+                je = next(jents, None)
+            if je and je.name == e.name:
+                # Shadowed by the index's own entry.
+                je = next(jents, None)
+            yield e
+        while je:
+            if wanted(je):
+                yield je
+            je = next(jents, None)
+
     def __iter__(self):
         return self.iter()
 
+    def find(self, name):
+        """Return the entry called name (e.g. '/foo/bar', or '/foo/' for
+        a directory), or None."""
+        return self._find(name) or self.journal.entries.get(name)
+
+    def _find(self, name):
+        # Look name up in the index proper.
+        if self.end <= INDEX_HDRLEN+ENTLEN:
+            return None
+        table = self._path_table()
+        if table:
+            basename = pathsplit(name)[-1] + '\0'
+            for ofs in table.offsets(name):
+                if self.m[ofs-len(basename):ofs] == basename:
+                    return FoundEntry(self, name, self.m, ofs)
+            return None
+        e = ExistingEntry(None, '/', '/', self.m, self.end-FOOTLEN-ENTLEN)
+        for basename in pathsplit(name)[1:]:
+            e = e._child(basename)
+            if not e:
+                return None
+        return e
+
+    def _path_table(self):
+        """Return the index's PathTable, building it if it's missing or
+        out of date, or None if the index is too small to bother."""
+        if self._paths is None:
+            if self.count < path_table_min_entries or not self.writable:
+                self._paths = False
+                return self._paths
+            self._paths = PathTable(self.filename + '.paths', self.ident)
+            if not self._paths.m:
+                self._paths.build((e.name, e._ofs)
+                                  for e in self._walk_iter())
+        return self._paths
+
     def exists(self):
         return self.m
 
@@ -424,6 +1170,28 @@ class Reader:
             self.m.close()
             self.m = None
             self.writable = False
+            self._restamp()
+        if self.journal is not None:
+            self.journal.entries = {}
+        if self._paths:
+            self._paths.close()
+        self._paths = None
+
+    def _restamp(self):
+        # If entries were updated in place, the index's times changed, so
+        # update the identity recorded by the files that are still valid
+        # for it -- unless the index has been rewritten since it was opened.
+        try:
+            ident = index_ident(xstat.stat(self.filename))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if ident == self.ident or ident[:2] != self.ident[:2]:
+            return
+        if self._paths and self._paths.m:
+            self._paths.restamp(ident)
+        self.ident = ident
 
     def filter(self, prefixes, wantrecurse=None):
         for (rp, path) in reduce_paths(prefixes):
@@ -433,6 +1201,157 @@ class Reader:
                 yield (name, e)
 
 
+def meta_usage(indexfile):
+    """Return (referenced, total), the number of distinct metadata records
+    indexfile's entries refer to, and the number of records in its
+    metadata store, or None if the store's hash table can't tell."""
+    table = MetaHashTable(indexfile + '.meta.hash')
+    covered = table.open()
+    total = table.used
+    table.close(covered)
+    if covered is None \
+       or covered != os.path.getsize(indexfile + '.meta'):
+        return None
+    r = Reader(indexfile)
+    try:
+        referenced = set(ofs for (ofs,) in r.columns('meta_ofs'))
+        referenced.update(e.meta_ofs for e in r.journal.entries.itervalues())
+    finally:
+        r.close()
+    return (len(referenced), total)
+
+
+def compact_meta(indexfile):
+    """Rewrite indexfile's metadata store (indexfile.meta) with only the
+    records that indexfile's entries refer to, and update the entries to
+    match.  Return the old and new sizes of the store.  The caller must
+    hold indexfile's Lock exclusively.
+
+    The new store, index, and store hash table are written as
+    indexfile.meta.compact, indexfile.compact, and
+    indexfile.meta.hash.compact, and synced.  Renaming the new store into
+    place commits the compaction, and then the other two follow.  If
+    that's interrupted, the next Reader of indexfile undoes or finishes
+    the job (see finish_meta_compaction()).
+    """
+    meta_filename = indexfile + '.meta'
+    new_meta = meta_filename + '.compact'
+    new_index = indexfile + '.compact'
+    new_hash = meta_filename + '.hash.compact'
+    msw = MetaStoreWriter(meta_filename)
+    fold_journal(indexfile, msw, (time.time() - 1) * 10**9)
+    msw.close()
+    r = Reader(indexfile)
+    try:
+        offsets = sorted(set(ofs for (ofs,) in r.columns('meta_ofs')))
+    finally:
+        r.close()
+    old_size = os.path.getsize(meta_filename)
+
+    remap = {}
+    digests = []
+    src = open(meta_filename, 'rb')
+    try:
+        dst = open(new_meta, 'wb')
+        try:
+            for ofs in offsets:
+                src.seek(ofs)
+                # None is an empty (but valid) record.
+                m = metadata.Metadata.read(src) or metadata.Metadata()
+                end = src.tell()
+                src.seek(ofs)
+                remap[ofs] = dst.tell()
+                dst.write(src.read(end - ofs))
+                digests.append(Sha1(m.encode(include_path=False)).digest())
+            dst.flush()
+            fdatasync(dst.fileno())
+            new_size = dst.tell()
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+    # Index the new store, as MetaStoreWriter would have.
+    table = MetaHashTable(new_hash)
+    table.create(len(offsets))
+    for digest, ofs in zip(digests, offsets):
+        table.add(digest, remap[ofs])
+    table.close(new_size)
+
+    out = open(new_index, 'wb')
+    try:
+        f = open(indexfile, 'rb')
+        try:
+            while 1:
+                b = f.read(1024*1024)
+                if not b:
+                    break
+                out.write(b)
+        finally:
+            f.close()
+    finally:
+        out.close()
+    r = Reader(new_index)
+    try:
+        for e in r.forward_iter():
+            if remap[e.meta_ofs] != e.meta_ofs:
+                # meta_ofs is the last field of an entry
+                r.m[e._ofs+ENTLEN-8:e._ofs+ENTLEN] = \
+                    struct.pack('!Q', remap[e.meta_ofs])
+    finally:
+        r.close()
+    for name in (new_index, new_hash):
+        out = open(name, 'r+b')
+        try:
+            fdatasync(out.fileno())
+        finally:
+            out.close()
+
+    # The old hash table doesn't match the new store, so don't leave it
+    # around for anyone who doesn't finish the compaction first.
+    unlink(meta_filename + '.hash')
+    os.rename(new_meta, meta_filename)
+    _fsync_dir(meta_filename)
+    os.rename(new_index, indexfile)
+    os.rename(new_hash, meta_filename + '.hash')
+    return (old_size, new_size)
+
+
+def _fsync_dir(filename):
+    """Make the renames in filename's directory durable."""
+    fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def finish_meta_compaction(indexfile):
+    """Finish or undo an interrupted compact_meta() of indexfile."""
+    new_index = indexfile + '.compact'
+    new_meta = indexfile + '.meta.compact'
+    new_hash = indexfile + '.meta.hash.compact'
+    if os.path.exists(new_meta):
+        # The new store hadn't been renamed into place yet.
+        unlink(new_meta)
+        unlink(new_index)
+        unlink(new_hash)
+        return
+    # Otherwise it had been committed; another process may be finishing
+    # it too.
+    finished = False
+    for (src, dst) in ((new_index, indexfile),
+                       (new_hash, indexfile + '.meta.hash')):
+        try:
+            os.rename(src, dst)
+            finished = True
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    if finished:
+        debug1('index: finished compaction of %s\n' % indexfile)
+
+
 # FIXME: this function isn't very generic, because it splits the filename
 # in an odd way and depends on a terminating '/' to indicate directories.
 def pathsplit(p):
@@ -457,7 +1376,7 @@ class Writer:
         (dir,name) = os.path.split(filename)
         (ffd,self.tmpname) = tempfile.mkstemp('.tmp', filename, dir)
         self.f = os.fdopen(ffd, 'wb', 65536)
-        self.f.write(INDEX_HDR)
+        self.f.write(INDEX_HDR + struct.pack(INDEX_LEN_SIG, 0))
 
     def __del__(self):
         self.abort()
@@ -477,6 +1396,10 @@ class Writer:
             if self.count:
                 self.count += 1
             self.f.write(struct.pack(FOOTER_SIG, self.count))
+            end = self.f.tell()
+            self.f.seek(len(INDEX_HDR))
+            self.f.write(struct.pack(INDEX_LEN_SIG, end))
+            self.f.seek(end)
             self.f.flush()
         assert(self.level == None)
 
@@ -527,6 +1450,8 @@ class Writer:
         self._add(ename, e)
 
     def add_ixentry(self, e):
+        # The entry may outlive the map it came from.
+        e._decode()
         e.children_ofs = e.children_n = 0
         self._add(pathsplit(e.name), e)
 
@@ -566,3 +1491,60 @@ def merge(*iters):
     def pfinal(count, total):
         progress('bup: merging indexes (%d/%d), done.\n' % (count, total))
     return merge_iter(iters, 1024, pfunc, pfinal, key='name')
+
+
+def add_entries(ri, wr, msw, tmax):
+    """Add the entries from wr (e.g. Writer.new_reader()) to the index
+    that ri reads, then close ri.
+
+    If there aren't too many of them (see journal_max_ratio), they're
+    appended to the index's journal, and the rest of the index is left
+    alone.  Otherwise, the index, its journal, and wr are merged into a
+    new index.
+    """
+    limit = max(journal_min_entries, int(ri.count * journal_max_ratio))
+    if not ri.exists() or len(ri.journal) + len(wr) > limit:
+        _merge_entries(ri, wr, msw, tmax)
+        return
+    new = []
+    for e in wr:
+        if e.is_fake():
+            # A placeholder for a parent directory (see _golevel()); if
+            # the directory's already there, just make sure it's rechecked.
+            old = ri.find(e.name)
+            if old:
+                if old.is_valid():
+                    old.invalidate()
+                    old.repack()
+                continue
+        new.append(e)
+    if not ri.journal.append(new):
+        # The index changed after ri read it, so ri's journal can't be
+        # trusted to end where ri thinks it does.
+        debug1('index: %s changed while updating it, merging\n'
+               % ri.filename)
+        _merge_entries(ri, wr, msw, tmax)
+        return
+    ri.close()
+
+
+def _merge_entries(ri, wr, msw, tmax):
+    mi = Writer(ri.filename, msw, tmax)
+    for e in merge(ri, wr):
+        # FIXME: shouldn't we remove deleted entries eventually?  When?
+        mi.add_ixentry(e)
+    ri.close()
+    mi.close()
+
+
+def fold_journal(indexfile, msw, tmax):
+    """Rewrite indexfile to include the entries in its journal."""
+    ri = Reader(indexfile)
+    if not ri.journal.entries:
+        ri.close()
+        return
+    mi = Writer(indexfile, msw, tmax)
+    for e in ri:
+        mi.add_ixentry(e)
+    ri.close()
+    mi.close()
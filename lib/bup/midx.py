@@ -1,9 +1,21 @@
-import mmap
-from bup import _helpers
+import glob, math, mmap, resource
+from bup import _helpers, xstat
 from bup.helpers import *
 
 MIDX_VERSION = 4
 
+PAGE_SIZE = 4096
+SHA_PER_PAGE = PAGE_SIZE/20.
+
+# Indexes are merged into midx files in tiers.  An index with n objects is
+# in tier t if TIER_BASE*TIER_FANOUT**t <= n < TIER_BASE*TIER_FANOUT**(t+1)
+# (tier 0 also has everything smaller), and once a tier has TIER_FANOUT
+# members, they're merged into one midx, which lands in a higher tier.  So
+# each object is merged about log(n) times, rather than every time a pack
+# is added.
+TIER_BASE = 16384
+TIER_FANOUT = 4
+
 extract_bits = _helpers.extract_bits
 _total_searches = 0
 _total_steps = 0
@@ -90,26 +102,22 @@ class PackMidx:
             startv = 0
         end = self._fanget(el)
         endv = (el+1) << (32-self.bits)
-        _total_steps += 1   # lookup table is a step
-        hashv = _helpers.firstword(hash)
-        #print '(%08x) %08x %08x %08x' % (extract_bits(want, 32), startv, hashv, endv)
-        while start < end:
-            _total_steps += 1
-            #print '! %08x %08x %08x   %d - %d' % (startv, hashv, endv, start, end)
-            mid = start + (hashv-startv)*(end-start-1)/(endv-startv)
-            #print '  %08x %08x %08x   %d %d %d' % (startv, hashv, endv, start, mid, end)
-            v = self._get(mid)
-            #print '    %08x' % self._num(v)
-            if v < want:
-                start = mid+1
-                startv = _helpers.firstword(v)
-            elif v > want:
-                end = mid
-                endv = _helpers.firstword(v)
-            else: # got it!
-                return want_source and self._get_idxname(mid) or True
+        mid, steps = _helpers.interpolate_sha(self.shatable, start, end,
+                                              startv, endv, want)
+        _total_steps += 1 + steps   # lookup table is a step
+        if mid >= 0:
+            return want_source and self._get_idxname(mid) or True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return exists(hash, want_source) for each of the sorted hashes,
+        looking them all up in one pass."""
+        found = _helpers.find_shas(self.shatable, 20, len(self),
+                                   ''.join(hashes))
+        if not want_source:
+            return [True if i >= 0 else None for i in found]
+        return [self._get_idxname(i) if i >= 0 else None for i in found]
+
     def __iter__(self):
         for i in xrange(self._fanget(self.entries-1)):
             yield buffer(self.shatable, i*20, 20)
@@ -118,3 +126,164 @@ class PackMidx:
         return int(self._fanget(self.entries-1))
 
 
+
+
+def max_files():
+    """Return how many idx files it's safe to open at once."""
+    mf = min(resource.getrlimit(resource.RLIMIT_NOFILE))
+    if mf > 32:
+        mf -= 20  # just a safety margin
+    else:
+        mf -= 6   # minimum safety margin
+    return mf
+
+
+def tier(count):
+    """Return the tier of an index with count objects."""
+    t = 0
+    limit = TIER_BASE * TIER_FANOUT
+    while count >= limit:
+        t += 1
+        limit *= TIER_FANOUT
+    return t
+
+
+def write_midx(outdir, infilenames, outfilename=None, prefixstr=''):
+    """Merge the given idx and midx files into a new midx file, and return
+    (object count, midx filename).  By default, the file is created in
+    outdir, and named after the input files."""
+    from bup import git
+    if not outfilename:
+        assert(outdir)
+        sum = Sha1('\0'.join(infilenames)).hexdigest()
+        outfilename = '%s/midx-%s.midx' % (outdir, sum)
+
+    inp = []
+    total = 0
+    allfilenames = []
+    midxs = []
+    try:
+        for name in infilenames:
+            ix = git.open_idx(name)
+            midxs.append(ix)
+            inp.append((
+                ix.map,
+                len(ix),
+                ix.sha_ofs,
+                isinstance(ix, PackMidx) and ix.which_ofs or 0,
+                len(allfilenames),
+            ))
+            for n in ix.idxnames:
+                allfilenames.append(os.path.basename(n))
+            total += len(ix)
+        inp.sort(lambda x,y: cmp(str(y[0][y[2]:y[2]+20]),str(x[0][x[2]:x[2]+20])))
+
+        debug1('midx: %screating from %d files (%d objects).\n'
+               % (prefixstr, len(infilenames), total))
+
+        pages = int(total/SHA_PER_PAGE) or 1
+        bits = int(math.ceil(math.log(pages, 2)))
+        entries = 2**bits
+        debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
+
+        unlink(outfilename)
+        f = open(outfilename + '.tmp', 'w+b')
+        f.write('MIDX')
+        f.write(struct.pack('!II', MIDX_VERSION, bits))
+        assert(f.tell() == 12)
+
+        f.truncate(12 + 4*entries + 20*total + 4*total)
+        f.flush()
+        fdatasync(f.fileno())
+
+        fmap = mmap_readwrite(f, close=False)
+
+        # merge_into() releases the GIL while it reads these maps, so they
+        # must not be shared with anything that might close them (e.g. a
+        # PackIdxList); they're only closed once it returns.
+        count = _helpers.merge_into(fmap, bits, total, inp)
+        del fmap # Assume this calls msync() now.
+    finally:
+        for ix in midxs:
+            if isinstance(ix, PackMidx):
+                ix.close()
+        midxs = None
+        inp = None
+
+    f.seek(0, os.SEEK_END)
+    f.write('\0'.join(allfilenames))
+    f.close()
+    os.rename(outfilename + '.tmp', outfilename)
+    return total, outfilename
+
+
+def current_indexes(path, use_midx=True):
+    """Return (object count, filename) for each midx and idx file in path
+    that's still needed.  Any midx files made redundant by bigger (or
+    newer) ones are deleted.  If use_midx is false, just list the idxes."""
+    from bup import git
+    already = {}
+    sizes = {}
+    if not use_midx:
+        midxs = []
+    else:
+        midxs = glob.glob('%s/*.midx' % path)
+        contents = {}
+        for mname in midxs:
+            m = git.open_idx(mname)
+            contents[mname] = [('%s/%s' % (path,i)) for i in m.idxnames]
+            sizes[mname] = len(m)
+
+        # sort the biggest+newest midxes first, so that we can eliminate
+        # smaller (or older) redundant ones that come later in the list
+        midxs.sort(key=lambda ix: (-sizes[ix], -xstat.stat(ix).st_mtime))
+
+        for mname in midxs:
+            any = 0
+            for iname in contents[mname]:
+                if not already.get(iname):
+                    already[iname] = 1
+                    any = 1
+            if not any:
+                debug1('%r is redundant\n' % mname)
+                unlink(mname)
+                already[mname] = 1
+
+    midxs = [k for k in midxs if not already.get(k)]
+    idxs = [k for k in glob.glob('%s/*.idx' % path) if not already.get(k)]
+
+    for iname in idxs:
+        i = git.open_idx(iname)
+        sizes[iname] = len(i)
+
+    return [(sizes[n],n) for n in (midxs + idxs)]
+
+
+def auto_merge(path, max_files, prefixstr=''):
+    """Merge the indexes in path into tiered midx files, as needed, and
+    return the names of the new midx files.
+
+    Whenever a tier has TIER_FANOUT (or more) indexes, up to max_files of
+    them are merged, smallest tier first, and any of them that were midx
+    files are deleted.
+    """
+    created = []
+    while 1:
+        tiers = {}
+        for sz, name in current_indexes(path):
+            tiers.setdefault(tier(sz), []).append((sz, name))
+        full = [t for t, members in tiers.iteritems()
+                if len(members) >= TIER_FANOUT]
+        if not full:
+            if not created:
+                debug1('midx: %snothing to do.\n' % prefixstr)
+            return [name for name in created if os.path.exists(name)]
+        members = sorted(tiers[min(full)])[:max_files]
+        debug1('midx: %smerging %d indexes from tier %d.\n'
+               % (prefixstr, len(members), min(full)))
+        total, name = write_midx(path, [name for sz, name in members],
+                                 prefixstr=prefixstr)
+        created.append(name)
+        for sz, name in members:
+            if name.endswith('.midx'):
+                unlink(name)
@@ -1,4 +1,4 @@
-import errno, platform, tempfile
+import errno, platform, random, tempfile, threading, time
 from bup import bloom
 from bup.helpers import *
 from wvtest import *
@@ -10,14 +10,20 @@ mkdirp(bup_tmp)
 def test_bloom():
     initial_failures = wvfailure_count()
     tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tbloom-')
-    hashes = [os.urandom(20) for i in range(100)]
+    # Use the same "random" objects every time, so that the number of
+    # false positives below doesn't vary from run to run.
+    rng = random.Random(42)
+    def random_sha():
+        return ''.join(chr(rng.getrandbits(8)) for i in xrange(20))
+    hashes = [random_sha() for i in range(100)]
     class Idx:
         pass
     ix = Idx()
     ix.name='dummy.idx'
     ix.shatable = ''.join(hashes)
-    for k in (4, 5):
-        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k)
+    for version, k in [(v, k) for v in (2, 3) for k in (4, 5)]:
+        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k,
+                         version=version)
         b.add_idx(ix)
         WVPASSLT(b.pfalse_positive(), .1)
         b.close()
@@ -27,16 +33,18 @@ def test_bloom():
             all_present &= b.exists(h)
         WVPASS(all_present)
         false_positives = 0
-        for h in [os.urandom(20) for i in range(1000)]:
+        for h in [random_sha() for i in range(1000)]:
             if b.exists(h):
                 false_positives += 1
         WVPASSLT(false_positives, 5)
+        WVPASSEQ(b.version, version)
         os.unlink(tmpdir + '/pybuptest.bloom')
 
     tf = tempfile.TemporaryFile()
     b = bloom.create('bup.bloom', f=tf, expected=100)
     WVPASSEQ(b.rwfile, tf)
     WVPASSEQ(b.k, 5)
+    WVPASSEQ(b.version, 2)
 
     # Test large (~1GiB) filter.  This may fail on s390 (31-bit
     # architecture), and anywhere else where the address space is
@@ -57,3 +65,65 @@ def test_bloom():
         WVPASSEQ(b.k, 4)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_bloom_v3_blocks():
+    tf = tempfile.TemporaryFile()
+    b = bloom.create('bup.bloom', f=tf, expected=1000, k=5, version=3)
+    WVPASSEQ(b.headerlen, 64)
+    class Idx:
+        pass
+    for i in range(20):
+        ix = Idx()
+        ix.name = 'dummy%d.idx' % i
+        ix.shatable = os.urandom(20)
+        before = b.map[:]
+        b.add_idx(ix)
+        after = b.map[:]
+        changed = [n for n in range(len(after)) if before[n] != after[n]]
+        WVPASS(changed)
+        # all the bits for one object land in one cache-line block
+        WVPASSEQ(len(set((n - b.headerlen) // 64 for n in changed)), 1)
+        found, steps = bloom._helpers.bloom_contains3(b.map, ix.shatable,
+                                                      b.bits, b.k)
+        WVPASSEQ((found, steps), (1, 5))
+    WVPASSEQ(len(b), 20)
+
+
+@wvtest
+def test_bloom_lock():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tbloom-')
+    name = tmpdir + '/bup.bloom'
+    WVPASSEQ(bloom.lock(name), None)
+    bloom.create(name, expected=100).close()
+    lockf = bloom.lock(name)
+    # A writer waits for the lock, and then finds the filter that
+    # replaced the one it was waiting for.
+    opened = []
+    def open_rw():
+        b = bloom.ShaBloom(name, readwrite=True, expected=1)
+        opened.append(os.fstat(b.rwfile.fileno()).st_ino)
+        b.close()
+    t = threading.Thread(target=open_rw)
+    t.start()
+    time.sleep(0.1)
+    WVPASSEQ(opened, [])
+    bloom.create(tmpdir + '/bup.tmp.bloom', expected=100).close()
+    os.rename(tmpdir + '/bup.tmp.bloom', name)
+    lockf.close()
+    t.join()
+    WVPASSEQ(opened, [os.stat(name).st_ino])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_version_from_config():
+    WVPASSEQ(bloom.version_from_config(lambda name: None), 2)
+    WVPASSEQ(bloom.version_from_config({'bup.bloomVersion': '3'}.get), 3)
+    WVEXCEPT(ValueError, bloom.version_from_config,
+             {'bup.bloomVersion': '4'}.get)
+    WVEXCEPT(ValueError, bloom.version_from_config,
+             {'bup.bloomVersion': 'v3'}.get)
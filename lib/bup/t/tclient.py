@@ -117,6 +117,22 @@ def test_dumb_client_server():
         subprocess.call(['rm', '-rf', tmpdir])
 
 
+@wvtest
+def test_config_get():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tclient-')
+    os.environ['BUP_MAIN_EXE'] = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    git.git_config_set('bup.chunker', 'gear')
+    c = client.Client(bupdir, create=True)
+    WVPASSEQ(c.config_get('bup.chunker'), 'gear')
+    WVPASSEQ(c.config_get('bup.chunkAvgSize'), None)
+    c.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_midx_refreshing():
     initial_failures = wvfailure_count()
@@ -1,6 +1,6 @@
-import struct, os, tempfile, time
+import struct, os, random, tempfile, time, glob
 from subprocess import check_call
-from bup import git
+from bup import git, midx, bloom, _helpers
 from bup.helpers import *
 from wvtest import *
 
@@ -131,6 +131,7 @@ def test_pack_name_lookup():
             hashes.append(w.new_blob(str(i)))
         log('\n')
         idxnames.append(os.path.basename(w.close() + '.idx'))
+        git.wait_auto_midx()
 
     r = git.PackIdxList(packdir)
     WVPASSEQ(len(r.packs), 2)
@@ -358,3 +359,379 @@ def test_object_info():
               (blob_hash.decode('hex'), 'blob', blob_size)))
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_new_blobs_jobs():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    blobs = [os.urandom(5000) for i in xrange(50)]
+    blobs += blobs[10:20]  # duplicates must only be written once
+    packs = []
+    for jobs in (1, 4):
+        w = git.PackWriter(jobs=jobs)
+        WVPASSEQ(list(w.new_blobs(iter(blobs))),
+                 [git.calc_hash('blob', b) for b in blobs])
+        WVPASSEQ(w.count, 50)
+        packs.append(open(w.close(run_midx=False) + '.pack').read())
+        for name in glob.glob(git.repo('objects/pack/*')):
+            os.unlink(name)
+    WVPASSEQ(packs[0], packs[1])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_config():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    WVPASSEQ(git.git_config_get('bup.chunker'), None)
+    git.git_config_set('bup.chunker', 'gear')
+    WVPASSEQ(git.git_config_get('bup.chunker'), 'gear')
+    WVPASSEQ(git.git_config_get('bup.chunker', repo_dir=bupdir), 'gear')
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_adaptive_compression():
+    a = git.AdaptiveCompression(6)
+    noise = [os.urandom(8192) for i in xrange(100)]
+    text = ['%d bottles of beer on the wall\n' % i * 200 for i in xrange(100)]
+    a.start_file('x.jpg')
+    WVPASSEQ([a.level_for(b) for b in noise], [0] * 100)
+    WVPASSEQ(a.bytes_stored, 8192 * 100)
+    # settled after 4 trials, then a reprobe every 64 blobs
+    WVPASSEQ(a.trials, 5)
+    a.start_file('y.txt')
+    WVPASSEQ([a.level_for(b) for b in text], [6] * 100)
+    WVPASSEQ(a.trials, 10)
+    # A compressible stretch in a settled file is noticed at the next probe.
+    a.start_file('z.bin')
+    levels = [a.level_for(b) for b in noise[:10] + text]
+    WVPASSEQ(levels[:10], [0] * 10)
+    WVPASS(levels[-40:] == [6] * 40)
+    # The extension's history settles new files from the start.
+    for i in xrange(4):
+        a.start_file('%d.jpg' % i)
+        for b in noise[:4]:
+            a.level_for(b)
+    trials = a.trials
+    a.start_file('w.jpg')
+    WVPASSEQ(a.level_for(noise[0]), 0)
+    WVPASSEQ(a.trials, trials)
+    WVPASSEQ(git.AdaptiveCompression(0).level_for(text[0]), 0)
+
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    # Blobs that are already stored don't affect the levels chosen for
+    # the others, however many jobs there are.
+    w = git.PackWriter()
+    for b in noise[20:24] + text[2:4]:
+        w.new_blob(b)
+    w.close()
+    results = []
+    for jobs in (1, 4):
+        w = git.PackWriter(jobs=jobs, adaptive_compression=True)
+        w.start_file('f')
+        ids = list(w.new_blobs(iter(noise[16:28])))
+        w.start_file('g')
+        ids += list(w.new_blobs(iter(text[:20])))
+        WVPASSEQ(w.adaptive.bytes_stored, 8192 * 8)
+        trials = w.adaptive.trials
+        name = w.close(run_midx=False)
+        results.append((trials, open(name + '.pack').read()))
+        os.unlink(name + '.pack')
+        os.unlink(name + '.idx')
+    WVPASSEQ(results[0][0], results[1][0])
+    WVPASS(results[0][1] == results[1][1])
+    w = git.PackWriter(jobs=4, adaptive_compression=True)
+    w.start_file('f')
+    ids = list(w.new_blobs(iter(noise[:20])))
+    w.start_file('g')
+    ids += list(w.new_blobs(iter(text[:20])))
+    w.close()
+    cp = git.CatPipe()
+    for id, b in zip(ids, noise[:20] + text[:20]):
+        WVPASS(''.join(cp.join(id.encode('hex'))) == b)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_pack_reader():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    text = ''.join('%d bottles of beer on the wall\n' % i for i in xrange(3000))
+    blobs = [text[i:] + text[:i] + str(i) for i in xrange(0, 60000, 3000)]
+    blobs += [os.urandom(100000), '']
+    w = git.PackWriter()
+    ids = [w.new_blob(b) for b in blobs]
+    tree = w.new_tree([(0100644, 'f%02d' % i, id)
+                       for i, id in enumerate(ids)])
+    commit = w.new_commit(tree, None, 'a <a@b>', 0, 0, 'a <a@b>', 0, 0, 'x')
+    w.close()
+    ids += [tree, commit]
+    git.update_ref('refs/heads/master', commit, None)
+
+    def read(it):
+        return (it.next(), ''.join(it))
+
+    def check(reader):
+        for id in ids:
+            hexid = id.encode('hex')
+            WVPASS(read(reader.get(hexid)) == read(git.CatPipe().get(hexid)))
+        WVPASS(''.join(reader.join(commit.encode('hex'))) == ''.join(blobs))
+        WVPASS(read(reader.get(commit.encode('hex') + ':'))
+               == read(git.CatPipe().get(tree.encode('hex'))))
+        # not an id; handled by git
+        WVPASSEQ(read(reader.get('master'))[0], 'commit')
+        WVEXCEPT(KeyError, reader.get('1' * 40).next)
+
+    check(git.PackReader())
+    # Deltas, based on offsets and on ids.
+    for offsets in ('true', 'false'):
+        subprocess.check_call(['git', '--git-dir', bupdir, 'config',
+                               'repack.usedeltabaseoffset', offsets])
+        subprocess.check_call(['git', '--git-dir', bupdir, 'repack', '-adfq'])
+        out = subprocess.Popen(['git', '--git-dir', bupdir, 'verify-pack',
+                                '-v'] + glob.glob(bupdir + '/objects/pack/*.idx'),
+                               stdout=subprocess.PIPE).communicate()[0]
+        WVPASS('chain length = ' in out)
+        check(git.PackReader())
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_reader_pool():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    blobs = [os.urandom(random.randrange(1, 20000)) for i in xrange(50)]
+    w = git.PackWriter()
+    ids = [w.new_blob(b) for b in blobs]
+    subtree = w.new_tree([(0100644, 'f%02d' % i, id)
+                          for i, id in enumerate(ids[10:20])])
+    shalist = [(0100644, 'a%02d' % i, id) for i, id in enumerate(ids[:10])]
+    shalist += [(040000, 'b', subtree)]
+    shalist += [(0100644, 'c%02d' % i, id) for i, id in enumerate(ids[20:])]
+    tree = w.new_tree(shalist)
+    commit = w.new_commit(tree, None, 'a <a@b>', 0, 0, 'a <a@b>', 0, 0, 'x')
+    w.close()
+
+    for jobs in (1, 3):
+        pool = git.ReaderPool(jobs)
+        got = list(pool.get_many(id.encode('hex') for id in ids))
+        WVPASS(got == [('blob', b) for b in blobs])
+        WVPASS(''.join(pool.join(commit.encode('hex'))) == ''.join(blobs))
+        WVPASS(''.join(pool.join(ids[0].encode('hex'))) == blobs[0])
+        WVPASSEQ(list(pool.get_many([])), [])
+        # A missing object is reported in order, after the ones before it.
+        it = pool.get_many([ids[0].encode('hex'), '1' * 40,
+                            ids[1].encode('hex')], lookahead=3)
+        WVPASSEQ(it.next(), ('blob', blobs[0]))
+        WVEXCEPT(KeyError, it.next)
+        # Any number of threads may join() at once.
+        workers = WorkerPool(4)
+        joined = workers.imap(lambda id: ''.join(pool.join(id)),
+                              [commit.encode('hex'), subtree.encode('hex')] * 4)
+        WVPASS(list(joined) == [''.join(blobs), ''.join(blobs[10:20])] * 4)
+        workers.close()
+        pool.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_exists_many():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+    hashes = []
+    idxnames = []
+    for start in xrange(0, 2000, 500):
+        w = git.PackWriter()
+        for i in xrange(start, start + 500):
+            hashes.append(w.new_blob(str(i)))
+        idxnames.append(w.close(run_midx=False) + '.idx')
+    missing = [_helpers.random_sha() for i in xrange(100)]
+    queries = hashes + missing + hashes[:10]
+    random.shuffle(queries)
+
+    def check(r, queries):
+        expected = [r.exists(h, want_source=True) for h in queries]
+        WVPASS(r.exists_many(queries, want_source=True) == expected)
+        WVPASS(r.exists_many(queries) == [x and True for x in expected])
+        WVPASSEQ(r.exists_many([]), [])
+        return expected
+
+    # idx v2, and v1 as written by git
+    # A single index wants its queries sorted.
+    ix = git.open_idx(idxnames[0])
+    WVPASSEQ(sum(1 for x in check(ix, sorted(queries)) if x), 510)
+    v1name = tmpdir + '/v1.idx'
+    subprocess.check_call(['git', 'index-pack', '--index-version=1',
+                           '-o', v1name, idxnames[0][:-4] + '.pack'])
+    v1 = git.open_idx(v1name)
+    WVPASS(isinstance(v1, git.PackIdxV1))
+    v1.name = ix.name  # for want_source
+    WVPASSEQ(sum(1 for x in check(v1, sorted(queries)) if x), 510)
+    for h in hashes[:500]:
+        WVPASSEQ(v1.find_offset(h), ix.find_offset(h))
+
+    r = git.PackIdxList(packdir)
+    WVPASSEQ(len(r.packs), 4)
+    WVPASSEQ(sum(1 for x in check(r, queries) if x), 2010)
+    del r
+    subprocess.check_call([bup_exe, 'midx', '-f'])
+    r = git.PackIdxList(packdir)
+    WVPASSEQ(len(r.packs), 1)
+    WVPASSEQ(sum(1 for x in check(r, queries) if x), 2010)
+    WVPASSEQ(sum(1 for x in check(r.packs[0], sorted(queries)) if x), 2010)
+    WVPASSEQ(r.packs[0].exists(missing[0]), None)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_midx_tiers():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+    old_tiers = midx.TIER_BASE, midx.TIER_FANOUT
+    try:
+        midx.TIER_BASE, midx.TIER_FANOUT = 10, 2
+        WVPASSEQ([midx.tier(n) for n in (0, 19, 20, 39, 40, 80)],
+                 [0, 0, 1, 1, 2, 3])
+        hashes = []
+        for i in xrange(8):
+            w = git.PackWriter()
+            for j in xrange(10):
+                hashes.append(w.new_blob(os.urandom(20)))
+            w.close(run_midx=False)
+            midx.auto_merge(packdir, 100)
+            current = midx.current_indexes(packdir)
+            tiers = [midx.tier(sz) for sz, name in current]
+            WVPASSEQ(sorted(tiers), sorted(set(tiers)))
+            WVPASSEQ(sum(sz for sz, name in current), len(hashes))
+            if i == 3:
+                big = current[0][1]
+            elif i == 4:
+                # The new pack doesn't touch the existing tiers.
+                WVPASS(big in [name for sz, name in current])
+        WVPASSEQ(len(current), 1)
+        WVPASS(current[0][1].endswith('.midx'))
+        WVPASSEQ(len(glob.glob(packdir + '/*.midx')), 1)
+        r = git.PackIdxList(packdir)
+        WVPASSEQ(len(r.packs), 1)
+        WVPASS(all(r.exists_many(hashes)))
+        del r
+
+        # In the background, and the bloom filter is updated too.
+        w = git.PackWriter()
+        hashes.append(w.new_blob(os.urandom(20)))
+        w.close()
+        git.wait_auto_midx()
+        WVPASS(os.path.exists(packdir + '/bup.bloom'))
+        r = git.PackIdxList(packdir)
+        WVPASSEQ(len(r.packs), 2)
+        WVPASS(all(r.exists_many(hashes)))
+    finally:
+        midx.TIER_BASE, midx.TIER_FANOUT = old_tiers
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_bloom_updates():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bup_exe
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = git.repo('objects/pack')
+    bfull = packdir + '/bup.bloom'
+
+    def write_pack():
+        w = git.PackWriter()
+        new = [w.new_blob(os.urandom(20)) for i in xrange(10)]
+        return w.close(run_midx=False) + '.idx', new
+
+    def make_bloom(*idxnames):
+        b = bloom.create(bfull, expected=1000)
+        for name in idxnames:
+            b.add_idx(git.open_idx(name))
+        b.close()
+
+    first, hashes = write_pack()
+    WVPASS(not os.path.exists(bfull))
+    make_bloom(first)
+    second, new = write_pack()
+    hashes += new
+    b = bloom.ShaBloom(bfull)
+    WVPASSEQ(len(b), 20)
+    WVPASSEQ(sorted(b.idxnames),
+             sorted([os.path.basename(first), os.path.basename(second)]))
+    WVPASS(all([b.exists(h) for h in hashes]))
+    b.close()
+    r = git.PackIdxList(packdir)
+    WVPASS(r.bloom)
+    WVPASSEQ(r.unbloomed, [])
+    del r
+
+    # A filter that's missing an index is still used for the others.
+    os.unlink(bfull)
+    make_bloom(first)
+    r = git.PackIdxList(packdir)
+    WVPASS(r.bloom)
+    WVPASSEQ([os.path.basename(p.name) for p in r.unbloomed],
+             [os.path.basename(second)])
+    WVPASS(all([r.exists(h) for h in hashes]))
+    WVPASS(all(r.exists_many(hashes)))
+    WVPASS(not any(r.exists_many([os.urandom(20) for i in xrange(100)])))
+    del r
+
+    old_max = bloom.MAX_PFALSE_POSITIVE
+    try:
+        WVPASS(not git.update_bloom(packdir, second))
+        WVPASSEQ(len(bloom.ShaBloom(bfull)), 20)
+        # Adding an index twice changes nothing.
+        WVPASS(not git.update_bloom(packdir, second))
+        WVPASSEQ(len(bloom.ShaBloom(bfull)), 20)
+        bloom.MAX_PFALSE_POSITIVE = 0
+        WVPASS(git.update_bloom(packdir, second))
+    finally:
+        bloom.MAX_PFALSE_POSITIVE = old_max
+
+    # While someone else holds the filter (e.g. 'bup bloom' regenerating
+    # it), an update doesn't wait, and leaves the index out.
+    os.unlink(bfull)
+    make_bloom(first)
+    lockf = bloom.lock(bfull)
+    WVPASS(not git.update_bloom(packdir, second))
+    lockf.close()
+    WVPASSEQ(len(bloom.ShaBloom(bfull)), 10)
+    WVPASS(not git.update_bloom(packdir, second))
+    WVPASSEQ(len(bloom.ShaBloom(bfull)), 20)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -1,5 +1,8 @@
 from bup import hashsplit, _helpers
+from bup.helpers import Sha1
 from wvtest import *
+from array import array
+import os, random, tempfile
 from cStringIO import StringIO
 
 @wvtest
@@ -20,8 +23,22 @@ def test_fanout_behaviour():
                 return ofs, ord(c)
         return 0, 0
 
-    old_splitbuf = _helpers.splitbuf
-    _helpers.splitbuf = splitbuf
+    # The corresponding batch version, as hashsplit actually calls it.
+    def splitbuf_all(buf, max_blob):
+        splits = []
+        end = 0
+        while 1:
+            ofs, bits = splitbuf(buffer(buf, end))
+            if not ofs:
+                break
+            if ofs > max_blob:
+                ofs, bits = max_blob, 0
+            end += ofs
+            splits += [end, bits]
+        return array('I', splits).tostring()
+
+    old_splitbuf_all = _helpers.splitbuf_all
+    _helpers.splitbuf_all = splitbuf_all
     old_BLOB_MAX = hashsplit.BLOB_MAX
     hashsplit.BLOB_MAX = 4
     old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
@@ -47,7 +64,276 @@ def test_fanout_behaviour():
     WVPASSEQ(levels(split_many),
         [(1, 1), (4, 2), (4, 0), (1, 0), (4, 0), (1, 5), (1, 0)])
 
-    _helpers.splitbuf = old_splitbuf
+    _helpers.splitbuf_all = old_splitbuf_all
     hashsplit.BLOB_MAX = old_BLOB_MAX
     hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
     hashsplit.fanout = old_fanout
+
+
+@wvtest
+def test_splitbuf_all():
+    # Must find the same boundaries as one splitbuf() call per chunk.
+    data = ''.join(chr(random.randrange(256)) for i in xrange(300000))
+    for max_blob in (hashsplit.BLOB_MAX, 1000):
+        expected = []
+        end = 0
+        while 1:
+            ofs, bits = _helpers.splitbuf(buffer(data, end))
+            if not ofs:
+                break
+            if ofs > max_blob:
+                ofs, bits = max_blob, 0
+            end += ofs
+            expected += [end, bits]
+        WVPASS(len(expected) > 10)
+        actual = array('I', _helpers.splitbuf_all(data, max_blob)).tolist()
+        WVPASSEQ(actual, expected)
+    WVPASSEQ(_helpers.splitbuf_all('', 100), '')
+
+
+@wvtest
+def test_buf():
+    buf = hashsplit.Buf(8)
+    buf.put('abcdef')
+    WVPASSEQ(buf.used(), 6)
+    WVPASSEQ(str(buf.peek(4)), 'abcd')
+    WVPASSEQ(str(buf.peek(10)), 'abcdef')
+    buf.eat(2)
+    WVPASSEQ(str(buf.get(3)), 'cde')
+    buf.put('ghij')  # moves 'f' to the front to make room
+    WVPASSEQ(str(buf.peek(buf.used())), 'fghij')
+    WVPASSEQ(buf.fill(StringIO('klmnopq'), 7), 7)  # must grow
+    WVPASSEQ(str(buf.get(buf.used())), 'fghijklmnopq')
+    f = tempfile.TemporaryFile()
+    f.write('xyz')
+    f.seek(0)
+    WVPASSEQ(buf.fill(f, 10), 3)
+    WVPASSEQ(buf.fill(f, 10), 0)
+    WVPASSEQ(str(buf.peek(buf.used())), 'xyz')
+
+
+@wvtest
+def test_hashsplit_iter_chunks():
+    # The chunks must not depend on how (or how much) data was read.
+    data = ''.join(chr(random.randrange(256)) for i in xrange(3000000))
+    expected = []
+    start = 0
+    while start < len(data):
+        ofs, bits = _helpers.splitbuf(buffer(data, start))
+        expected.append(min(ofs or len(data) - start, hashsplit.BLOB_MAX))
+        start += expected[-1]
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    for src in (StringIO(data), f):
+        src.seek(0)
+        chunks = [str(b) for b, level
+                  in hashsplit.hashsplit_iter([src], False, None)]
+        WVPASS([len(c) for c in chunks] == expected)
+        WVPASS(''.join(chunks) == data)
+
+@wvtest
+def test_hashsplit_iter_mmap():
+    # Mapped files must split exactly like read ones, across windows, and
+    # fall back to read() when the file changes size.
+    data = ''.join(chr(random.randrange(256)) for i in xrange(3000000))
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.flush()
+    expected = [str(b) for b, level
+                in hashsplit.hashsplit_iter([StringIO(data)], False, None)]
+    old_min, old_window = hashsplit.MMAP_MIN_SIZE, hashsplit.MMAP_WINDOW
+    try:
+        hashsplit.MMAP_MIN_SIZE = 1
+        hashsplit.MMAP_WINDOW = 256*1024
+        f.seek(0)
+        WVPASS(hashsplit._mmappable([f]))
+        chunks = [str(b) for b, level
+                  in hashsplit.hashsplit_iter([f], False, None)]
+        WVPASS(chunks == expected)
+
+        f.seek(0)
+        chunks = []
+        for b, level in hashsplit.hashsplit_iter([f], False, None):
+            if not chunks:
+                f.seek(0, 2)
+                f.write('extra' * 1000)
+                f.flush()
+            chunks.append(str(b))
+        WVPASS(''.join(chunks) == data + 'extra' * 1000)
+
+        # A shrinking file must not touch the map past its new end
+        # (SIGBUS), but stop there and read() what is left.
+        f.seek(0)
+        chunks = []
+        for b, level in hashsplit.hashsplit_iter([f], False, None):
+            if not chunks:
+                f.truncate(100000)
+            chunks.append(str(b))
+        WVPASS(''.join(chunks) == data[:100000])
+    finally:
+        hashsplit.MMAP_MIN_SIZE, hashsplit.MMAP_WINDOW = old_min, old_window
+
+@wvtest
+def test_gear_chunker():
+    rand = random.Random(4)
+    data = ''.join(chr(rand.randrange(256)) for i in xrange(3000000))
+    old_chunker = hashsplit.chunker
+    try:
+        hashsplit.chunker = hashsplit.GearChunker(1000, 4096, 10000)
+        WVPASSEQ(hashsplit.chunker.basebits(), 12)
+        splits = array('I', hashsplit.chunker.find_splits(data))
+        ends = list(splits[0::2])
+        sizes = [end - start for start, end in zip([0] + ends, ends)]
+        WVPASS(min(sizes) > 1000)
+        WVPASSEQ(max(sizes), 10000)
+        WVPASS(3000 < sum(sizes) / len(sizes) < 6000)
+        # Boundaries must not depend on how the data was read.
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        for src in (StringIO(data), f):
+            src.seek(0)
+            chunks = [str(b) for b, level
+                      in hashsplit.hashsplit_iter([src], False, None)]
+            WVPASSEQ([len(c) for c in chunks[:-1]], sizes)
+            WVPASS(''.join(chunks) == data)
+    finally:
+        hashsplit.chunker = old_chunker
+
+@wvtest
+def test_chunker_from_config():
+    config = {}
+    WVPASSEQ(hashsplit.chunker_from_config(config.get).name, 'rollsum')
+    config['bup.chunker'] = 'gear'
+    c = hashsplit.chunker_from_config(config.get)
+    WVPASSEQ((c.name, c.min_size, c.avg_size, c.max_size()),
+             ('gear', 2048, 8192, 32768))
+    config['bup.chunkAvgSize'] = '16k'
+    config['bup.chunkMaxSize'] = '64k'
+    WVPASSEQ(hashsplit.chunker_from_config(config.get).config(),
+             [('bup.chunker', 'gear'), ('bup.chunkMinSize', '2048'),
+              ('bup.chunkAvgSize', '16384'), ('bup.chunkMaxSize', '65536')])
+    config['bup.chunkAvgSize'] = '10000'
+    WVEXCEPT(ValueError, hashsplit.chunker_from_config, config.get)
+    config['bup.chunkAvgSize'] = '128k'
+    WVEXCEPT(ValueError, hashsplit.chunker_from_config, config.get)
+    config['bup.chunkAvgSize'] = 'x'
+    WVEXCEPT(ValueError, hashsplit.chunker_from_config, config.get)
+    config['bup.chunker'] = 'nope'
+    WVEXCEPT(ValueError, hashsplit.chunker_from_config, config.get)
+
+@wvtest
+def test_resume_split():
+    # Resuming must produce exactly the tree that splitting the whole
+    # file again would.
+    objs = {}
+    def makeblob(blob):
+        sha = Sha1(str(blob)).digest()
+        objs[sha] = str(blob)
+        return sha
+    def maketree(shalist):
+        sha = Sha1(repr(shalist)).digest()
+        objs[sha] = [(mode, int(name, 16), id) for mode, name, id in shalist]
+        return sha
+    def split(f, stacks=None):
+        return hashsplit.split_to_blob_or_tree(makeblob, maketree, [f],
+                                               keep_boundaries=False,
+                                               stacks=stacks)
+    def resume(sha, f):
+        return hashsplit.resume_split(objs.get, objs.get, maketree, sha, f)
+
+    rand = random.Random(21)
+    old_fanout = hashsplit.fanout
+    try:
+        for fanout, data in ((16, 500000), (2, 500000), (16, 0)):
+            hashsplit.fanout = fanout
+            if data:
+                data = ''.join(chr(rand.randrange(256)) for i in xrange(data))
+            else:
+                # Nothing but forced splits, so the trees are closed by
+                # MAX_PER_TREE.
+                data = '\0' * (hashsplit.BLOB_MAX * 300 + 1234)
+            f = tempfile.TemporaryFile()
+            f.write(data)
+            mode, old = split(StringIO(data))
+            WVPASSEQ(mode, hashsplit.GIT_MODE_TREE)
+            WVPASSEQ(resume(old, f), None)  # hasn't grown
+            for extra in (1, 100000):
+                f.seek(0, 2)
+                f.write(data[:extra])
+                stacks = resume(old, f)
+                WVPASS(stacks)
+                WVPASS(0 < f.tell() < len(data))
+                WVPASSEQ(split(f, stacks),
+                         split(StringIO(data + data[:extra])))
+                mode, old = split(StringIO(data + data[:extra]))
+                data += data[:extra]
+            # Anything other than an append (here, a change to the chunk
+            # just before where it would resume) must be noticed.
+            f.seek(0, 2)
+            f.write('more')
+            WVPASS(resume(old, f))
+            ofs = f.tell() - 1
+            f.seek(ofs)
+            c = f.read(1)
+            f.seek(ofs)
+            f.write(chr(ord(c) ^ 1))
+            WVPASSEQ(resume(old, f), None)
+    finally:
+        hashsplit.fanout = old_fanout
+
+@wvtest
+def test_sparse_files():
+    # Skipping holes must produce exactly the chunks (and tree) that
+    # reading all of the zeros would.
+    blobs = []
+    def makeblob(blob):
+        blobs.append(str(blob))
+        return Sha1(str(blob)).digest()
+    def maketree(shalist):
+        return Sha1(repr(shalist)).digest()
+    def split(f):
+        return hashsplit.split_to_blob_or_tree(makeblob, maketree, [f],
+                                               keep_boundaries=False)
+
+    rand = random.Random(23)
+    f = tempfile.TemporaryFile()
+    for hole, size in ((3000000, 100000), (300000, 50000), (2500000, 10),
+                       (0, 1)):
+        f.seek(hole, 1)
+        f.write(''.join(chr(rand.randrange(256)) for i in xrange(size)))
+    f.truncate(f.tell() + 4000000)
+    f.seek(0)
+    data = f.read()
+    old_chunker, old_min = hashsplit.chunker, hashsplit.MMAP_MIN_SIZE
+    old_window = hashsplit.MMAP_WINDOW
+    try:
+        hashsplit.MMAP_MIN_SIZE = 1
+        hashsplit.MMAP_WINDOW = 256*1024
+        for chunker in (hashsplit.RollsumChunker(),
+                        hashsplit.GearChunker(1000, 4096, 10000)):
+            hashsplit.chunker = chunker
+            expected = [(str(b), level) for b, level
+                        in hashsplit.hashsplit_iter([StringIO(data)], False,
+                                                    None)]
+            f.seek(0)
+            chunks = []
+            zeros = 0
+            for b, level in hashsplit.hashsplit_iter([f], False, None):
+                chunks.append((str(b), level))
+                zeros += isinstance(b, hashsplit._ZeroChunk)
+            WVPASS(chunks == expected)
+            f.seek(0)
+            buf = hashsplit.MmapBuf(f)
+            if hashsplit._file_holes(buf):
+                WVPASS(zeros > 0)
+            buf.close()
+
+            expected = split(StringIO(data))
+            del blobs[:]
+            f.seek(0)
+            WVPASSEQ(split(f), expected)
+            # The zero chunk is only stored once.
+            WVPASSEQ(len(blobs), len(chunks) - zeros + (zeros and 1))
+    finally:
+        hashsplit.chunker, hashsplit.MMAP_MIN_SIZE = old_chunker, old_min
+        hashsplit.MMAP_WINDOW = old_window
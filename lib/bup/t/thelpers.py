@@ -1,7 +1,7 @@
 import helpers
 from cStringIO import StringIO
 import math
-import os
+import os, tempfile
 import bup._helpers as _helpers
 from bup.helpers import *
 from wvtest import *
@@ -175,3 +175,84 @@ def test_prefixed_output():
     WVPASSEQ(out.getvalue(), 'xn \n')
     fixer.write('bar\n\n')
     WVPASSEQ(out.getvalue(), 'xn \nxn bar\nxn \n')
+
+
+@wvtest
+def test_worker_pool():
+    pool = WorkerPool(3)
+    try:
+        WVPASSEQ(list(pool.imap(lambda x: x * 2, xrange(100), lookahead=5)),
+                 range(0, 200, 2))
+        WVPASSEQ(list(pool.imap(lambda x: x, [])), [])
+        def fail_on_3(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+        results = pool.imap(fail_on_3, xrange(10))
+        WVPASSEQ([next(results) for i in xrange(3)], [0, 1, 2])
+        WVEXCEPT(ValueError, next, results)
+    finally:
+        pool.close()
+
+
+@wvtest
+def test_excluded_paths():
+    ex = ExcludedPaths(['/a/b', '/a/c/d/', 'rel/x', '/a/./e/../f'])
+    WVPASS(ex)
+    WVPASS(not ExcludedPaths())
+    WVPASS('/a/b' in ex)
+    WVPASS('/a/b/' in ex)
+    WVPASS('/a//c/d' in ex)
+    WVPASS('/a/f' in ex)
+    WVPASS('rel/x' in ex)
+    WVPASS('./rel/x/' in ex)
+    WVPASS('/a' not in ex)
+    WVPASS('/a/c' not in ex)
+    WVPASS('/a/b/z' not in ex)
+    WVPASS('/rel/x' not in ex)
+    a = ex.find('/a/')
+    WVPASS(a and not a.excluded)
+    WVPASS(a.child('b/').excluded)
+    WVPASS(not a.child('c/').excluded)
+    WVPASS(a.child('c/').child('d').excluded)
+    WVPASSEQ(a.child('nope'), None)
+    WVPASSEQ(ex.find('/z/'), None)
+
+
+@wvtest
+def test_rx_excludes():
+    import re
+    patterns = ['^/foo/', r'\.pyc$', '(?i)TMP', r'(a)\1', 'ba+r', 'x|y']
+    rxs = RxExcludes([re.compile(p) for p in patterns])
+    for path in ('/foo/z', '/z/foo/', '/a.pyc', '/a.py', '/tmp/', '/Tmp',
+                 '/aa', '/ab', '/baaar', '/br', '/x', '/yes', '/zzz'):
+        expected = [rx for rx in rxs if rx.search(path)]
+        WVPASS(rxs.search(path) in (expected or [None]))
+        WVPASSEQ(should_rx_exclude_path(path, rxs), bool(expected))
+        WVPASSEQ(should_rx_exclude_path(path, list(rxs)), bool(expected))
+    WVPASSEQ(rxs.search('/foo/x.pyc').pattern, '^/foo/')
+    WVPASSEQ(RxExcludes().search('/foo'), None)
+
+@wvtest
+def test_write_sparsely():
+    blocks = ['\0' * 100000, 'data', '\0' * 10, 'more', '\0' * 200000]
+    for n in (len(blocks), len(blocks) - 1):
+        f = tempfile.TemporaryFile()
+        write_sparsely(f, blocks[:n])
+        f.seek(0)
+        WVPASS(f.read() == ''.join(blocks[:n]))
+    f = tempfile.TemporaryFile()
+    f.write('x')
+    write_sparsely(f, blocks)
+    write_sparsely(f, ['y'])
+    f.seek(0)
+    WVPASS(f.read() == 'x' + ''.join(blocks) + 'y')
+    # Seeks don't apply to appends, so nothing may be skipped.
+    f = tempfile.NamedTemporaryFile()
+    f.write('x')
+    f.flush()
+    af = open(f.name, 'ab')
+    write_sparsely(af, blocks)
+    af.close()
+    f.seek(0)
+    WVPASS(f.read() == 'x' + ''.join(blocks))
@@ -182,3 +182,459 @@ def index_dirty():
         os.chdir(orig_cwd)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def metastore_hash():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    try:
+        os.chdir(tmpdir)
+        metas = []
+        for i in xrange(3000):
+            m = metadata.Metadata()
+            m.symlink_target = 'target-%d' % i
+            metas.append(m)
+
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        ofs = [ms.store(m) for m in metas]
+        WVPASSEQ(len(set(ofs)), len(metas))
+        WVPASSEQ(ofs[0], 0)
+        WVPASSEQ(ms.store(metas[0]), 0)
+        WVPASSEQ(ms.store(metas[1234]), ofs[1234])
+        ms.close()
+        size = os.path.getsize('index.meta.tmp')
+        WVPASS(os.path.exists('index.meta.tmp.hash'))
+
+        msr = index.MetaStoreReader('index.meta.tmp')
+        WVPASSEQ(msr.metadata_at(ofs[1234]).symlink_target, 'target-1234')
+        msr.close()
+
+        # A clean table covers the whole store, so nothing's appended.
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        WVPASSEQ([ms.store(m) for m in metas], ofs)
+        ms.close()
+        WVPASSEQ(os.path.getsize('index.meta.tmp'), size)
+
+        # Records appended without the table are picked up...
+        extra = metadata.Metadata()
+        extra.symlink_target = 'extra'
+        f = open('index.meta.tmp', 'ab')
+        f.write(extra.encode(include_path=False))
+        f.close()
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        WVPASSEQ(ms.store(extra), size)
+        ms.close()
+
+        # ...and a table that wasn't closed, or is missing, is rebuilt.
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        new = metadata.Metadata()
+        new.symlink_target = 'new'
+        new_ofs = ms.store(new)
+        ms._file.flush()
+        ms._table._close_map()
+        ms._table = None
+        del ms
+        for i in range(2):
+            ms = index.MetaStoreWriter('index.meta.tmp')
+            WVPASSEQ(ms.store(new), new_ofs)
+            WVPASSEQ(ms.store(metas[2999]), ofs[2999])
+            ms.close()
+            os.unlink('index.meta.tmp.hash')
+    finally:
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def metastore_compaction():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    try:
+        os.chdir(tmpdir)
+        def meta(target):
+            m = metadata.Metadata()
+            m.symlink_target = target
+            return m
+
+        fs = xstat.stat(lib_t_dir + '/tindex.py')
+        ds = xstat.stat(lib_t_dir)
+        ms = index.MetaStoreWriter('index.tmp.meta')
+        for i in xrange(100):
+            ms.store(meta('unused-%d' % i))
+        tmax = (time.time() - 1) * 10**9
+        w = index.Writer('index.tmp', ms, tmax)
+        w.add('/a/y', fs, ms.store(meta('y')))
+        w.add('/a/x', fs, ms.store(meta('x')))
+        w.add('/a/', ds, ms.store(meta('a')))
+        w.close()
+        ms.close()
+
+        def targets():
+            msr = index.MetaStoreReader('index.tmp.meta')
+            r = index.Reader('index.tmp')
+            result = [(e.name, getattr(msr.metadata_at(e.meta_ofs),
+                                       'symlink_target', None))
+                      for e in r]
+            r.close()
+            msr.close()
+            return result
+
+        before = targets()
+        WVPASSEQ([t for t in before if t[0].startswith('/a/')],
+                 [('/a/y', 'y'), ('/a/x', 'x'), ('/a/', 'a')])
+        referenced, total = index.meta_usage('index.tmp')
+        # y, x, a and the root's empty record
+        WVPASSEQ((referenced, total), (4, 104))
+        old_size, new_size = index.compact_meta('index.tmp')
+        WVPASSEQ(os.path.getsize('index.tmp.meta'), new_size)
+        WVPASSLT(new_size, old_size / 10)
+        WVPASSEQ(targets(), before)
+        WVPASS(not os.path.exists('index.tmp.compact'))
+        WVPASS(not os.path.exists('index.tmp.meta.compact'))
+        WVPASS(not os.path.exists('index.tmp.meta.hash.compact'))
+
+        # The hash table is rewritten to match the compacted store.
+        table = index.MetaHashTable('index.tmp.meta.hash')
+        WVPASSEQ(table.open(), new_size)
+        WVPASSEQ(table.used, 4)
+        table.close(new_size)
+        ms = index.MetaStoreWriter('index.tmp.meta')
+        WVPASSEQ(ms.store(meta('unused-0')), new_size)
+        WVPASSEQ(dict(before)['/a/x'],
+                 index.MetaStoreReader('index.tmp.meta').metadata_at(
+                     ms.store(meta('x'))).symlink_target)
+        ms.close()
+
+        # An interrupted compaction is undone before the new store is
+        # renamed into place, and finished after.
+        open('index.tmp.compact', 'wb').write('partial')
+        open('index.tmp.meta.compact', 'wb').write('partial')
+        open('index.tmp.meta.hash.compact', 'wb').write('partial')
+        WVPASSEQ(targets(), before)
+        WVPASS(not os.path.exists('index.tmp.compact'))
+        WVPASS(not os.path.exists('index.tmp.meta.compact'))
+        WVPASS(not os.path.exists('index.tmp.meta.hash.compact'))
+        os.rename('index.tmp', 'index.tmp.compact')
+        os.rename('index.tmp.meta.hash', 'index.tmp.meta.hash.compact')
+        WVPASSEQ(targets(), before)
+        WVPASS(not os.path.exists('index.tmp.compact'))
+        WVPASS(not os.path.exists('index.tmp.meta.hash.compact'))
+        WVPASS(os.path.exists('index.tmp.meta.hash'))
+
+        # Compaction waits for (or skips) anyone else using the index.
+        user = index.Lock('index.tmp')
+        WVPASS(user.acquire())
+        lock = index.Lock('index.tmp')
+        WVPASS(lock.acquire())
+        WVPASS(not lock.acquire(exclusive=True, wait=False))
+        user.close()
+        WVPASS(lock.acquire(exclusive=True, wait=False))
+        lock.close()
+    finally:
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def index_journal():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    old_min = index.journal_min_entries
+    try:
+        os.chdir(tmpdir)
+        ds = xstat.stat(lib_t_dir)
+        fs = xstat.stat(lib_t_dir + '/tindex.py')
+        tmax = (time.time() - 1) * 10**9
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        w = index.Writer('index.tmp', ms, tmax)
+        w.add('/a/c', fs, 0)
+        w.add('/a/b/x', fs, 0)
+        w.add('/a/b/', ds, 0)
+        w.add('/a/', ds, 0)
+        w.close()
+        r = index.Reader('index.tmp')
+        fake_validate(r)
+        r.close()
+
+        def add(*names):
+            ri = index.Reader('index.tmp')
+            wi = index.Writer('index.tmp', ms, tmax)
+            for name in names:
+                wi.add(name, name.endswith('/') and ds or fs, 0)
+            wr = wi.new_reader()
+            index.add_entries(ri, wr, ms, tmax)
+            wr.close()
+            wi.abort()
+
+        base_size = os.path.getsize('index.tmp')
+        add('/a/d/y', '/a/d/', '/a/b/w')
+        WVPASS(os.path.getsize('index.tmp') > base_size)
+        r = index.Reader('index.tmp')
+        all_names = ['/a/d/y', '/a/d/', '/a/c', '/a/b/x', '/a/b/w', '/a/b/',
+                     '/a/', '/']
+        WVPASSEQ([e.name for e in r], all_names)
+        WVPASSEQ(r.count, 5)
+        WVPASSEQ(len(r), 8)
+        # The new entries' parents (and theirs) need rechecking.
+        WVPASSEQ([e.name for e in r if not e.is_valid()],
+                 ['/a/d/y', '/a/d/', '/a/b/w', '/a/b/', '/a/', '/'])
+        WVPASSEQ([e.name for e in r.iter(name='/a/d/')], ['/a/d/y', '/a/d/'])
+        WVPASSEQ(r.find('/a/b/w').name, '/a/b/w')
+        WVPASSEQ(r.find('/a/b/x').name, '/a/b/x')
+        WVPASSEQ(r.find('/a/b/nope'), None)
+        # Pruned directories hide their journal entries too.
+        WVPASSEQ([e.name for e in r.iter(wantrecurse=lambda e:
+                                          e.name not in ('/a/b/', '/a/d/'))],
+                 ['/a/d/', '/a/c', '/a/b/', '/a/', '/'])
+        fake_validate(r)
+        r.close()
+
+        # Journal entries are updated in place, and invalidate parents.
+        r = index.Reader('index.tmp')
+        WVPASSEQ([e.name for e in r if not e.is_valid()], [])
+        e = r.find('/a/d/y')
+        e.invalidate()
+        e.repack()
+        WVPASSEQ([e.name for e in r if not e.is_valid()],
+                 ['/a/d/y', '/a/d/', '/a/', '/'])
+        fake_validate(r)
+        r.close()
+
+        # An interrupted append is ignored.
+        with open('index.tmp', 'ab') as f:
+            f.write('/a/d/z\0' + '\xff' * 20)
+        r = index.Reader('index.tmp')
+        WVPASSEQ([e.name for e in r], all_names)
+        r.close()
+
+        # But a damaged batch isn't.
+        r = index.Reader('index.tmp')
+        journal_start = r.end
+        r.close()
+        with open('index.tmp', 'rb') as f:
+            good_index = f.read()
+        with open('index.tmp', 'r+b') as f:
+            f.seek(journal_start)
+            f.write('x')
+        WVEXCEPT(index.Error, index.Reader, 'index.tmp')
+        with open('index.tmp', 'wb') as f:
+            f.write(good_index)
+
+        ms2 = index.MetaStoreWriter('index.meta.tmp')
+        index.fold_journal('index.tmp', ms2, tmax)
+        ms2.close()
+        r = index.Reader('index.tmp')
+        WVPASSEQ(len(r.journal), 0)
+        WVPASSEQ([e.name for e in r], all_names)
+        WVPASSEQ(r.count, 8)
+        WVPASSEQ([e.name for e in r if not e.is_valid()], [])
+        r.close()
+
+        # If another process rewrites the index before the new entries
+        # are appended, they're merged with the index instead.
+        ri = index.Reader('index.tmp')
+        index.journal_min_entries = 1
+        add('/a/h')
+        index.journal_min_entries = old_min
+        WVPASS(os.path.getsize('index.tmp') != ri.ident[1])
+        wi = index.Writer('index.tmp', ms, tmax)
+        wi.add('/a/g', fs, 0)
+        wr = wi.new_reader()
+        index.add_entries(ri, wr, ms, tmax)
+        wr.close()
+        wi.abort()
+        r = index.Reader('index.tmp')
+        WVPASSEQ(len(r.journal), 0)
+        WVPASSEQ([e.name for e in r], ['/a/g'] + all_names)
+        r.close()
+
+        # Too many new entries are merged into a new index right away.
+        index.journal_min_entries = 1
+        add('/a/f', '/a/e')
+        r = index.Reader('index.tmp')
+        WVPASSEQ(len(r.journal), 0)
+        WVPASSEQ(r.count, 11)
+        WVPASSEQ([e.name for e in r][:4], ['/a/g', '/a/f', '/a/e', '/a/d/y'])
+        r.close()
+    finally:
+        index.journal_min_entries = old_min
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def index_path_table():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    old_min = index.path_table_min_entries
+    try:
+        os.chdir(tmpdir)
+        ds = xstat.stat(lib_t_dir)
+        fs = xstat.stat(lib_t_dir + '/tindex.py')
+        tmax = (time.time() - 1) * 10**9
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        w = index.Writer('index.tmp', ms, tmax)
+        w.add('/a/c/', ds, 0)
+        w.add('/a/c', fs, 0)
+        w.add('/a/b/y', fs, 0)
+        w.add('/a/b/x', fs, 0)
+        w.add('/a/b/', ds, 0)
+        w.add('/a/', ds, 0)
+        w.close()
+        r = index.Reader('index.tmp')
+        fake_validate(r)
+        r.close()
+
+        def names(it):
+            return [e.name for e in it]
+        queries = ('/', '/a/', '/a', '/a/b/', '/a/b', '/a/b/x', '/a/c',
+                   '/a/c/', '/a/nope', '/nope/x')
+        saved = lambda e: e.name != '/a/b/'
+        r = index.Reader('index.tmp')
+        expected = [names(r.iter(name=q)) for q in queries]
+        expected_saved = [names(r.iter(name=q, wantrecurse=saved))
+                          for q in queries]
+        WVPASSEQ(r.find('/a/b/x').name, '/a/b/x')
+        r.close()
+        WVPASS(not os.path.exists('index.tmp.paths'))
+
+        index.path_table_min_entries = 0
+        r = index.Reader('index.tmp')
+        WVPASSEQ(r.find('/a/b/x').name, '/a/b/x')
+        WVPASS(os.path.exists('index.tmp.paths'))
+        WVPASSEQ(r._paths.count, 7)
+        for q in ('/', '/a/', '/a/b/', '/a/b/y', '/a/c', '/a/c/'):
+            WVPASSEQ(r.find(q).name, q)
+        WVPASSEQ(r.find('/a/b'), None)
+        WVPASSEQ(r.find('/a/nope'), None)
+        WVPASSEQ([names(r.iter(name=q)) for q in queries], expected)
+        WVPASSEQ([names(r.iter(name=q, wantrecurse=saved)) for q in queries],
+                 expected_saved)
+        # Invalidating an entry found via the table invalidates its parents.
+        e = r.find('/a/b/y')
+        e.invalidate()
+        e.repack()
+        WVPASSEQ([e.name for e in r if not e.is_valid()],
+                 ['/a/b/y', '/a/b/', '/a/', '/'])
+        r.close()
+        # Updating entries in place doesn't make the table out of date...
+        table_ino = os.stat('index.tmp.paths').st_ino
+        r = index.Reader('index.tmp')
+        WVPASSEQ(r.find('/a/b/x').name, '/a/b/x')
+        WVPASSEQ(os.stat('index.tmp.paths').st_ino, table_ino)
+        r.close()
+        # ...but any other change to the index (even one that keeps its
+        # inode and size, say) does.
+        time.sleep(0.01)
+        f = open('index.tmp', 'r+b')
+        data = f.read()
+        f.seek(0)
+        f.write(data)
+        f.close()
+        WVPASSEQ(os.path.getsize('index.tmp'), len(data))
+        r = index.Reader('index.tmp')
+        WVPASSEQ(r.find('/a/b/x').name, '/a/b/x')
+        WVPASS(os.stat('index.tmp.paths').st_ino != table_ino)
+        r.close()
+
+        # A table for an older version of the index is rebuilt.
+        w = index.Writer('index.tmp', ms, tmax)
+        w.add('/a/d', fs, 0)
+        w.add('/a/', ds, 0)
+        w.close()
+        r = index.Reader('index.tmp')
+        WVPASSEQ(r.find('/a/b/x'), None)
+        WVPASSEQ(r.find('/a/d').name, '/a/d')
+        WVPASSEQ(r._paths.count, 3)
+        r.close()
+    finally:
+        index.path_table_min_entries = old_min
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def index_lazy_entries():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    try:
+        os.chdir(tmpdir)
+        ds = xstat.stat(lib_t_dir)
+        fs = xstat.stat(lib_t_dir + '/tindex.py')
+        tmax = (time.time() - 1) * 10**9
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        w = index.Writer('index.tmp', ms, tmax)
+        w.add('/a/b', fs, 7)
+        w.add('/a/', ds, 5)
+        w.close()
+        r = index.Reader('index.tmp')
+        entries = list(r.forward_iter())
+        WVPASSEQ([e.name for e in entries], ['b', 'a/', '/'])
+        b = entries[0]
+        WVPASSEQ(b.size, fs.st_size)
+        WVPASSEQ(b.mode, fs.st_mode)
+        WVPASSEQ(b.mtime, min(fs.st_mtime, tmax))
+        WVPASSEQ(b.meta_ofs, 7)
+        WVEXCEPT(AttributeError, getattr, b, 'nonexistent')
+        # Fields that have been set aren't overwritten by later decoding.
+        b.flags = 0
+        WVPASS(struct.unpack(index.INDEX_SIG, b.packed())[15] == 0)
+        WVPASSEQ(entries[1].packed(),
+                 str(buffer(r.m, entries[1]._ofs, index.ENTLEN)))
+        WVPASSEQ(list(r.columns('basename', 'size', 'mode', 'meta_ofs')),
+                 [(e.basename, e.size, e.mode, e.meta_ofs) for e in entries])
+        WVPASSEQ(list(r.columns('mtime', 'flags')),
+                 [(e.mtime, e.flags) for e in r.forward_iter()])
+        WVEXCEPT(ValueError, list, r.columns('nonexistent'))
+        r.close()
+    finally:
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def index_hashes_by_identity():
+    initial_failures = wvfailure_count()
+    orig_cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tindex-')
+    try:
+        os.chdir(tmpdir)
+        ds = xstat.stat(lib_t_dir)
+        fs = xstat.stat(lib_t_dir + '/tindex.py')
+        gs = xstat.stat(lib_t_dir + '/thelpers.py')
+        ms = index.MetaStoreWriter('index.meta.tmp')
+        # Without a tmax, so that the times are recorded as they are.
+        w = index.Writer('index.tmp', ms, None)
+        w.add('/a/g', gs, 0)
+        w.add('/a/f', fs, 0)
+        w.add('/a/', ds, 0)
+        w.close()
+        r = index.Reader('index.tmp')
+        WVPASSEQ(r.hashes_by_identity(), {})
+        fake_validate(r)
+        g = eget(r, '/a/g')
+        g.invalidate()
+        g.repack()
+        WVPASSEQ(r.hashes_by_identity(),
+                 {index.stat_identity(fs): (0100644, index.FAKE_SHA)})
+        WVPASSEQ(eget(r, '/a/f').identity(), index.stat_identity(fs))
+        WVPASSEQ(index.stat_identity(ds), None)
+        WVPASSEQ(r.hashes_by_identity(check_device=False).keys(),
+                 [index.stat_identity(fs, check_device=False)])
+        WVPASSEQ(index.stat_identity(fs, check_device=False)[0], 0)
+        r.close()
+    finally:
+        os.chdir(orig_cwd)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -97,4 +97,28 @@ $(pwd)/src/a/
 $(pwd)/src/a-link
 $(pwd)/src/"
 
+WVSTART "drecurse --jobs"
+WVPASS mkdir -p src/d/e/f src/d/g src/h
+WVPASS touch src/d/e/f/1 src/d/e/2 src/d/g/3 src/h/4
+WVPASS chmod 000 src/d/g
+serial="$(bup drecurse --exclude src/h src 2>&1)"
+WVPASSEQ "$(bup drecurse -j 1 --exclude src/h src 2>&1)" "$serial"
+WVPASSEQ "$(bup drecurse -j 4 --exclude src/h src 2>&1)" "$serial"
+WVPASS chmod 755 src/d/g
+WVPASSEQ "$(bup drecurse -j 3 "$(pwd)/src")" "$(bup drecurse "$(pwd)/src")"
+WVFAIL bup drecurse -j 0 src
+
+# A deep tree with many directories at each level must not need more
+# fds than the walk's depth plus the jobs.
+WVPASS rm -rf src
+dir=src
+for level in $(seq 12); do
+    WVPASS mkdir -p "$dir"/{1..40}
+    WVPASS touch "$dir/9/file"
+    dir="$dir/9"
+done
+serial="$(WVPASS bup drecurse src)" || exit $?
+WVPASSEQ "$(echo "$serial" | wc -l)" 493
+WVPASSEQ "$(ulimit -n 64; bup drecurse -j 8 src 2>&1)" "$serial"
+
 WVPASS rm -rf "$tmpdir"
@@ -0,0 +1,60 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+
+WVPASS bup init
+WVPASS cd "$tmpdir"
+
+
+WVSTART "index (renamed files)"
+WVPASS mkdir -p src/old/sub
+WVPASS bup random 100k > src/old/sub/data
+WVPASS echo hello > src/old/hello
+WVPASS echo other > src/old/other
+WVPASS ln -s hello src/old/link
+# Don't let the files look like they might still be changing.
+WVPASS sleep 1
+WVPASS bup index -u src
+WVPASS bup save -n src src
+WVPASS mv src/old src/new
+WVPASS ln src/new/hello src/new/hello2
+WVPASS bup index -u src
+# The new hard link changed hello's ctime, so it has to be read again.
+WVPASSEQ "$(WVPASS bup index -s src/new/)" \
+"  src/new/sub/data
+A src/new/sub/
+  src/new/other
+  src/new/link
+A src/new/hello2
+A src/new/hello
+A src/new/"
+
+# A file that changed while it was renamed has to be read again.
+WVPASS mv src/new/other src/other
+WVPASS echo changed > src/other
+WVPASS bup index -u src
+WVPASSEQ "$(WVPASS bup index -s src/other)" "A src/other"
+
+WVPASS bup save -n src src
+files=("src/latest/$tmpdir/src/new/sub/data" "src/latest/$tmpdir/src/new/link"
+       "src/latest/$tmpdir/src/other")
+saved="$(WVPASS bup ls -s "${files[@]}")" || exit $?
+
+# Reading everything again must produce exactly the same trees.
+WVPASS bup index --clear
+WVPASS bup index -u src
+WVPASS bup save -n src src
+WVPASSEQ "$(WVPASS bup ls -s "${files[@]}")" "$saved"
+
+
+WVPASS rm -rf "$tmpdir"
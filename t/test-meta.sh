@@ -93,6 +93,12 @@ test-src-save-restore()
         WVPASS bup restore -C src-restore "/src/latest$(pwd)/"
         WVPASS test -d src-restore/src
         WVPASS "$TOP/t/compare-trees" -c src/ src-restore/src/
+        # Restoring files in parallel must produce the same tree.
+        WVPASS force-delete src-restore
+        WVPASS mkdir src-restore
+        WVPASS bup restore -j 4 -C src-restore "/src/latest$(pwd)/"
+        WVPASS test -d src-restore/src
+        WVPASS "$TOP/t/compare-trees" -c src/ src-restore/src/
         WVPASS rm -rf src.bup
     )
 }
@@ -244,7 +250,7 @@ hardlink-test-run-restore()
 {
     WVPASS force-delete src-restore
     WVPASS mkdir src-restore
-    WVPASS bup restore -C src-restore "/src/latest$(pwd)/"
+    WVPASS bup restore "$@" -C src-restore "/src/latest$(pwd)/"
     WVPASS test -d src-restore/src
 }
 
@@ -329,6 +335,10 @@ WVSTART 'metadata save/restore (hardlinks)'
     (WVPASS cd src-restore; WVPASS hardlink-sets .) > hardlink-sets.restored \
         || exit $?
     WVPASS diff -u hardlink-sets.expected hardlink-sets.restored
+    WVPASS hardlink-test-run-restore -j 4
+    (WVPASS cd src-restore; WVPASS hardlink-sets .) > hardlink-sets.restored \
+        || exit $?
+    WVPASS diff -u hardlink-sets.expected hardlink-sets.restored
 
     # Test that we don't link outside restore tree.
     WVPASS setup-hardlink-test
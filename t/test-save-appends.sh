@@ -0,0 +1,53 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+
+WVPASS bup init
+WVPASS cd "$tmpdir"
+
+
+WVSTART "save --detect-appends"
+WVPASS mkdir src
+WVPASS bup random 2M > src/log
+WVPASS bup index -u src
+WVPASS bup save -n src src
+WVPASS bup random --seed=2 300k >> src/log
+WVPASS bup index -u src
+WVPASS bup --debug save -n src --detect-appends src 2>&1 \
+    | WVPASS grep 'log: resuming split at'
+appended="$(WVPASS bup ls -s "src/latest/$tmpdir/src/log")" || exit $?
+
+# Splitting the whole file must produce exactly the same tree.
+WVPASS bup index --clear
+WVPASS bup index -u src
+WVPASS bup save -n src src
+WVPASSEQ "$(WVPASS bup ls -s "src/latest/$tmpdir/src/log")" "$appended"
+
+WVPASS bup restore -C restore "src/latest/$tmpdir/src/log"
+WVPASS cmp src/log restore/log
+
+
+WVSTART "save --detect-appends (rewritten file)"
+WVPASS bup random --seed=3 2M > src/log
+WVPASS bup random --seed=2 300k >> src/log
+WVPASS bup index -u src
+WVPASS bup --debug save -n src --detect-appends src 2>&1 \
+    | WVFAIL grep 'log: resuming split at'
+WVPASS rm -r restore
+WVPASS bup restore -C restore "src/latest/$tmpdir/src/log"
+WVPASS cmp src/log restore/log
+
+WVFAIL bup save -r :"$BUP_DIR" -n src --detect-appends src
+
+
+WVPASS rm -rf "$tmpdir"
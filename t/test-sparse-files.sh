@@ -0,0 +1,75 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+# Print the disk usage of the given file, in KiB.
+usage() { du -k "$1" | cut -f1; }
+
+
+WVPASS bup init
+WVPASS cd "$tmpdir"
+
+
+WVSTART "save (sparse files)"
+WVPASS mkdir src
+WVPASS dd if=/dev/zero of=src/image bs=1M seek=40 count=0
+WVPASS bup random 100k \
+    | WVPASS dd of=src/image bs=1k seek=10000 conv=notrunc
+WVPASS bup random --seed=2 1M \
+    | WVPASS dd of=src/image bs=1k seek=25000 conv=notrunc
+WVPASS cat src/image > src/dense
+WVPASS bup index -u src
+WVPASS bup save -n src src
+image="$(WVPASS bup ls -s "src/latest/$tmpdir/src/image" | cut -d' ' -f1)" \
+    || exit $?
+# The holes must split exactly like the zeros they read as.
+WVPASSEQ "$(WVPASS bup ls -s "src/latest/$tmpdir/src/dense" | cut -d' ' -f1)" \
+    "$image"
+
+# Only check the space used if the filesystem supports holes.
+sparse=''
+if test "$(usage src/image)" -lt 5000; then
+    sparse=true
+fi
+
+
+WVSTART "restore --sparse"
+WVPASS bup restore -C restore "src/latest/$tmpdir/src/"
+WVPASS cmp src/image restore/image
+WVPASS cmp src/dense restore/dense
+WVPASS bup restore --sparse -C restore-sparse "src/latest/$tmpdir/src/"
+WVPASS cmp src/image restore-sparse/image
+WVPASS cmp src/dense restore-sparse/dense
+if test "$sparse"; then
+    WVPASS test "$(usage restore-sparse/image)" -lt 5000
+    WVPASS test "$(usage restore-sparse/dense)" -lt 5000
+fi
+
+
+WVSTART "join --sparse"
+WVPASS bup join --sparse -o joined "$image"
+WVPASS cmp src/image joined
+WVPASS bup join --sparse "$image" > joined-stdout
+WVPASS cmp src/image joined-stdout
+WVPASS echo x > joined-append
+WVPASS bup join --sparse "$image" >> joined-append
+WVPASS echo x > expected-append
+WVPASS cat src/image >> expected-append
+WVPASS cmp expected-append joined-append
+if test "$sparse"; then
+    WVPASS test "$(usage joined)" -lt 5000
+    WVPASS test "$(usage joined-stdout)" -lt 5000
+fi
+WVFAIL bup join --sparse "$image" | cat > /dev/null
+
+
+WVPASS rm -rf "$tmpdir"
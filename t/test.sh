@@ -144,6 +144,9 @@ WVPASSEQ "$(cat tag[ab].tmp | bup split -b --git-ids)" \
          "$(cat tagab.tmp)"
 WVPASS bup split --bench -b <"$top/t/testfile1" >tags1.tmp
 WVPASS bup split -vvvv -b "$top/t/testfile2" >tags2.tmp
+WVPASSEQ "$(bup split -j 4 -b "$top/t/testfile2")" "$(cat tags2.tmp)"
+WVPASSEQ "$(bup split -j 4 -t "$top/t/testfile2")" \
+         "$(bup split -t "$top/t/testfile2")"
 WVPASS echo -n "" | bup split -n split_empty_string.tmp
 WVPASS bup margin
 WVPASS bup midx -f
@@ -309,6 +312,25 @@ WVPASS bup tag -f -d v0.1
 WVFAIL bup tag -d v0.1
 
 
+WVSTART "split (gear chunker)"
+(
+    tmp=split-gear.tmp
+    WVPASS force-delete $tmp
+    WVPASS mkdir $tmp
+    export BUP_DIR="$(WVPASS pwd)/$tmp/bup" || exit $?
+    WVFAIL bup init --chunker=nope
+    WVFAIL bup init --chunk-sizes=4k,10k,64k
+    WVPASS bup init --chunker=gear --chunk-sizes=4k,16k,64k
+    WVPASSEQ "$(git --git-dir="$BUP_DIR" config bup.chunkAvgSize)" 16384
+    WVPASS bup split -n gear "$top/t/testfile1"
+    WVPASS bup join gear >$tmp/testfile1
+    WVPASS cmp "$top/t/testfile1" $tmp/testfile1
+    WVPASSEQ "$(bup split -b --remote=":$BUP_DIR" "$top/t/testfile1")" \
+             "$(bup split -b "$top/t/testfile1")"
+    WVPASS rm -r "$tmp"
+) || exit $?
+
+
 WVSTART "save (no index)"
 (
     tmp=save-no-index.tmp